@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""
+Author:   Micha Silver
+Version:  0.1
+Description:
+  Incremental copy of forecast, rain and image files into the web archive.
+  Files already in the archive with the same size and md5 are skipped.
+  When source and destination are on the same filesystem files are hard linked
+  (or reflinked where hard links are refused), otherwise they are copied
+  with a large buffer in a pool of threads.
+  Every file is written under a temporary name in the target directory
+  then renamed, so web readers never see a partial file.
+
+  Can also be run from the command line:
+    archive_copy.py [-m|--move] [-f|--flat] <source dir> <destination dir>
+"""
+
+import os, sys, errno, shutil, hashlib, logging, argparse
+from multiprocessing.pool import ThreadPool
+
+# Copy buffer size, and number of copy threads
+COPY_BUFSIZE = 1024 * 1024
+COPY_THREADS = 4
+# Linux ioctl to clone (reflink) a file: FICLONE = _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+def file_md5(path):
+    """
+    Return the md5 hex digest of a file, read in COPY_BUFSIZE chunks
+    """
+    h = hashlib.md5()
+    f = open(path, 'rb')
+    try:
+        while True:
+            buf = f.read(COPY_BUFSIZE)
+            if not buf:
+                break
+            h.update(buf)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
+def same_file(src, dest):
+    """
+    True if dest already holds the contents of src:
+    either the same inode (an earlier hard link) or equal size and md5
+    The md5 is computed only when the sizes match
+    """
+    try:
+        d = os.stat(dest)
+    except OSError:
+        return False
+    s = os.stat(src)
+    if (s.st_dev, s.st_ino) == (d.st_dev, d.st_ino):
+        return True
+    if s.st_size != d.st_size:
+        return False
+    return file_md5(src) == file_md5(dest)
+
+
+def reflink(src, dest):
+    """
+    Clone src into the (new) file dest with the FICLONE ioctl
+    Raises IOError where the filesystem does not support reflinks
+    """
+    import fcntl
+    fsrc = open(src, 'rb')
+    try:
+        fdst = open(dest, 'wb')
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        finally:
+            fdst.close()
+    except (IOError, OSError):
+        if os.path.exists(dest):
+            os.unlink(dest)
+        raise
+    finally:
+        fsrc.close()
+
+
+def copy_file(src, dest, same_fs):
+    """
+    Put one file into place at dest through a temporary name
+    Returns the method used: 'link', 'reflink' or 'copy'
+    """
+    dest_dir, dest_name = os.path.split(dest)
+    tmp = os.path.join(dest_dir, ".%s.%s.tmp" % (dest_name, os.getpid()))
+    method = None
+    if same_fs:
+        try:
+            os.link(src, tmp)
+            method = 'link'
+        except OSError:
+            try:
+                reflink(src, tmp)
+                shutil.copystat(src, tmp)
+                method = 'reflink'
+            except (IOError, OSError):
+                pass
+
+    if method is None:
+        fsrc = open(src, 'rb')
+        try:
+            fdst = open(tmp, 'wb')
+            try:
+                shutil.copyfileobj(fsrc, fdst, COPY_BUFSIZE)
+            finally:
+                fdst.close()
+        finally:
+            fsrc.close()
+        shutil.copystat(src, tmp)
+        method = 'copy'
+
+    try:
+        os.rename(tmp, dest)
+    except OSError:
+        os.unlink(tmp)
+        raise
+    return method
+
+
+def list_files(src_dir, flat=False):
+    """
+    List (relative path) of all files under src_dir
+    With flat=True only the files directly in src_dir are listed
+    (files in subdirectories are left alone)
+    """
+    rel_paths = []
+    if flat:
+        for f in sorted(os.listdir(src_dir)):
+            if os.path.isfile(os.path.join(src_dir, f)):
+                rel_paths.append(f)
+        return rel_paths
+
+    for root, dirs, fnames in os.walk(src_dir):
+        dirs.sort()
+        rel_root = os.path.relpath(root, src_dir)
+        for f in sorted(fnames):
+            if rel_root == os.curdir:
+                rel_paths.append(f)
+            else:
+                rel_paths.append(os.path.join(rel_root, f))
+    return rel_paths
+
+
+def sync_tree(src_dir, dest_dir, flat=False, move=False, threads=COPY_THREADS):
+    """
+    Incrementally copy all files of src_dir into dest_dir
+    keeping the subdirectory structure (or only the top level files if flat=True)
+    Files already in place (same size and md5) are skipped.
+    If move=True the source files are removed once they are safely in dest_dir
+    Returns a dict of counts: link, reflink, copy, skip, error and the number of bytes transferred
+    """
+    stats = {'link': 0, 'reflink': 0, 'copy': 0, 'skip': 0, 'error': 0, 'bytes': 0}
+    if not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir)
+    same_fs = os.stat(src_dir).st_dev == os.stat(dest_dir).st_dev
+
+    # Create the destination subdirectories up front, not from the threads
+    rel_paths = list_files(src_dir, flat)
+    for d in sorted(set(os.path.dirname(r) for r in rel_paths)):
+        if d and not os.path.isdir(os.path.join(dest_dir, d)):
+            os.makedirs(os.path.join(dest_dir, d))
+
+    def transfer(rel_path):
+        src = os.path.join(src_dir, rel_path)
+        dest = os.path.join(dest_dir, rel_path)
+        try:
+            if same_file(src, dest):
+                method = 'skip'
+            else:
+                method = copy_file(src, dest, same_fs)
+            if move:
+                os.unlink(src)
+            return method, rel_path, os.path.getsize(dest)
+        except (IOError, OSError) as e:
+            logging.error("Archive copy of %s to %s failed: %s", src, dest, str(e))
+            return 'error', rel_path, 0
+
+    pool = ThreadPool(max(1, threads))
+    try:
+        results = pool.map(transfer, rel_paths)
+    finally:
+        pool.close()
+        pool.join()
+
+    for method, rel_path, nbytes in results:
+        stats[method] += 1
+        if method in ('link', 'reflink', 'copy'):
+            stats['bytes'] += nbytes
+            logging.debug("Archived (%s): %s", method, rel_path)
+
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incremental copy of a directory into the web archive")
+    parser.add_argument("src_dir", help="Source directory")
+    parser.add_argument("dest_dir", help="Destination directory")
+    parser.add_argument("-f", "--flat", action="store_true", help="Copy only the files directly in the source directory")
+    parser.add_argument("-m", "--move", action="store_true", help="Remove source files after copying")
+    parser.add_argument("-t", "--threads", type=int, default=COPY_THREADS, help="Number of copy threads")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
+    print sync_tree(args.src_dir, args.dest_dir, args.flat, args.move, args.threads)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Author:   Micha Silver
+Version:  0.1
+Description:
+  Compact binary copy of the aggregated basin mask (basins.txt) written by create_netcdf.py.
+  basins.txt, read by the model, has one value per line and no shape,
+  the binary file holds the same grid as raw int32 after a small header:
+    8 bytes   magic "WRFHBAS1"
+    int32     number of rows
+    int32     number of columns
+    int32     orientation: 0 = first row is the southernmost (as in basins.txt and the NetCDF)
+                           1 = first row is the northernmost
+    int32     NoData value
+    8 bytes   reserved
+  All values little endian. The grid can be memory mapped (read_basins_bin),
+  for random access to single cells without reading the file.
+
+  From the command line, print the grid size and the number of cells in each basin,
+  or the basin at a row/column:
+    basins_bin.py <basins file> [-r row -c col]
+"""
+
+import os, struct, argparse
+import numpy as np
+
+magic = "WRFHBAS1"
+header_fmt = "<8s4i8x"
+header_size = struct.calcsize(header_fmt)
+SOUTH_FIRST = 0
+NORTH_FIRST = 1
+
+
+def write_basins_bin(basins, filename, orientation=SOUTH_FIRST, nodata=-9999):
+    """
+    Write a 2D grid of basin ids to filename (under a temporary name, renamed when complete)
+    Masked cells are written as nodata
+    """
+    data = np.ma.filled(basins, nodata).astype('<i4')
+    tmp = "%s.%s.tmp" % (filename, os.getpid())
+    f = open(tmp, 'wb')
+    try:
+        f.write(struct.pack(header_fmt, magic, data.shape[0], data.shape[1], orientation, nodata))
+        data.tofile(f)
+    finally:
+        f.close()
+    os.rename(tmp, filename)
+
+
+def read_basins_header(filename):
+    """
+    Returns a dict of the header values: nrows, ncols, orientation, nodata
+    """
+    f = open(filename, 'rb')
+    try:
+        head = f.read(header_size)
+    finally:
+        f.close()
+    if len(head) < header_size:
+        raise ValueError("%s: file too short" % filename)
+    m, nrows, ncols, orientation, nodata = struct.unpack(header_fmt, head)
+    if m != magic:
+        raise ValueError("%s: not a binary basins file" % filename)
+    return {'nrows': nrows, 'ncols': ncols, 'orientation': orientation, 'nodata': nodata}
+
+
+def read_basins_bin(filename, north_first=False):
+    """
+    Memory map the basin grid (read only): returns the array and the header dict
+    With north_first=True the returned array is flipped if needed so its first row is the northernmost
+    (a flipped view, still memory mapped)
+    """
+    head = read_basins_header(filename)
+    arr = np.memmap(filename, dtype='<i4', mode='r', offset=header_size,
+                    shape=(head['nrows'], head['ncols']))
+    if north_first and head['orientation'] == SOUTH_FIRST:
+        arr = arr[::-1]
+    elif not north_first and head['orientation'] == NORTH_FIRST:
+        arr = arr[::-1]
+    return arr, head
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Read a binary basins file")
+    parser.add_argument("basins_file", help="Binary basins file")
+    parser.add_argument("-r", "--row", type=int, help="Row (0 = southernmost)")
+    parser.add_argument("-c", "--col", type=int, help="Column")
+    args = parser.parse_args()
+
+    arr, head = read_basins_bin(args.basins_file)
+    print "Grid: %s rows x %s columns" % (head['nrows'], head['ncols'])
+    if args.row is not None and args.col is not None:
+        print "Basin at row %s, column %s: %s" % (args.row, args.col, arr[args.row, args.col])
+    else:
+        ids, counts = np.unique(arr, return_counts=True)
+        print "Basin\tCells"
+        for i, c in zip(ids, counts):
+            print "%s\t%s" % (i, c)
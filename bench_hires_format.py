@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+Author:   Micha Silver
+Version:  0.1
+Description:
+  Benchmark of the gis_hires output formats of create_netcdf.py:
+  NETCDF3_64BIT (uncompressed) against NETCDF4 (row-band chunks, zlib and shuffle).
+  A synthetic hires grid is written with the same variables as create_netcdf.py,
+  mostly NoData outside a few basins, and for each format the file size,
+  the write time, and the read time are reported. Reads are timed both for whole
+  variables (as verify_hires.py and change_nc.py read them) and for bands of rows.
+
+  Command line:
+    bench_hires_format.py [-r rows] [-c cols] [-d fraction of data cells] [-o output dir]
+"""
+
+import os, time, argparse, tempfile, shutil
+import numpy as np
+from netCDF4 import Dataset
+from create_netcdf import hires_vars, create_grid_variable
+
+formats = ['NETCDF3_64BIT', 'NETCDF4']
+band_rows = 512
+
+
+def synthetic_layers(nrows, ncols, data_fraction, seed=0):
+    """
+    Make arrays for each variable: NoData (fill) everywhere except in a few basins,
+    which together cover about data_fraction of the grid
+    """
+    rng = np.random.RandomState(seed)
+    yy, xx = np.mgrid[0:nrows, 0:ncols]
+    in_basin = np.zeros((nrows, ncols), dtype=bool)
+    nbasins = 5
+    radius = np.sqrt(data_fraction * nrows * ncols / (nbasins * np.pi))
+    for b in range(nbasins):
+        cy, cx = rng.randint(0, nrows), rng.randint(0, ncols)
+        in_basin |= (yy - cy) ** 2 + (xx - cx) ** 2 < radius ** 2
+    del yy, xx
+
+    layers = {}
+    for name, dtype, fill in hires_vars:
+        if name == 'LATITUDE':
+            arr = np.repeat(np.linspace(29.0, 33.0, nrows, dtype='f4')[:, None], ncols, axis=1)
+        elif name == 'LONGITUDE':
+            arr = np.repeat(np.linspace(33.0, 36.0, ncols, dtype='f4')[None, :], nrows, axis=0)
+        elif name in ('OVROUGHRTFAC', 'RETDEPRTFAC'):
+            arr = np.ones((nrows, ncols), dtype=dtype)
+        else:
+            arr = np.empty((nrows, ncols), dtype=dtype)
+            arr.fill(fill)
+            if name == 'TOPOGRAPHY':
+                vals = rng.normal(400.0, 150.0, in_basin.sum())
+            elif name == 'FLOWDIRECTION':
+                vals = 2 ** rng.randint(0, 8, in_basin.sum())
+            elif name == 'basn_mask':
+                vals = rng.randint(1, 6, in_basin.sum())
+            else:
+                vals = rng.randint(0, 6, in_basin.sum())
+            arr[in_basin] = vals
+        layers[name] = arr
+    return layers
+
+
+def write_file(filename, nc_format, layers):
+    """
+    Write the layers as create_netcdf.py does, returns the write time in seconds
+    """
+    nrows, ncols = layers['TOPOGRAPHY'].shape
+    t0 = time.time()
+    nc = Dataset(filename, 'w', format=nc_format)
+    nc.createDimension('y', nrows)
+    nc.createDimension('x', ncols)
+    nc.createVariable('x', 'f8', ('x',))[:] = np.arange(ncols) * 100.0
+    nc.createVariable('y', 'f8', ('y',))[:] = np.arange(nrows) * 100.0
+    for name, dtype, fill in hires_vars:
+        var = create_grid_variable(nc, name, dtype, fill)
+        var[:] = layers[name]
+    nc.close()
+    return time.time() - t0
+
+
+def read_whole(filename):
+    """
+    Read every variable whole, and flip it, like verify_hires.py
+    """
+    t0 = time.time()
+    nc = Dataset(filename, 'r')
+    for name, dtype, fill in hires_vars:
+        np.flipud(nc.variables[name][:])
+    nc.close()
+    return time.time() - t0
+
+
+def read_bands(filename):
+    """
+    Read every variable in bands of band_rows rows
+    """
+    t0 = time.time()
+    nc = Dataset(filename, 'r')
+    for name, dtype, fill in hires_vars:
+        var = nc.variables[name]
+        for r0 in range(0, var.shape[0], band_rows):
+            var[r0:r0 + band_rows, :]
+    nc.close()
+    return time.time() - t0
+
+
+def drop_cache(filename):
+    """
+    Ask the kernel to drop the cached pages of the file (Linux, where available),
+    so the read times include the disk I/O
+    """
+    if hasattr(os, 'posix_fadvise'):
+        fd = os.open(filename, os.O_RDONLY)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        os.close(fd)
+
+
+def run(nrows, ncols, data_fraction, out_dir):
+    layers = synthetic_layers(nrows, ncols, data_fraction)
+    results = []
+    for nc_format in formats:
+        filename = os.path.join(out_dir, "gis_hires_%s.nc" % nc_format)
+        write_t = write_file(filename, nc_format, layers)
+        drop_cache(filename)
+        whole_t = read_whole(filename)
+        band_t = read_bands(filename)
+        results.append((nc_format, os.path.getsize(filename), write_t, whole_t, band_t))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark NETCDF3 and NETCDF4 gis_hires files")
+    parser.add_argument("-r", "--rows", type=int, default=3000, help="Number of rows")
+    parser.add_argument("-c", "--cols", type=int, default=3000, help="Number of columns")
+    parser.add_argument("-d", "--data-fraction", type=float, default=0.1, help="Fraction of cells inside basins")
+    parser.add_argument("-o", "--output-dir", help="Directory for the test files (default a temp directory, removed)")
+    args = parser.parse_args()
+
+    out_dir = args.output_dir or tempfile.mkdtemp(prefix="bench_hires_")
+    try:
+        results = run(args.rows, args.cols, args.data_fraction, out_dir)
+    finally:
+        if not args.output_dir:
+            shutil.rmtree(out_dir)
+
+    print "Grid: %s x %s, %.0f%% data cells" % (args.rows, args.cols, args.data_fraction * 100)
+    print "%-15s %12s %10s %12s %12s" % ("Format", "Size (MB)", "Write (s)", "Read all (s)", "Read rows (s)")
+    for nc_format, size, write_t, whole_t, band_t in results:
+        print "%-15s %12.1f %10.2f %12.2f %12.2f" % (nc_format, size / 1048576.0, write_t, whole_t, band_t)
@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+"""
+Author:   Micha Silver
+Version:  0.1
+Description:
+  Benchmarks of the hot paths of the scripts in this repository, on synthetic
+  WRF-Hydro shaped inputs at several scales (small, medium, large):
+    AAIGrid layers and a geo_em file     -> create_netcdf.py (full build, NETCDF4 build, update)
+    gis_hires NetCDF                      -> change_nc.py, verify_hires.py
+    wrfout_d03_* files (XLAT, XLONG, RAINNC) -> netcdf2text.py
+    fixed width frxst_pts_out.txt         -> hydrographs.py parse_frxst and create_graph,
+                                             a run with no new data (startup time), and the ensemble envelope
+  The fixtures are generated once per scale in the work directory and reused.
+  Each case runs in its own process, so the peak RSS reported is that of the case alone.
+  Results (times of each repeat, peak RSS) are saved as JSON, and a scaling table is printed.
+  A previous results file can be given to compare the runs.
+
+  Command line:
+    bench_suite.py [-s small,medium] [-c case,...] [-n repeats] [-w work dir] [-o results.json] [--compare old.json]
+"""
+
+import os, sys, time, json, shutil, platform, resource, subprocess, argparse, datetime
+import numpy as np
+from netCDF4 import Dataset
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Fixture sizes: hires grid (rows, cols, multiples of agg_factor), wrfout grid,
+# number of stations and forecast hours in the frxst file, and number of wrfout files
+scales = {
+    'small':  {'hires': (300, 450), 'wrf': (100, 100), 'stations': 50, 'hours': 48, 'wrfout_files': 2},
+    'medium': {'hires': (1200, 1500), 'wrf': (300, 300), 'stations': 200, 'hours': 72, 'wrfout_files': 3},
+    'large':  {'hires': (3000, 3600), 'wrf': (600, 600), 'stations': 1000, 'hours': 120, 'wrfout_files': 4},
+}
+scale_order = ['small', 'medium', 'large']
+agg_factor = 30
+# Number of hydrographs drawn in the create_graph case
+graph_count = 20
+# Number of members in the ensemble envelope case
+ensemble_members = 10
+
+
+def write_asc(filename, arr, cellsize=100, xll=200000.0, yll=500000.0):
+    """
+    Write an AAIGrid (first row is the northernmost)
+    """
+    f = open(filename, 'w')
+    f.write("ncols %d\nnrows %d\nxllcorner %s\nyllcorner %s\ncellsize %d\nNODATA_value -9999\n"
+            % (arr.shape[1], arr.shape[0], xll, yll, cellsize))
+    np.savetxt(f, arr, fmt='%d')
+    f.close()
+
+
+def make_geo_em(filename):
+    geo = Dataset(filename, 'w', format='NETCDF3_CLASSIC')
+    for k, v in (('MAP_PROJ', 1), ('STAND_LON', 35.0), ('TRUELAT1', 30.0), ('TRUELAT2', 33.0),
+                 ('CEN_LAT', 31.0), ('CEN_LON', 35.0)):
+        geo.setncattr(k, v)
+    geo.close()
+
+
+def make_wrfout(filename, nrows, ncols, hour, rng):
+    nc = Dataset(filename, 'w', format='NETCDF3_64BIT')
+    nc.createDimension('Time', None)
+    nc.createDimension('south_north', nrows)
+    nc.createDimension('west_east', ncols)
+    lat = np.repeat(np.linspace(29.0, 33.0, nrows, dtype='f4')[:, None], ncols, axis=1)
+    lon = np.repeat(np.linspace(33.0, 36.0, ncols, dtype='f4')[None, :], nrows, axis=0)
+    for name, vals in (('XLAT', lat), ('XLONG', lon),
+                       ('RAINNC', rng.gamma(0.3, 2.0 + hour, (nrows, ncols)).astype('f4'))):
+        var = nc.createVariable(name, 'f4', ('Time', 'south_north', 'west_east'))
+        var[0] = vals
+    nc.close()
+
+
+def make_frxst(filename, stations, hours, rng):
+    """
+    Fixed width frxst_pts_out.txt as read by hydrographs.parse_frxst:
+    seconds [0:8], date [9:19], time [20:28], station id [32:36], discharge [59:66]
+    """
+    init = datetime.datetime(2014, 11, 1, 0)
+    f = open(filename, 'w')
+    for h in range(1, hours + 1):
+        t = init + datetime.timedelta(hours=h)
+        for s in range(stations):
+            q = max(0.0, rng.gamma(0.5, 5.0) * np.sin(np.pi * h / hours))
+            f.write("%8d %s %s    %4d %9.4f %9.4f %2s%7.3f\n" % (h * 3600, t.strftime("%Y-%m-%d"),
+                    t.strftime("%H:%M:%S"), s + 1, 34.5, 31.2, "", q))
+    f.close()
+
+
+def make_fixtures(scale, work_dir):
+    """
+    Generate (once) the synthetic inputs of one scale in work_dir/<scale>
+    Returns the fixture directory
+    """
+    import bench_hires_format
+    spec = scales[scale]
+    fx = os.path.join(work_dir, scale)
+    done_flag = os.path.join(fx, ".complete")
+    if os.path.isfile(done_flag):
+        return fx
+    if os.path.isdir(fx):
+        shutil.rmtree(fx)
+    os.makedirs(os.path.join(fx, "ascii"))
+    os.makedirs(os.path.join(fx, "wrfout"))
+    os.makedirs(os.path.join(fx, "frxst", "2014110100"))
+    print "Generating %s fixtures in %s ..." % (scale, fx)
+
+    rng = np.random.RandomState(1)
+    nrows, ncols = spec['hires']
+    layers = bench_hires_format.synthetic_layers(nrows, ncols, 0.1)
+    for name, asc in (('TOPOGRAPHY', 'topography.asc'), ('FLOWDIRECTION', 'flowdir.asc'),
+                      ('CHANNELGRID', 'channelgrid.asc'), ('STREAMORDER', 'streamorder.asc'),
+                      ('basn_mask', 'basins.asc'), ('frxst_pts', 'frxstpts.asc')):
+        # AAIGrid rows run north to south
+        write_asc(os.path.join(fx, "ascii", asc), np.flipud(layers[name]))
+    make_geo_em(os.path.join(fx, "geo_em.d03.nc"))
+    bench_hires_format.write_file(os.path.join(fx, "gis_hires.nc"), 'NETCDF3_64BIT', layers)
+    del layers
+
+    init = datetime.datetime(2014, 11, 1, 0)
+    for h in range(spec['wrfout_files']):
+        t = init + datetime.timedelta(hours=h)
+        make_wrfout(os.path.join(fx, "wrfout", "wrfout_d03_" + t.strftime("%Y-%m-%d_%H:%M:%S")),
+                    spec['wrf'][0], spec['wrf'][1], h, rng)
+    make_frxst(os.path.join(fx, "frxst", "2014110100", "frxst_pts_out.txt"), spec['stations'], spec['hours'], rng)
+    open(done_flag, 'w').close()
+    return fx
+
+
+def domain(fx, out_dir, nc_format='NETCDF3_64BIT'):
+    """
+    A create_netcdf.py domain dict for the fixtures
+    """
+    return {'name': 'bench', 'asc_dir': os.path.join(fx, "ascii"), 'gtiff_dir': '', 'geofile': os.path.join(fx, "geo_em.d03.nc"),
+            'hires_filename': os.path.join(out_dir, "gis_hires_out.nc"), 'basins_txt': os.path.join(out_dir, "basins.txt"),
+            'basins_bin': '', 'agg_factor': agg_factor, 'block_rows': 512, 'nc_format': nc_format,
+            'chunk_bytes': 1048576, 'complevel': 4}
+
+
+def timed(fn, *args):
+    t0 = time.time()
+    fn(*args)
+    return time.time() - t0
+
+
+def run_script(args):
+    """
+    Run a script in a child process (output discarded), returns the elapsed time
+    """
+    devnull = open(os.devnull, 'w')
+    t0 = time.time()
+    try:
+        subprocess.check_call([sys.executable] + args, stdout=devnull, stderr=devnull)
+    finally:
+        devnull.close()
+    return time.time() - t0
+
+
+def quiet(fn, *args):
+    """
+    Call fn with stdout discarded (the scripts print progress messages)
+    """
+    saved = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return fn(*args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = saved
+
+
+def case_create_netcdf(fx, out_dir):
+    import create_netcdf
+    return quiet(timed, create_netcdf.build_hires, domain(fx, out_dir))
+
+
+def case_create_netcdf4(fx, out_dir):
+    import create_netcdf
+    return quiet(timed, create_netcdf.build_hires, domain(fx, out_dir, 'NETCDF4'))
+
+
+def case_create_netcdf_update(fx, out_dir):
+    """
+    Update after an edit of the forecast points layer only
+    """
+    import create_netcdf
+    asc_dir = os.path.join(out_dir, "ascii")
+    shutil.copytree(os.path.join(fx, "ascii"), asc_dir)
+    dom = domain(fx, out_dir)
+    dom['asc_dir'] = asc_dir
+    quiet(create_netcdf.build_hires, dom)
+    f = open(os.path.join(asc_dir, "frxstpts.asc"), 'a')
+    f.write("\n")
+    f.close()
+    return quiet(timed, create_netcdf.update_hires, dom)
+
+
+def case_change_nc(fx, out_dir):
+    import change_nc
+    return quiet(timed, change_nc.change_values, os.path.join(fx, "gis_hires.nc"),
+                 os.path.join(out_dir, "gis_hires_changed.nc"), '2', 'basn_mask', '7', 'STREAMORDER')
+
+
+def case_verify_hires(fx, out_dir):
+    return run_script([os.path.join(script_dir, "verify_hires.py"), "-i", os.path.join(fx, "gis_hires.nc"),
+                       "-o", os.path.join(out_dir, "drain_pts.txt")])
+
+
+def case_netcdf2text(fx, out_dir):
+    return run_script([os.path.join(script_dir, "netcdf2text.py"), "-i", os.path.join(fx, "wrfout"), "-o", out_dir])
+
+
+def case_hydrographs_parse(fx, out_dir):
+    import hydrographs
+    return timed(hydrographs.parse_frxst, "2014110100", os.path.join(fx, "frxst"), "frxst_pts_out.txt")
+
+
+def case_hydrographs_graph(fx, out_dir):
+    import hydrographs
+    plt = hydrographs.pyplot()
+    import matplotlib.dates as md
+    rows = hydrographs.parse_frxst("2014110100", os.path.join(fx, "frxst"), "frxst_pts_out.txt")
+    by_id = {}
+    for r in rows:
+        by_id.setdefault(r[3], []).append(r)
+    t0 = time.time()
+    for sid in sorted(by_id)[:graph_count]:
+        disch = [r[4] for r in by_id[sid]]
+        times = [md.datestr2num(r[5]) for r in by_id[sid]]
+        hydrographs.create_graph("2", sid, disch, times, by_id[sid][0][5], out_dir, "hydrograph_")
+        plt.close('all')
+    return time.time() - t0
+
+
+def case_hydrographs_noop(fx, out_dir):
+    """
+    A cron run of hydrographs.py that finds no new data (startup cost only)
+    """
+    ts_file = os.path.join(out_dir, "last_timestamp")
+    f = open(ts_file, 'w')
+    f.write("%d" % (time.time() + 86400))
+    f.close()
+    f = open(os.path.join(out_dir, "hydrographs.conf"), 'w')
+    f.write("[General]\nmin_hr = 0\nmax_hr = 120\nhr_col = 0\ndisch_col = 4\ndt_str_col = 5\n"
+            "data_path = %s\nrain_path = %s\nimg_path = %s\ntimestamp_file = %s\n"
+            "disch_data_file = frxst_pts_out.txt\nprecip_data_file = precip.tar.gz\nlogfile = %s\n"
+            "[Graphs]\nout_data_path = %s\nout_pref = hydrograph_\nout_precip_path = %s\n"
+            "[Db]\nhost = localhost\ndbname = wrfhydro\nuser = wrfhydro\npassword = wrfhydro\n"
+            "[Web]\nweb_archive = %s\n"
+            % (os.path.join(fx, "frxst"), out_dir, out_dir, ts_file, os.path.join(out_dir, "hydrographs.log"),
+               out_dir, out_dir, out_dir))
+    f.close()
+    return run_script([os.path.join(script_dir, "hydrographs.py"), out_dir])
+
+
+def case_hydrographs_envelope(fx, out_dir):
+    """
+    Ensemble envelope (min, median, max) of ensemble_members perturbed copies of the frxst series
+    """
+    import hydrographs
+    rows = hydrographs.parse_frxst("2014110100", os.path.join(fx, "frxst"), "frxst_pts_out.txt")
+    by_id = {}
+    for r in rows:
+        by_id.setdefault(r[3], ([], []))
+        by_id[r[3]][0].append(r[0] / 3600.0)
+        by_id[r[3]][1].append(r[4])
+    rng = np.random.RandomState(2)
+    members = []
+    for m in range(ensemble_members):
+        members.append(dict((i, (i, t, np.array(q) * rng.uniform(0.5, 1.5), "2014-11-01 00:00:00"))
+                            for i, (t, q) in by_id.iteritems()))
+    return timed(hydrographs.ensemble_envelope, members)
+
+
+cases = [('create_netcdf', case_create_netcdf), ('create_netcdf4', case_create_netcdf4),
+         ('create_netcdf_update', case_create_netcdf_update), ('change_nc', case_change_nc),
+         ('verify_hires', case_verify_hires), ('netcdf2text', case_netcdf2text),
+         ('hydrographs_noop', case_hydrographs_noop), ('hydrographs_parse', case_hydrographs_parse),
+         ('hydrographs_graph', case_hydrographs_graph), ('hydrographs_envelope', case_hydrographs_envelope)]
+
+
+def run_case_here(case, scale, work_dir):
+    """
+    Run one case in this process (called in the child process)
+    Returns a dict of seconds and peak RSS (MB, of this process and of its children)
+    or of the reason the case was skipped
+    """
+    fx = make_fixtures(scale, work_dir)
+    out_dir = os.path.join(work_dir, "out_%s_%s_%s" % (scale, case, os.getpid()))
+    os.makedirs(out_dir)
+    sys.path.insert(0, script_dir)
+    try:
+        try:
+            seconds = dict(cases)[case](fx, out_dir)
+        except ImportError as e:
+            return {'skipped': "missing module: %s" % e}
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    # ru_maxrss is in KB on Linux
+    return {'seconds': seconds,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+            'children_peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0}
+
+
+def run_case(case, scale, work_dir):
+    """
+    Run one case in a new process, and return its result dict
+    A case that fails returns {'failed': last line of its error output}
+    """
+    p = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--run-case", case,
+                          "-s", scale, "-w", work_dir], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    lines = out.strip().splitlines()
+    if p.returncode != 0 or not lines:
+        err_lines = err.strip().splitlines()
+        return {'failed': err_lines[-1] if err_lines else "exit status %s" % p.returncode}
+    return json.loads(lines[-1])
+
+
+def run_suite(scale_list, case_list, repeats, work_dir):
+    results = []
+    for scale in scale_list:
+        # Generate the fixtures before timing anything
+        make_fixtures(scale, work_dir)
+        for case in case_list:
+            runs = [run_case(case, scale, work_dir) for r in range(repeats)]
+            if 'skipped' in runs[0]:
+                print "%-22s %-7s skipped (%s)" % (case, scale, runs[0]['skipped'])
+                results.append({'case': case, 'scale': scale, 'skipped': runs[0]['skipped']})
+                continue
+            failed = [r['failed'] for r in runs if 'failed' in r]
+            if failed:
+                print "%-22s %-7s FAILED (%s)" % (case, scale, failed[0])
+                results.append({'case': case, 'scale': scale, 'failed': failed[0]})
+                continue
+            secs = [r['seconds'] for r in runs]
+            rss = max(max(r['peak_rss_mb'], r['children_peak_rss_mb']) for r in runs)
+            print "%-22s %-7s median %8.3f s  min %8.3f s  peak RSS %7.1f MB" % (case, scale, np.median(secs), min(secs), rss)
+            results.append({'case': case, 'scale': scale, 'seconds': secs,
+                            'median_seconds': float(np.median(secs)), 'peak_rss_mb': rss})
+    return results
+
+
+def scaling_report(results, scale_list):
+    """
+    Print the median time of each case at each scale
+    """
+    table = {}
+    for r in results:
+        table.setdefault(r['case'], {})[r['scale']] = r.get('median_seconds')
+    print
+    print "%-22s" % "Case" + "".join("%12s" % s for s in scale_list)
+    for case in [c for c, fn in cases if c in table]:
+        cells = []
+        for s in scale_list:
+            v = table[case].get(s)
+            cells.append("%12s" % ("-" if v is None else "%.3f" % v))
+        print "%-22s" % case + "".join(cells)
+
+
+def compare(results, old_file):
+    """
+    Print the speedup of each case against a previous results file
+    """
+    old = json.load(open(old_file))
+    old_times = dict(((r['case'], r['scale']), r.get('median_seconds')) for r in old['results'])
+    print
+    print "Compared with %s (%s)" % (old_file, old.get('timestamp'))
+    print "%-22s %-7s %10s %10s %8s" % ("Case", "Scale", "Before", "After", "Speedup")
+    for r in results:
+        before = old_times.get((r['case'], r['scale']))
+        after = r.get('median_seconds')
+        if before and after:
+            print "%-22s %-7s %10.3f %10.3f %7.2fx" % (r['case'], r['scale'], before, after, before / after)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the WRF-Hydro scripts on synthetic inputs")
+    parser.add_argument("-s", "--scales", default="small,medium", help="Comma separated scales: small, medium, large")
+    parser.add_argument("-c", "--cases", help="Comma separated cases (default all): " + ", ".join(c for c, fn in cases))
+    parser.add_argument("-n", "--repeats", type=int, default=3, help="Runs of each case")
+    parser.add_argument("-w", "--work-dir", default=os.path.join(script_dir, "bench_data"), help="Directory for fixtures and outputs")
+    parser.add_argument("-o", "--output", help="JSON results file (default bench_results_<timestamp>.json in the work dir)")
+    parser.add_argument("--compare", help="Previous JSON results file to compare with")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        # Child process: one case, result as JSON on the last line
+        print json.dumps(run_case_here(args.run_case, args.scales, args.work_dir))
+        sys.exit(0)
+
+    scale_list = [s for s in scale_order if s in args.scales.split(',')]
+    case_list = args.cases.split(',') if args.cases else [c for c, fn in cases]
+    unknown = [c for c in case_list if c not in dict(cases)]
+    if unknown:
+        parser.error("Unknown cases: " + ", ".join(unknown))
+    if not os.path.isdir(args.work_dir):
+        os.makedirs(args.work_dir)
+
+    results = run_suite(scale_list, case_list, args.repeats, args.work_dir)
+    scaling_report(results, scale_list)
+
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    out_file = args.output or os.path.join(args.work_dir, "bench_results_%s.json" % timestamp)
+    report = {'timestamp': timestamp, 'host': platform.node(), 'python': platform.python_version(),
+              'numpy': np.__version__, 'repeats': args.repeats, 'scales': dict((s, scales[s]) for s in scale_list),
+              'results': results}
+    f = open(out_file, 'w')
+    json.dump(report, f, indent=1, sort_keys=True)
+    f.close()
+    print "\nResults saved to %s" % out_file
+    if args.compare:
+        compare(results, args.compare)
@@ -26,6 +26,7 @@ import os, getopt, sys, csv
 import shutil
 import numpy as np
 from netCDF4 import Dataset
+import nc3mmap
 
 
 def print_syntax(m):
@@ -110,6 +111,8 @@ def change_values(in_file, out_file, mask_id, mask_var, new_val, change_var):
     Replace values in output nc file 'o' in variable 'ch_var', 
     where the variable 'mask' in input nc 'i' matches values in the dictionary 'dict'
     Take new values from 'dict' for each matching mask value
+    Classic (NETCDF3) files are memory mapped with nc3mmap, and the change is written
+    in place, so only the pages of the cells changed are written back
     """
 
     try:
@@ -131,27 +134,31 @@ def change_values(in_file, out_file, mask_id, mask_var, new_val, change_var):
     out_var = out_nc.variables[change_var]
     if in_var.dimensions == out_var.dimensions and in_var.shape == out_var.shape:
         # nc files OK, good to go
-        # Get shape and number of dimensions
-        shp = in_var.shape
-        dims = len(shp)
-        # create numpy arrays from the variables in each nc file
-        # Note: must be indexed: [:]. Otherwise array will hold the object, not values
-        in_arr  = np.array(in_var[:])
-        out_arr = np.array(out_var[:])
-        
-        # Loop thru input array with ndenumerate function. 
-        for idx, val in np.ndenumerate(in_arr):
-            #Check each index if it matches a mask value
-            #for m,v in dict.iteritems():
-            if (int(float(val)) == int(float(mask_id))):
-            # If there is a match, set the output array at this index 
-            # to the new value from the mask dictionary
-                out_arr[idx] = new_val
-
-        # Now push numpy array back to netcdf variable
-        out_var[:] = out_arr[:]
-        in_nc.close()
-        out_nc.close()
+        if nc3mmap.is_classic(in_file) and nc3mmap.is_classic(out_file):
+            # Close the datasets, and map the variables straight from the files
+            in_nc.close()
+            out_nc.close()
+            in_arr  = nc3mmap.variable(in_file, mask_var)
+            out_arr = nc3mmap.variable(out_file, change_var, mode='r+')
+        else:
+            # create numpy arrays from the variables in each nc file
+            # Note: must be indexed: [:]. Otherwise array will hold the object, not values
+            in_arr  = np.array(in_var[:])
+            out_arr = np.array(out_var[:])
+
+        # Check all cells at once for a match with the mask value (as integers),
+        # and set the output array at those cells to the new value
+        match = np.trunc(in_arr) == int(float(mask_id))
+        out_arr[match] = np.array(new_val).astype(out_arr.dtype)
+        print "Changed %s cells" % np.count_nonzero(match)
+
+        if isinstance(out_arr.base, np.memmap):
+            out_arr.base.flush()
+        else:
+            # Now push numpy array back to netcdf variable
+            out_var[:] = out_arr[:]
+            in_nc.close()
+            out_nc.close()
         return True
 
     else:
@@ -38,35 +38,123 @@
 # THis is now changed - the "y_coordinate*(-1)" was removed 
 # and the np function flipud was re-activated
 # in both the read_int_values() and read_float_values() functions
+
+# Input layers can now be GeoTIFF (or any GDAL raster), as exported by prepare_hires_hydro.sh:
+# set gtiff_dir below. They are read block-wise in their native types, without the AAIGrid text
+
+# Optional NETCDF4 (HDF5) output: set nc_format below. Each 2D variable is chunked in bands
+# of whole rows, and compressed with zlib and shuffle. Mostly NoData files shrink many times.
+# The model must be built with a NetCDF library that has NetCDF4/HDF5 support to read it
+
+# The build is now a function, build_hires(), of a domain's options,
+# read from a config file (create_netcdf.conf) with one section per domain.
+# Several domains can be built at once in a pool of processes:
+#   create_netcdf.py -c create_netcdf.conf [-d domain ...] [-p processes]
+
+# Update mode (-u): the checksum of each input layer, and a key of the grid header and projection,
+# are stored as global attributes of the hires file. An update re-writes only the variables
+# whose input changed, and the coordinates only if the grid changed
 """
 
+import os, sys, time, hashlib, argparse, traceback, subprocess
+import ConfigParser
+from multiprocessing import Pool, cpu_count
+from distutils.spawn import find_executable
 import numpy as np
 from netCDF4 import Dataset
 from pyproj import Proj
+import basins_bin
+
+
+# Default options of a domain (see create_netcdf.conf)
+domain_defaults = {
+    # Aggregation Factor
+    'agg_factor': '30',
+    # Input layers: the AAIGrids in asc_dir, or if set, the GeoTIFF layers in gtiff_dir (one of them is required)
+    'asc_dir': '',
+    'gtiff_dir': '',
+    # Number of raster rows read from GDAL at a time
+    'block_rows': '512',
+    # If set, also write the aggregated basins to this compact binary file (see basins_bin.py)
+    'basins_bin': '',
+    # Output format: 'NETCDF3_64BIT' (uncompressed), or 'NETCDF4' (chunked and compressed)
+    'nc_format': 'NETCDF3_64BIT',
+    # NETCDF4 only: approximate size of one chunk (a band of rows) in bytes, and the zlib level
+    'chunk_bytes': '1048576',
+    'complevel': '4',
+    # ncdump of the NetCDF installation the model is built with, and the formats (as ncdump -k
+    # names them) its library reads: the new file is checked with it (see check_hires_file)
+    'ncdump': 'ncdump',
+    'model_formats': 'classic, 64-bit offset, netCDF-4',
+}
+int_options = ('agg_factor', 'block_rows', 'chunk_bytes', 'complevel')
+required_options = ('geofile', 'hires_filename', 'basins_txt')
+
+# The 2D variables of the hires file: name, type, fill value
+hires_vars = [('TOPOGRAPHY', 'f4', -9999.0), ('LATITUDE', 'f4', -9999.0), ('LONGITUDE', 'f4', -9999.0),
+              ('CHANNELGRID', 'i2', -9999), ('STREAMORDER', 'i2', -9999), ('LAKEGRID', 'i2', -9999),
+              ('OVROUGHRTFAC', 'f4', 1), ('RETDEPRTFAC', 'f4', 1), ('basn_mask', 'i2', -9999),
+              ('frxst_pts', 'i2', -9999), ('FLOWDIRECTION', 'i2', -9999)]
+# The variables read from input layers: name, AAIGrid file, GeoTIFF file
+hires_layers = [('TOPOGRAPHY', 'topography.asc', 'TOPOGRAPHY.tif'),
+                ('FLOWDIRECTION', 'flowdir.asc', 'FLOWDIRECTION.tif'),
+                ('CHANNELGRID', 'channelgrid.asc', 'CHANNELGRID.tif'),
+                ('STREAMORDER', 'streamorder.asc', 'STREAMORDER.tif'),
+                ('basn_mask', 'basins.asc', 'basn_mask.tif'),
+                ('frxst_pts', 'frxstpts.asc', 'frxst_pts.tif'),
+                ('LAKEGRID', 'lakes.asc', 'LAKEGRID.tif')]
+
+
+def get_gdal_header(filename):
+    """
+    Read the same header values as in an AAIGrid from any GDAL raster
+    """
+    from osgeo import gdal
+    ds = gdal.Open(filename)
+    gt = ds.GetGeoTransform()
+    data = {'ncols': ds.RasterXSize, 'nrows': ds.RasterYSize,
+            'xllcorner': gt[0], 'yllcorner': gt[3] + gt[5] * ds.RasterYSize,
+            'cellsize': gt[1], 'NODATA_value': ds.GetRasterBand(1).GetNoDataValue()}
+    ds = None
+    return data
 
 
-# Aggregation Factor
-agg_factor = 30
-
-# Input
-asc_dir = '/home/micha/work/IHS/gis_hires/ascii/'
-geofile = '/home/micha/work/IHS/gis_hires/NetCDF/geo_em.d03.nc'
+def get_proj(geofile):
+    """
+    The Lambert Conformal Conic projection of the WRF domain, from the geo_em file attributes
+    """
+    geo = Dataset(geofile, 'r')
+    stdlon  = geo.getncattr('STAND_LON')
+    stdlat1 = geo.getncattr('TRUELAT1')
+    stdlat2 = geo.getncattr('TRUELAT2')
+    cenlat  = geo.getncattr('CEN_LAT')
+    geo.close()
+    return Proj(proj='lcc', lon_0=stdlon, lat_0=cenlat, lat_1=stdlat1, lat_2=stdlat2)
+
+
+def read_grid_header(filename):
+    """
+    The AAIGrid header values (ncols, nrows, xllcorner, yllcorner, cellsize, NODATA_value)
+    of an AAIGrid, or of any GDAL raster
+    """
+    if not filename.endswith('.asc'):
+        data = get_gdal_header(filename)
+    else:
+        with open(filename, 'r') as f:
+            data = {'ncols':'', 'nrows':'', 'xllcorner':'', 'yllcorner':'', 'cellsize':'', 'NODATA_value':''}
+            for i in range(6):
+                kk = f.readline()
+                var,val = kk.split()
+                if var == 'ncols' or var == 'nrows':
+                    data[var] = int(val)
+                else:
+                    data[var] = float(val.replace(',','.'))
+    return data
 
-# Output
-hires_filename = '/home/micha/work/IHS/gis_hires/NetCDF/gis_hires_micha.nc'
-basins_txt     = '/home/micha/work/IHS/gis_hires/NetCDF/basins.txt'
 
-def get_hires_dims(filename):
+def get_hires_dims(filename, p):
 
-    with open(filename, 'r') as f:
-        data = {'ncols':'', 'nrows':'', 'xllcorner':'', 'yllcorner':'', 'cellsize':'', 'NODATA_value':''}
-        for i in range(6):
-            kk = f.readline()
-            var,val = kk.split()
-            if var == 'ncols' or var == 'nrows':
-                data[var] = int(val)
-            else:
-                data[var] = float(val.replace(',','.'))
+    data = read_grid_header(filename)
     # Compute coordinates
     x_coordinates = np.arange(
         data["xllcorner"] + (data["cellsize"] / 2.0),
@@ -152,12 +240,165 @@ def read_asc_float_values(filename):
     return kk
 
 
-def agg_basins(hires):
+def var_values(ncvar, kk, nodata=None, min_value=None):
+    """
+    Prepare raster values for a NetCDF variable: cells of the raster NoData value get the
+    fill value of the variable, values below min_value (if given) are set to min_value
+    Values of an integer variable must fit its type (i.e. stream reach ids in an i2 variable):
+    raises ValueError otherwise, rather than let them wrap around
+    """
+    fill_value = getattr(ncvar, '_FillValue', None)
+    if nodata is not None and fill_value is not None:
+        if np.isnan(nodata):
+            kk = np.where(np.isnan(kk), fill_value, kk)
+        else:
+            kk = np.where(kk == nodata, fill_value, kk)
+    if min_value is not None:
+        kk = np.where(kk < min_value, min_value, kk)
+    if np.issubdtype(ncvar.dtype, np.integer) and kk.size > 0:
+        info = np.iinfo(ncvar.dtype)
+        if kk.min() < info.min or kk.max() > info.max:
+            raise ValueError("%s: values %s to %s are out of the range of its type (%s)"
+                             % (ncvar.name, kk.min(), kk.max(), ncvar.dtype))
+    return kk
+
+
+def read_gdal_values(filename, ncvar):
+    """
+    Read a whole GDAL raster, flipped (south to north) like read_asc_int_values,
+    with the values prepared for ncvar (see var_values)
+    """
+    from osgeo import gdal
+    ds = gdal.Open(filename)
+    band = ds.GetRasterBand(1)
+    kk = var_values(ncvar, np.flipud(band.ReadAsArray()), band.GetNoDataValue())
+    ds = None
+    return kk
+
+
+def write_gdal_values(filename, ncvar, min_value=None, block_rows=512):
+    """
+    Copy a GDAL raster into a NetCDF variable in bands of block_rows rows,
+    in the native type of the raster. The raster rows run north to south,
+    the NetCDF rows south to north, so each band is flipped into place.
+    NoData cells get the fill value of the variable (see var_values)
+    """
+    from osgeo import gdal
+    ds = gdal.Open(filename)
+    band = ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    nrows, ncols = ds.RasterYSize, ds.RasterXSize
+    for r0 in range(0, nrows, block_rows):
+        n = min(block_rows, nrows - r0)
+        kk = var_values(ncvar, band.ReadAsArray(0, r0, ncols, n), nodata, min_value)
+        ncvar[nrows-r0-n:nrows-r0, :] = kk[::-1]
+    ds = None
+
+
+def fill_variable(ncfile, dom, varname, asc_name, tif_name, min_value=None):
+    """
+    Fill one NetCDF variable from the GeoTIFF in the domain's gtiff_dir if set,
+    otherwise from the AAIGrid in asc_dir
+    """
+    if dom['gtiff_dir']:
+        write_gdal_values(os.path.join(dom['gtiff_dir'], tif_name), ncfile.variables[varname],
+                          min_value, dom['block_rows'])
+        return
+    kk = read_asc_int_values(os.path.join(dom['asc_dir'], asc_name))
+    kk = var_values(ncfile.variables[varname], kk, min_value=min_value)
+    ncfile.variables[varname][:] = kk[:]
+    del kk
+
+
+def create_grid_variable(ncfile, varname, datatype, fill_value, chunk_bytes=1048576, complevel=4):
+    """
+    Create a 2D (y, x) variable. In NETCDF4 format it is chunked in bands of whole rows
+    (about chunk_bytes each, to match the row-band writes and the readers) and compressed
+    """
+    if ncfile.data_model != 'NETCDF4':
+        var = ncfile.createVariable(varname, datatype, ('y', 'x',), fill_value=fill_value)
+    else:
+        ny, nx = len(ncfile.dimensions['y']), len(ncfile.dimensions['x'])
+        rows = max(1, min(ny, chunk_bytes // (nx * np.dtype(datatype).itemsize)))
+        var = ncfile.createVariable(varname, datatype, ('y', 'x',), fill_value=fill_value,
+                                    zlib=True, shuffle=True, complevel=complevel, chunksizes=(rows, nx))
+    var.setncattr('coordinates', 'x y')
+    return var
+
+
+def check_ncdump_header(header, model_formats):
+    """
+    Check the header printed by "ncdump -hs" (with the storage details of the NetCDF-C library)
+    against what the model's library reads: the format must be one of model_formats,
+    and NETCDF4 variables may only use the filters built into every NetCDF-C/HDF5 library
+    (zlib and shuffle: any other _Filter needs an HDF5 plugin)
+    Returns a list of the problems found (empty if none)
+    """
+    problems = []
+    fmt = None
+    for line in header.splitlines():
+        line = line.strip().rstrip(' ;')
+        if '=' not in line or ':_' not in line:
+            continue
+        key, value = [v.strip() for v in line.split('=', 1)]
+        var, attr = key.split(':', 1)
+        value = value.strip('"')
+        if attr == '_Format':
+            fmt = value
+        elif attr == '_Filter':
+            problems.append("%s: filter %s is not built into the NetCDF library" % (var, value))
+        elif attr == '_DeflateLevel' and not 1 <= int(value) <= 9:
+            problems.append("%s: deflate level %s" % (var, value))
+    if fmt is None:
+        problems.append("no _Format in the ncdump -hs header")
+    elif fmt not in model_formats:
+        problems.append("format %s is not read by the model build (%s)" % (fmt, ", ".join(model_formats)))
+    return problems
+
+
+def check_hires_file(filename, ncdump='ncdump', model_formats=None):
+    """
+    Re-open the new hires file as the readers (verify_hires.py, change_nc.py) do,
+    and read the first and last row of every variable
+    This is the library that wrote the file: it does not show that the model can read it.
+    So the file is also read with ncdump -hs of the model's NetCDF installation (the NetCDF-C library
+    that the model's Fortran NetCDF reader calls), and its format and filters are checked
+    (check_ncdump_header). If ncdump is not installed this check is skipped, with a warning:
+    the file must then be tested with the model build
+    model_formats is a comma separated list of the formats the model's library reads
+    Raises ValueError if a check fails
+    """
+    nc = Dataset(filename, 'r')
+    print "Checking %s (format %s)" % (filename, nc.file_format)
+    for name, var in nc.variables.iteritems():
+        if len(var.shape) == 2:
+            var[0, :]
+            var[-1, :]
+        else:
+            var[:]
+    nc.close()
+
+    if not find_executable(ncdump):
+        print "WARNING: %s not found, %s not checked with the model's NetCDF library" % (ncdump, filename)
+        return False
+    try:
+        header = subprocess.check_output([ncdump, '-hs', filename], stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        raise ValueError("%s cannot read %s: %s" % (ncdump, filename, e.output.strip()))
+    if model_formats is None:
+        model_formats = domain_defaults['model_formats']
+    problems = check_ncdump_header(header, [f.strip() for f in model_formats.split(',')])
+    if problems:
+        raise ValueError("%s: %s" % (filename, "; ".join(problems)))
+    print "%s: read by %s" % (filename, ncdump)
+    return True
+
+
+def agg_basins(hires, agg_factor):
     rows,cols = hires.shape
     lores = np.ma.masked_all((rows/agg_factor,cols/agg_factor),dtype=int)
 
     for row,rowdata in enumerate(lores):
-        print row
         for column, columndata in enumerate(rowdata):
 
             hires_row_start = row * agg_factor
@@ -178,149 +419,357 @@ def agg_basins(hires):
 
     return lores
 
-geo = Dataset(geofile, 'r')
-
-mapproj = geo.getncattr('MAP_PROJ')
-stdlon  = geo.getncattr('STAND_LON')
-stdlat1 = geo.getncattr('TRUELAT1')
-stdlat2 = geo.getncattr('TRUELAT2')
-cenlat  = geo.getncattr('CEN_LAT')
-cenlon  = geo.getncattr('CEN_LON')
-
-p = Proj(proj='lcc', lon_0=stdlon, lat_0=cenlat, lat_1=stdlat1, lat_2=stdlat2)
-
-hires_specs = get_hires_dims(asc_dir + 'topography.asc')
-
-print "Creating hires file %s ..." %hires_filename
-
-ncfile = Dataset(hires_filename, 'w', format='NETCDF3_64BIT')
-
-ncfile.createDimension('y', size=hires_specs['lats'].shape[0])
-ncfile.createDimension('x', size=hires_specs['lons'].shape[1])
-
-ncfile.createVariable('x','f8',('x',),)
-ncfile.variables['x'].setncattr('units', 'Meter')
-ncfile.variables['x'][:] = hires_specs['x'][:]
-ncfile.createVariable('y','f8',('y',),)
-ncfile.variables['y'].setncattr('units', 'Meter')
-ncfile.variables['y'][:] = hires_specs['y'][:]
-
-
-ncfile.createVariable('TOPOGRAPHY','f4',('y', 'x',),fill_value=-9999.0)
-ncfile.variables['TOPOGRAPHY'].setncattr('coordinates', 'x y')
-ncfile.createVariable('LATITUDE','f4',('y', 'x',),fill_value=-9999.0)
-ncfile.variables['LATITUDE'].setncattr('coordinates', 'x y')
-ncfile.createVariable('LONGITUDE','f4',('y', 'x',),fill_value=-9999.0)
-ncfile.variables['LONGITUDE'].setncattr('coordinates', 'x y')
-ncfile.createVariable('CHANNELGRID','i2',('y', 'x',),fill_value=-9999)
-ncfile.variables['CHANNELGRID'].setncattr('coordinates', 'x y')
-ncfile.createVariable('STREAMORDER','i2',('y', 'x',),fill_value=-9999)
-ncfile.variables['STREAMORDER'].setncattr('coordinates', 'x y')
-ncfile.createVariable('LAKEGRID','i2',('y', 'x',),fill_value=-9999)
-ncfile.variables['LAKEGRID'].setncattr('coordinates', 'x y')
-ncfile.createVariable('OVROUGHRTFAC','f4',('y', 'x',),fill_value=1)
-ncfile.variables['OVROUGHRTFAC'].setncattr('coordinates', 'x y')
-ncfile.createVariable('RETDEPRTFAC','f4',('y', 'x',),fill_value=1)
-ncfile.variables['RETDEPRTFAC'].setncattr('coordinates', 'x y')
-ncfile.createVariable('basn_mask','i2',('y', 'x',),fill_value=-9999)
-ncfile.variables['basn_mask'].setncattr('coordinates', 'x y')
-ncfile.createVariable('frxst_pts','i2',('y', 'x',),fill_value=-9999)
-ncfile.variables['frxst_pts'].setncattr('coordinates', 'x y')
-ncfile.createVariable('FLOWDIRECTION','i2',('y', 'x',),fill_value=-9999)
-ncfile.variables['FLOWDIRECTION'].setncattr('coordinates', 'x y')
-
-print hires_specs['lats'].min()
-print hires_specs['lats'].max()
-print hires_specs['lats'].shape
-
-# Fill variables
-ncfile.variables['LATITUDE'][:]  = hires_specs['lats'][:]
-del hires_specs['lats']
-
-ncfile.variables['LONGITUDE'][:] = hires_specs['lons'][:]
-del hires_specs['lons']
-
-
-print "Reading topography ..."
-topography = read_asc_int_values(asc_dir + 'topography.asc')
-topography = np.where(topography < -9999, -9999, topography)
-ncfile.variables['TOPOGRAPHY'][:]    = topography[:]
-del topography
-
-print "Reading flowdirection ..."
-flowdirection = read_asc_int_values(asc_dir + 'flowdir.asc')
-ncfile.variables['FLOWDIRECTION'][:] = flowdirection[:]
-del flowdirection
-
-print "Reading channelgrid ..."
-channelgrid = read_asc_int_values(asc_dir + 'channelgrid.asc')
-# MS: What is this supposed to be??
-#channelgrid = np.where(channelgrid > 0, 0, -9999)
-ncfile.variables['CHANNELGRID'][:]   = channelgrid[:]
-del channelgrid
-
-print "Reading streamorder ..."
-streamorder = read_asc_int_values(asc_dir + 'streamorder.asc')
-ncfile.variables['STREAMORDER'][:]   = streamorder[:]
-del streamorder
-
-print "Reading basins ..."
-basins = read_asc_int_values(asc_dir + 'basins.asc')
-# MS: What is this supposed to be??
-#channelmask = np.where(basins >= 0, 1, 0)
-ncfile.variables['basn_mask'][:]   = basins[:]
-
-
-print "Reading forecast points ..."
-frxst_pts = read_asc_int_values(asc_dir + 'frxstpts.asc')
-ncfile.variables['frxst_pts'][:]     = frxst_pts[:]
-del frxst_pts
-
-try:
-    print "Reading lake grid ..."
-    lakegrid = read_asc_int_values(asc_dir + 'lakes.asc')
-except:
-    lakegrid = None
-    pass
-
-
-
-"""
-if reduce_to_basin == 1:
-    channelgrid = np.where(channelmask == 1, channelgrid, -9999)
-    streamorder = np.where(channelgrid >= 0, streamorder, -9999)
-
-"""
-
-# MS: What is this supposed to be??
-#ncfile.variables['basn_mask'][:]     = -9999
-
-if lakegrid is not None:
-    ncfile.variables['LAKEGRID'][:]  = lakegrid[:]
-
-#ncfile.variables['gw_basns'][:] = basn_mask[:]
-#print np.where(ncfile.variables['frxst_pts'][:] >= 0)
-
-ncfile.close()
-
-# groundwater basins are defined in a plain text file -->
-# --> adapt path for gwbasmskfil in noah_wrfcode.namelist
-# not on the hires grid --> wrf grid
-# do not flip, use crappy arcgis output format
-
-
-# if aggfctr > 1: basin mask needs to be aggregated to wrf grid
-
-basins     = agg_basins(basins)
-basin_file = open(basins_txt, 'w')
-
-for line in range(basins.shape[0]):
-    for j in basins[line,:]:
-        basin_file.write(str(j) + '\n')
-
-basin_file.close()
-
-
-print 'Done!'
-
-
+def layer_file(dom, asc_name, tif_name):
+    """
+    Path of an input layer of the domain: the GeoTIFF if gtiff_dir is set, otherwise the AAIGrid
+    """
+    if dom['gtiff_dir']:
+        return os.path.join(dom['gtiff_dir'], tif_name)
+    return os.path.join(dom['asc_dir'], asc_name)
+
+
+def file_md5(filename):
+    """
+    md5 checksum of a file, '' if the file does not exist
+    """
+    if not os.path.isfile(filename):
+        return ''
+    h = hashlib.md5()
+    f = open(filename, 'rb')
+    try:
+        while True:
+            buf = f.read(1024 * 1024)
+            if not buf:
+                break
+            h.update(buf)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
+def grid_key(header, p):
+    """
+    A string identifying the grid (header values) and projection:
+    the coordinates have to be computed again only if it changes
+    """
+    return "%s %s %r %r %r %s" % (header['ncols'], header['nrows'], header['xllcorner'],
+                                  header['yllcorner'], header['cellsize'], p.srs)
+
+
+def source_checksums(dom):
+    """
+    md5 checksums of the input layers of the domain: dict of variable name: md5
+    """
+    return dict((v, file_md5(layer_file(dom, a, t))) for v, a, t in hires_layers)
+
+
+def set_build_attrs(ncfile, dom, key, checksums):
+    """
+    Record the grid key, the agg_factor and the checksums of the inputs in global attributes
+    """
+    ncfile.setncattr('grid_key', key)
+    ncfile.setncattr('agg_factor', dom['agg_factor'])
+    for v, md5 in checksums.iteritems():
+        ncfile.setncattr('src_md5_' + v, md5)
+
+
+def write_coordinates(ncfile, hires_specs):
+    ncfile.variables['x'][:] = hires_specs['x'][:]
+    ncfile.variables['y'][:] = hires_specs['y'][:]
+    ncfile.variables['LATITUDE'][:]  = hires_specs['lats'][:]
+    ncfile.variables['LONGITUDE'][:] = hires_specs['lons'][:]
+
+
+def write_basins_txt(basins, basins_txt):
+    """
+    groundwater basins are defined in a plain text file -->
+    --> adapt path for gwbasmskfil in noah_wrfcode.namelist
+    not on the hires grid --> wrf grid
+    do not flip, use crappy arcgis output format
+    One value per line, row by row, written in one bulk operation
+    """
+    np.savetxt(basins_txt, np.ma.filled(basins, -9999).reshape(-1, 1), fmt='%d')
+
+
+def build_hires(dom):
+    """
+    Build the gis_hires NetCDF file, and the aggregated basins.txt, of one domain
+    dom is a dict of the domain's options (see load_domains and create_netcdf.conf)
+    Returns a dict of: domain name, output files, grid size and build time in seconds
+    """
+    t0 = time.time()
+    name = dom.get('name', '')
+    hires_filename = dom['hires_filename']
+    p = get_proj(dom['geofile'])
+
+    if dom['gtiff_dir']:
+        hires_specs = get_hires_dims(os.path.join(dom['gtiff_dir'], 'TOPOGRAPHY.tif'), p)
+    else:
+        hires_specs = get_hires_dims(os.path.join(dom['asc_dir'], 'topography.asc'), p)
+
+    print "%s: Creating hires file %s ..." % (name, hires_filename)
+
+    ncfile = Dataset(hires_filename, 'w', format=dom['nc_format'])
+
+    ncfile.createDimension('y', size=hires_specs['lats'].shape[0])
+    ncfile.createDimension('x', size=hires_specs['lons'].shape[1])
+
+    ncfile.createVariable('x','f8',('x',),)
+    ncfile.variables['x'].setncattr('units', 'Meter')
+    ncfile.variables['x'][:] = hires_specs['x'][:]
+    ncfile.createVariable('y','f8',('y',),)
+    ncfile.variables['y'].setncattr('units', 'Meter')
+    ncfile.variables['y'][:] = hires_specs['y'][:]
+
+    for varname, datatype, fill_value in hires_vars:
+        create_grid_variable(ncfile, varname, datatype, fill_value, dom['chunk_bytes'], dom['complevel'])
+
+    shape = hires_specs['lats'].shape
+    print "%s: latitude %s to %s, grid %s" % (name, hires_specs['lats'].min(), hires_specs['lats'].max(), shape)
+
+    # Fill variables
+    ncfile.variables['LATITUDE'][:]  = hires_specs['lats'][:]
+    del hires_specs['lats']
+
+    ncfile.variables['LONGITUDE'][:] = hires_specs['lons'][:]
+    del hires_specs['lons']
+
+
+    print "%s: Reading topography ..." % name
+    fill_variable(ncfile, dom, 'TOPOGRAPHY', 'topography.asc', 'TOPOGRAPHY.tif', min_value=-9999)
+
+    print "%s: Reading flowdirection ..." % name
+    fill_variable(ncfile, dom, 'FLOWDIRECTION', 'flowdir.asc', 'FLOWDIRECTION.tif')
+
+    print "%s: Reading channelgrid ..." % name
+    # MS: What is this supposed to be??
+    #channelgrid = np.where(channelgrid > 0, 0, -9999)
+    fill_variable(ncfile, dom, 'CHANNELGRID', 'channelgrid.asc', 'CHANNELGRID.tif')
+
+    print "%s: Reading streamorder ..." % name
+    fill_variable(ncfile, dom, 'STREAMORDER', 'streamorder.asc', 'STREAMORDER.tif')
+
+    print "%s: Reading basins ..." % name
+    # The basins are also needed whole, for the aggregation to the WRF grid below
+    if dom['gtiff_dir']:
+        basins = read_gdal_values(os.path.join(dom['gtiff_dir'], 'basn_mask.tif'), ncfile.variables['basn_mask'])
+    else:
+        basins = var_values(ncfile.variables['basn_mask'],
+                            read_asc_int_values(os.path.join(dom['asc_dir'], 'basins.asc')))
+    # MS: What is this supposed to be??
+    #channelmask = np.where(basins >= 0, 1, 0)
+    ncfile.variables['basn_mask'][:]   = basins[:]
+
+
+    print "%s: Reading forecast points ..." % name
+    fill_variable(ncfile, dom, 'frxst_pts', 'frxstpts.asc', 'frxst_pts.tif')
+
+    try:
+        print "%s: Reading lake grid ..." % name
+        if dom['gtiff_dir']:
+            lakegrid = read_gdal_values(os.path.join(dom['gtiff_dir'], 'LAKEGRID.tif'), ncfile.variables['LAKEGRID'])
+        else:
+            lakegrid = read_asc_int_values(os.path.join(dom['asc_dir'], 'lakes.asc'))
+    except ValueError:
+        # Values out of the range of LAKEGRID are an error, a missing lake grid is not
+        raise
+    except:
+        lakegrid = None
+        pass
+
+    """
+    if reduce_to_basin == 1:
+        channelgrid = np.where(channelmask == 1, channelgrid, -9999)
+        streamorder = np.where(channelgrid >= 0, streamorder, -9999)
+
+    """
+
+    # MS: What is this supposed to be??
+    #ncfile.variables['basn_mask'][:]     = -9999
+
+    if lakegrid is not None:
+        ncfile.variables['LAKEGRID'][:]  = var_values(ncfile.variables['LAKEGRID'], lakegrid)[:]
+
+    #ncfile.variables['gw_basns'][:] = basn_mask[:]
+    #print np.where(ncfile.variables['frxst_pts'][:] >= 0)
+
+    set_build_attrs(ncfile, dom, grid_key(hires_specs, p), source_checksums(dom))
+    ncfile.close()
+    check_hires_file(hires_filename, dom['ncdump'], dom['model_formats'])
+
+    # if aggfctr > 1: basin mask needs to be aggregated to wrf grid
+    basins = agg_basins(basins, dom['agg_factor'])
+    write_basins_txt(basins, dom['basins_txt'])
+    if dom['basins_bin']:
+        basins_bin.write_basins_bin(basins, dom['basins_bin'])
+
+    return {'name': name, 'hires_filename': hires_filename, 'basins_txt': dom['basins_txt'],
+            'shape': shape, 'seconds': time.time() - t0, 'updated': ['all']}
+
+
+def update_hires(dom):
+    """
+    Update an existing gis_hires file of a domain: re-write only the variables whose
+    input layer changed since the last build (by the checksums in the global attributes),
+    the coordinates only if the grid header or projection changed,
+    and basins.txt only if basn_mask or agg_factor changed
+    A full build is done if the file does not exist, or the grid size or format changed
+    Returns the same dict as build_hires, 'updated' lists the re-written variables
+    """
+    t0 = time.time()
+    name = dom.get('name', '')
+    hires_filename = dom['hires_filename']
+    if not os.path.isfile(hires_filename):
+        return build_hires(dom)
+
+    p = get_proj(dom['geofile'])
+    topo_file = layer_file(dom, 'topography.asc', 'TOPOGRAPHY.tif')
+    header = read_grid_header(topo_file)
+    ncfile = Dataset(hires_filename, 'a')
+    shape = (len(ncfile.dimensions['y']), len(ncfile.dimensions['x']))
+    attrs = ncfile.ncattrs()
+    if (shape != (header['nrows'], header['ncols']) or ncfile.data_model.startswith('NETCDF4') != dom['nc_format'].startswith('NETCDF4')
+            or 'grid_key' not in attrs):
+        ncfile.close()
+        print "%s: grid or format changed, full build" % name
+        return build_hires(dom)
+
+    updated = []
+    key = grid_key(header, p)
+    if ncfile.getncattr('grid_key') != key:
+        print "%s: Calculating coordinates ..." % name
+        write_coordinates(ncfile, get_hires_dims(topo_file, p))
+        updated += ['x', 'y', 'LATITUDE', 'LONGITUDE']
+
+    checksums = source_checksums(dom)
+    basins = None
+    for varname, asc_name, tif_name in hires_layers:
+        md5 = checksums[varname]
+        attr = 'src_md5_' + varname
+        if not md5 or (attr in attrs and ncfile.getncattr(attr) == md5):
+            continue
+        print "%s: Updating %s ..." % (name, varname)
+        if varname == 'basn_mask':
+            if dom['gtiff_dir']:
+                basins = read_gdal_values(layer_file(dom, asc_name, tif_name), ncfile.variables['basn_mask'])
+            else:
+                basins = var_values(ncfile.variables['basn_mask'],
+                                    read_asc_int_values(layer_file(dom, asc_name, tif_name)))
+            ncfile.variables['basn_mask'][:] = basins[:]
+        elif varname == 'TOPOGRAPHY':
+            fill_variable(ncfile, dom, varname, asc_name, tif_name, min_value=-9999)
+        else:
+            fill_variable(ncfile, dom, varname, asc_name, tif_name)
+        updated.append(varname)
+
+    # Aggregated basins, if the basin mask or the aggregation changed
+    if (basins is None and ('agg_factor' not in attrs or ncfile.getncattr('agg_factor') != dom['agg_factor']
+                            or not os.path.isfile(dom['basins_txt']))):
+        basins = np.array(ncfile.variables['basn_mask'][:])
+    set_build_attrs(ncfile, dom, key, checksums)
+    ncfile.close()
+    if basins is not None:
+        basins = agg_basins(basins, dom['agg_factor'])
+        write_basins_txt(basins, dom['basins_txt'])
+        if dom['basins_bin']:
+            basins_bin.write_basins_bin(basins, dom['basins_bin'])
+        updated.append('basins_txt')
+
+    if updated:
+        check_hires_file(hires_filename, dom['ncdump'], dom['model_formats'])
+    return {'name': name, 'hires_filename': hires_filename, 'basins_txt': dom['basins_txt'],
+            'shape': shape, 'seconds': time.time() - t0, 'updated': updated}
+
+
+def load_domains(conf_file, names=None):
+    """
+    Read the domains from the config file: each section is one domain,
+    options in [DEFAULT] are shared by all domains (see create_netcdf.conf)
+    names selects some of the domains (default all)
+    Returns a list of dicts of the domain options
+    """
+    config = ConfigParser.SafeConfigParser(domain_defaults)
+    config.readfp(open(conf_file))
+    sections = config.sections()
+    if names:
+        unknown = [n for n in names if n not in sections]
+        if unknown:
+            raise ValueError("Domains not in %s: %s" % (conf_file, ", ".join(unknown)))
+        sections = names
+
+    domains = []
+    for s in sections:
+        dom = {'name': s}
+        for opt in config.options(s):
+            if opt in int_options:
+                dom[opt] = config.getint(s, opt)
+            else:
+                dom[opt] = config.get(s, opt)
+        for opt in required_options:
+            if not dom.get(opt):
+                raise ValueError("Domain %s: missing option %s" % (s, opt))
+        if not (dom['asc_dir'] or dom['gtiff_dir']):
+            raise ValueError("Domain %s: missing option asc_dir or gtiff_dir" % (s,))
+        domains.append(dom)
+    return domains
+
+
+def build_task(dom):
+    """
+    Build one domain in a pool process. Failures are returned, not raised,
+    so the other domains carry on
+    """
+    try:
+        if dom.get('update'):
+            return update_hires(dom), None
+        return build_hires(dom), None
+    except Exception:
+        return {'name': dom.get('name', '')}, traceback.format_exc()
+
+
+def build_domains(domains, processes=None):
+    """
+    Build several domains, each in its own process (at most processes at a time)
+    Returns a list of (report, error) per domain, in the order they finished
+    """
+    if processes is None:
+        processes = min(len(domains), cpu_count())
+    if processes <= 1 or len(domains) == 1:
+        return [build_task(d) for d in domains]
+
+    pool = Pool(processes)
+    try:
+        results = list(pool.imap_unordered(build_task, domains))
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create gis_hires NetCDF files for WRF-Hydro")
+    parser.add_argument("-c", "--config-file", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "create_netcdf.conf"),
+                        help="Configuration file (default create_netcdf.conf in the script directory)")
+    parser.add_argument("-d", "--domain", action="append", help="Domain (config section) to build, can be repeated (default all)")
+    parser.add_argument("-p", "--processes", type=int, help="Number of domains built at once (default one per core)")
+    parser.add_argument("-u", "--update", action="store_true", help="Update existing files: re-write only the changed layers")
+    args = parser.parse_args()
+
+    domains = load_domains(args.config_file, args.domain)
+    for dom in domains:
+        dom['update'] = args.update
+    results = build_domains(domains, args.processes)
+
+    failed = 0
+    for report, error in results:
+        if error:
+            failed += 1
+            print "%s: FAILED\n%s" % (report['name'], error)
+        else:
+            print "%s: %s (%s x %s) and %s in %.1f sec, updated: %s" % (report['name'], report['hires_filename'],
+                report['shape'][0], report['shape'][1], report['basins_txt'], report['seconds'],
+                ", ".join(report['updated']) or "nothing")
+
+    print 'Done!'
+    if failed:
+        sys.exit(1)
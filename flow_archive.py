@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""
+Author:   Micha Silver
+Version:  0.1
+Description:
+  Append-only columnar archive of the model flow predictions.
+  Each forecast cycle is written once, at the end of hydrographs.py,
+  as a compressed NetCDF4 file partitioned by init date:
+    <archive_dir>/YYYY/MM/frxst_YYYYMMDDHH.nc
+  holding a discharge(station, lead) variable chunked one station per chunk,
+  so reading a few stations touches only their chunks.
+
+  query_flows() selects the partitions from the file names alone (no file is opened
+  outside the requested time range) and reads only the requested stations.
+
+  From the command line, print the max predicted flow per station for a period:
+    flow_archive.py -a <archive dir> [-s 12,15,...] [--start YYYY-MM-DD] [--end YYYY-MM-DD]
+  (both dates inclusive: --end includes all the cycles of that day)
+"""
+
+import os, datetime, logging, argparse
+import numpy as np
+import netCDF4
+
+init_fmt = "%Y%m%d%H"
+
+
+def partition_path(archive_dir, init_time):
+    """
+    Path of the archive file for one init time
+    """
+    return os.path.join(archive_dir, init_time.strftime("%Y"), init_time.strftime("%m"),
+                        "frxst_" + init_time.strftime(init_fmt) + ".nc")
+
+
+def rows_to_arrays(data_rows):
+    """
+    Convert the rows from hydrographs.parse_frxst():
+    (secs, date, hour, station id, discharge, datestr)
+    to the init time, and arrays of station ids, lead hours and discharge(station, lead)
+    Missing (station, lead) pairs are NaN
+    """
+    secs = np.array([r[0] for r in data_rows], dtype=np.int64)
+    ids = np.array([r[3] for r in data_rows], dtype=np.int32)
+    disch = np.array([r[4] for r in data_rows], dtype=np.float32)
+    first = data_rows[0]
+    init_time = datetime.datetime.strptime(first[5].strip(), "%Y-%m-%d %H:%M:%S") \
+        - datetime.timedelta(seconds=int(first[0]))
+
+    station_ids = np.unique(ids)
+    leads = np.unique(secs)
+    flows = np.empty((len(station_ids), len(leads)), dtype=np.float32)
+    flows.fill(np.nan)
+    flows[np.searchsorted(station_ids, ids), np.searchsorted(leads, secs)] = disch
+    return init_time, station_ids, leads / 3600.0, flows
+
+
+def write_cycle(archive_dir, data_rows):
+    """
+    Write the predictions of one forecast cycle to its partition
+    The archive is append-only: an existing partition is never overwritten
+    The file is written under a temporary name and renamed when complete
+    (the temporary file is removed if the write fails)
+    Returns the path of the partition, or None if it already existed
+    """
+    init_time, station_ids, lead_hours, flows = rows_to_arrays(data_rows)
+    out_path = partition_path(archive_dir, init_time)
+    if os.path.exists(out_path):
+        logging.warning("Flow archive for %s already exists: %s", init_time, out_path)
+        return None
+
+    out_dir = os.path.dirname(out_path)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    tmp_path = out_path + ".tmp"
+    try:
+        nc = netCDF4.Dataset(tmp_path, 'w', format='NETCDF4')
+        try:
+            nc.setncattr('init_time', init_time.strftime("%Y-%m-%d %H:%M:%S"))
+            nc.createDimension('station', len(station_ids))
+            nc.createDimension('lead', len(lead_hours))
+            nc.createVariable('station_id', 'i4', ('station',))[:] = station_ids
+            lead = nc.createVariable('lead_hours', 'f4', ('lead',))
+            lead.setncattr('units', 'hours since init_time')
+            lead[:] = lead_hours
+            q = nc.createVariable('discharge', 'f4', ('station', 'lead'), zlib=True, complevel=4,
+                                  shuffle=True, chunksizes=(1, len(lead_hours)), fill_value=np.nan)
+            q.setncattr('units', 'm3/sec')
+            q[:] = flows
+        finally:
+            nc.close()
+        os.rename(tmp_path, out_path)
+    except:
+        # Do not leave a partial file in the archive
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    logging.info("Archived %s stations x %s lead times to %s", len(station_ids), len(lead_hours), out_path)
+    return out_path
+
+
+def list_partitions(archive_dir, start=None, end=None):
+    """
+    List (init_time, path) of all partitions with start <= init_time <= end
+    using only the directory and file names
+    """
+    parts = []
+    for root, dirs, fnames in os.walk(archive_dir):
+        dirs.sort()
+        for f in fnames:
+            if not (f.startswith("frxst_") and f.endswith(".nc")):
+                continue
+            try:
+                init_time = datetime.datetime.strptime(f[6:-3], init_fmt)
+            except ValueError:
+                continue
+            if (start is None or init_time >= start) and (end is None or init_time <= end):
+                parts.append((init_time, os.path.join(root, f)))
+    parts.sort()
+    return parts
+
+
+def query_flows(archive_dir, station_ids=None, start=None, end=None):
+    """
+    Read the archived predictions for a list of station ids (all stations if None)
+    for cycles initialized between start and end (datetimes, inclusive)
+    Returns a dict with:
+      init_times: list of datetimes
+      station_ids: array of station ids
+      lead_hours: array of lead times (the union over all cycles)
+      discharge: array (init time, station, lead), NaN where there is no prediction
+    """
+    parts = list_partitions(archive_dir, start, end)
+    init_times = []
+    cycles = []
+    all_ids = set()
+    all_leads = set()
+    for init_time, path in parts:
+        nc = netCDF4.Dataset(path, 'r')
+        try:
+            ids = nc.variables['station_id'][:]
+            leads = nc.variables['lead_hours'][:]
+            if station_ids is None:
+                idx = np.arange(len(ids))
+            else:
+                idx = np.nonzero(np.in1d(ids, station_ids))[0]
+            if len(idx) == 0:
+                continue
+            # Read just the rows (chunks) of the wanted stations
+            q = np.ma.filled(nc.variables['discharge'][idx, :], np.nan)
+        finally:
+            nc.close()
+        init_times.append(init_time)
+        cycles.append((ids[idx], leads, q))
+        all_ids.update(ids[idx].tolist())
+        all_leads.update(leads.tolist())
+
+    out_ids = np.array(sorted(all_ids), dtype=np.int32)
+    out_leads = np.array(sorted(all_leads), dtype=np.float32)
+    discharge = np.empty((len(cycles), len(out_ids), len(out_leads)), dtype=np.float32)
+    discharge.fill(np.nan)
+    for i, (ids, leads, q) in enumerate(cycles):
+        rows = np.searchsorted(out_ids, ids)
+        cols = np.searchsorted(out_leads, leads)
+        discharge[i][np.ix_(rows, cols)] = q
+
+    return {'init_times': init_times, 'station_ids': out_ids,
+            'lead_hours': out_leads, 'discharge': discharge}
+
+
+def parse_date(s):
+    return datetime.datetime.strptime(s, "%Y-%m-%d")
+
+
+def end_of_day(d):
+    """
+    The last moment of the day of d, so an end date includes all the cycles of that day
+    """
+    return datetime.datetime.combine(d.date(), datetime.time.max)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the archive of predicted flows")
+    parser.add_argument("-a", "--archive-dir", required=True, help="Flow archive directory")
+    parser.add_argument("-s", "--stations", help="Comma separated list of station ids (default all)")
+    parser.add_argument("--start", type=parse_date, help="First init date (YYYY-MM-DD)")
+    parser.add_argument("--end", type=lambda s: end_of_day(parse_date(s)),
+                        help="Last init date (YYYY-MM-DD, the whole day is included)")
+    args = parser.parse_args()
+    stations = None
+    if args.stations:
+        stations = [int(s) for s in args.stations.split(',')]
+
+    res = query_flows(args.archive_dir, stations, args.start, args.end)
+    print "Read %s cycles" % len(res['init_times'])
+    if len(res['init_times']) > 0:
+        max_q = np.nanmax(np.nanmax(res['discharge'], axis=2), axis=0)
+        print "Station\tMax predicted flow (m3/sec)"
+        for sid, q in zip(res['station_ids'], max_q):
+            print "%s\t%s" % (sid, q)
@@ -17,23 +17,198 @@ Options:
 Updates:
     20140920 - changed update_maxflows routine to use station_num instead of id
 	20141006 - Added function to call GRASS script and create rain maps
+	20261019 - send_alerts: one query for all users, templates read once, reused smtp sessions
+	20261019 - copy_to_archive: incremental link/copy into the web archive (archive_copy.py)
+	20261019 - Append each cycle's predictions to the columnar flow archive (flow_archive.py)
+	20261019 - Station registry loaded in one query per cycle (optionally cached on disk)
+	20261019 - Station registry cache checked against a trigger-bumped version (hydrographs_registry.sql)
+	20261019 - Flow levels computed in process for all stations, max_flows updated in one batch
+	20261019 - Precipitation maps rendered with numpy (precip_maps.py) instead of a GRASS session
+	20261019 - Precipitation maps rendered in parallel, gif animation assembled in process
+	20261019 - Rasterised map overlays cached on disk ([Precip] overlay_cache)
+	20261019 - Precipitation text files streamed from the tar.gz, no longer extracted to disk
+	20261019 - Configuration read by load_config into a dict, functions take explicit parameters (importable)
+	20261019 - Heavy modules imported only when there is new data, startup and run times logged
+	20261019 - Last processed timestamps kept per product (flows, precip) in a locked JSON state file (run_state.py)
+	20261019 - Ensemble mode: all new data directories processed in parallel, with min/median/max envelope graphs
 """
 
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.dates as md
-import datetime,tarfile 
-import numpy as np
-import os, csv, sys, errno, shutil
-import psycopg2
-import ConfigParser, logging
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-
-
-def send_alerts():
+import time
+start_time = time.time()
+# Only the standard library modules needed to check for new data are imported here:
+# matplotlib, numpy, psycopg2, smtplib/email, tarfile and the helper modules
+# are imported by the functions that use them, when there is new data to process
+import datetime, os, sys, errno
+import ConfigParser, logging, cPickle
+import run_state
+
+# Modules used to process new flow data, and new precipitation data (see preload_modules)
+flow_modules = ('numpy', 'psycopg2', 'matplotlib.pyplot', 'archive_copy')
+precip_modules = ('tarfile', 'precip_maps')
+
+
+def preload_modules(names):
+  """
+  Import the modules needed for the work ahead, and log the time it takes
+  (the functions import what they use themselves, this only reports the import cost up front)
+  """
+  t0 = time.time()
+  for name in names:
+    if name == 'matplotlib.pyplot':
+      pyplot()
+    else:
+      __import__(name)
+  logging.info("Loaded %s in %.0f ms", ", ".join(names), (time.time() - t0) * 1000)
+
+
+def pyplot():
+  """
+  Import matplotlib with the Agg backend (no display), return pyplot
+  """
+  if 'matplotlib.pyplot' not in sys.modules:
+    import matplotlib
+    matplotlib.use('Agg')
+  import matplotlib.pyplot as plt
+  return plt
+
+
+def db_connect(db):
+  """
+  Open a connection to the database
+  db is a dict of host, dbname, user and password (from the Db section of the conf file)
+  """
+  import psycopg2
+  conn_string = "host='"+db['host']+"' dbname='"+db['dbname']+"' user='"+db['user']+"' password='"+db['password']+"'"
+  return psycopg2.connect(conn_string)
+
+
+def get_alert_recipients(curs, registry, maxflows):
+  """
+  Query, in one round trip, all users with alert_level > 0
+  and the reshut_num of the stations each has access to.
+  Match them with the active stations in the station registry
+  whose flow level (from do_loop) is equal to or above the level the user asks for.
+  Return a list of (full_name, email_addr, stations) tuples,
+  where stations is a list of (station_name, max_flow, max_flow_ts)
+  """
+  sql =   "SELECT u.pk_uid, u.full_name, u.email_addr, u.alert_level, a.reshut_num "
+  sql +=  " FROM users AS u JOIN access AS a ON a.user_id=u.pk_uid "
+  sql +=  " WHERE u.active='t' AND u.alert_level>0 ORDER BY u.pk_uid;"
+  curs.execute(sql)
+
+  # Rows arrive ordered by user, so group consecutive rows
+  users = []
+  last_uid = None
+  for r in curs.fetchall():
+    if r[0] != last_uid:
+      last_uid = r[0]
+      users.append((r[1], r[2], r[3], set()))
+    users[-1][3].add(r[4])
+
+  # Only hydro stations (not drain points) have a name
+  hydro = sorted([s for s in registry.itervalues() if s['active'] and s['name'] is not None and s['id'] in maxflows],
+                 key=lambda s: s['name'])
+  recipients = []
+  for full_name, email_addr, alert_level, reshuts in users:
+    stations = []
+    for s in hydro:
+      m = maxflows[s['id']]
+      if s['reshut_num'] in reshuts and m['level'] >= alert_level:
+        ts = datetime.datetime.strptime(m['max_flow_ts'].strip(), "%Y-%m-%d %H:%M:%S")
+        stations.append((s['name'], m['max_flow'], ts.strftime("%d-%m-%Y %H:%M")))
+    if len(stations) > 0:
+      recipients.append((full_name, email_addr, stations))
+
+  return recipients
+
+
+def load_alert_templates(template_dir="."):
+  """
+  Read the header, message and footer templates of the alert email from template_dir
+  Return the three strings as a tuple
+  """
+  templates = []
+  for t in ('alert_header.txt', 'alert_msg.txt', 'alert_footer.txt'):
+    f = open(os.path.join(template_dir, t), 'r')
+    templates.append(f.read())
+    f.close()
+
+  return tuple(templates)
+
+
+def build_alert_msg(templates, sendfrom, full_name, rcptto, stations):
+  """
+  Construct the html email for one user from the templates
+  and the list of stations with alerts
+  """
+  from email.mime.text import MIMEText
+  header, msg_text, footer = templates
+  body_text = header
+  body_text += "שלום %s :" % str(full_name)
+  body_text += msg_text
+  for h in stations:
+    body_text += "<tr><td>%s</td><td style=\"text-align:center;\">%s</td><td style=\"text-align:center;\" dir=ltr>%s</td></tr>" % ( str(h[0]), str(h[1]), str(h[2]) )
+
+  body_text += footer
+  msg = MIMEText(body_text, 'html')
+  msg['From'] = sendfrom
+  msg['To'] = rcptto
+  msg['Subject'] = "WRF-Hydro alert"
+  return msg
+
+
+def smtp_connect(smtp_conf):
+  """
+  Open one smtp session, with STARTTLS and login only when configured
+  (a local debugging server, i.e. "python -m smtpd -n -c DebuggingServer",
+  accepts neither)
+  """
+  import smtplib
+  svr = smtplib.SMTP(smtp_conf['server'], smtp_conf['port'])
+  svr.ehlo()
+  if smtp_conf['starttls']:
+    svr.starttls()
+    svr.ehlo()
+  if smtp_conf['user']:
+    svr.login(smtp_conf['user'], smtp_conf['pass'])
+  return svr
+
+
+def send_msgs(smtp_conf, msgs):
+  """
+  Send a list of (rcptto, msg) over a single smtp session
+  Reconnect once if the server drops the session midway
+  Return the number of messages sent
+  """
+  import smtplib, socket
+  sent = 0
+  try:
+    svr = smtp_connect(smtp_conf)
+  except (smtplib.SMTPException, socket.error), e:
+    logging.error("SMTP connection failed: %s" % str(e))
+    return sent
+
+  try:
+    for rcptto, msg in msgs:
+      try:
+        try:
+          svr.sendmail(smtp_conf['from'], rcptto, msg.as_string())
+        except smtplib.SMTPServerDisconnected:
+          svr = smtp_connect(smtp_conf)
+          svr.sendmail(smtp_conf['from'], rcptto, msg.as_string())
+        sent += 1
+      except (smtplib.SMTPException, socket.error), e:
+        logging.error("SMTP failed for %s: %s" % (rcptto, str(e)))
+  finally:
+    try:
+      svr.quit()
+    except (smtplib.SMTPException, socket.error):
+      pass
+
+  return sent
+
+
+def send_alerts(db, smtp_conf, registry, maxflows, template_dir="."):
   """ 
   Send an email to each user, based on the level she requests,
   listing the hydro stations, and the max flow expected at that station
@@ -43,225 +218,240 @@ def send_alerts():
   rate = 2 means send alerts for any flow above 2 yr return rate
   rate = 3 means send alerts for any flow above 5 yr return rate
   etc...
+  Users come from one query, stations and flow levels from the registry and do_loop,
+  the templates are read once,
+  and the messages are sent over smtp_conf['sessions'] reused smtp sessions (see load_config)
   """
-  # First get list of users with rate >0
-  global host
-  global dbname
-  global user
-  global password
-  
-  conn_string = "host='"+host+"' dbname='"+dbname+"' user='"+user+"' password='"+password+"'"
+  import psycopg2
+  from multiprocessing.pool import ThreadPool
+  conn = None
   try:
-    conn = psycopg2.connect(conn_string)
+    conn = db_connect(db)
     curs = conn.cursor()
-    sql = "SELECT full_name, email_addr, reshut_num, alert_level, pk_uid FROM users WHERE active='t' and alert_level>0"
-    curs.execute(sql)
-    users = curs.fetchall()
+    recipients = get_alert_recipients(curs, registry, maxflows)
   except psycopg2.DatabaseError, e:
     logging.error('Error %s',  e)
-    sys.exit(1)
-
-  # smtp connection details from conf file
-  smtp_user = config.get("SMTP","smtp_user")
-  smtp_pass = config.get("SMTP", "smtp_pass")
-  smtp_server = config.get("SMTP", "smtp_server")
-  smtp_port = config.getint("SMTP", "smtp_port")
-
-  # Loop thru users and get all stations with return period equal or above the user's request
-  for u in users:
-    #logging.info("Sending alert to User: %s with ID: %s at: %s for return period %s" ,u[0], u[4], u[1], u[3])
-    # For each user, find the hydrographs she has access to, 
-    # with return rate above her requested level
-    sql = 	"SELECT h.station_name, m.max_flow, to_char(m.max_flow_ts,'DD-MM-YYYY HH24:MI') "
-    sql += 	" FROM max_flows AS m JOIN hydrostations AS h ON m.id=h.id "
-    sql +=	" WHERE h.reshut_num IN (SELECT reshut_num FROM access WHERE user_id=%s)"
-    sql +=	" AND m.flow_level >= %s AND h.active='t';"
-    data = (u[4], u[3])
-    curs.execute(sql, data)
-    stations = curs.fetchall()
-    alert_count = curs.rowcount
-    if alert_count == 0:
-      continue
-    
-    logging.info ("Found %s stations with alert for user %s ." % (alert_count, str(u[1])))
-	
-    # Setup smtp connection
-    svr = smtplib.SMTP(smtp_server, smtp_port)
-    sendfrom = 'micha@arava.co.il'
-    rcptto = u[1]
-    # Start constructing email message
-    fh = open('alert_header.txt','r')
-    f = open('alert_msg.txt','r')
-    ff= open('alert_footer.txt','r')
-    body_text = fh.read()
-    body_text += "שלום %s :" % str(u[0])
-    body_text += f.read()
-    for h in stations:
-    #logging.info("ALerting: %s for station: %s. Max Flow: %s",u[0], h[0], h[1])
-      body_text += "<tr><td>%s</td><td style=\"text-align:center;\">%s</td><td style=\"text-align:center;\" dir=ltr>%s</td></tr>" % ( str(h[0]), str(h[1]), str(h[2]) )
-    
-    body_text += ff.read()
-    msg = MIMEText(body_text, 'html')
-    msg['From'] = sendfrom
-    msg['To'] = rcptto
-    msg['Subject'] = "WRF-Hydro alert"
-    # message is ready, perform the send
-    try:
-      svr.ehlo()
-      svr.starttls()
-      svr.ehlo()
-      svr.login(smtp_user,smtp_pass)
-      svr.sendmail(sendfrom, rcptto, msg.as_string())
-    except smtplib.SMTPException, e:
-      logging.error("SMTP failed: %s" % str(e))
-    finally:
-      svr.quit()
+    raise
+  finally:
+    if conn:
+      conn.close()
+
+  if len(recipients) == 0:
+    logging.info("No alerts to send")
+    return
+
+  sessions = smtp_conf['sessions']
+  templates = load_alert_templates(template_dir)
+  msgs = []
+  for full_name, rcptto, stations in recipients:
+    logging.info ("Found %s stations with alert for user %s ." % (len(stations), str(rcptto)))
+    msgs.append((rcptto, build_alert_msg(templates, smtp_conf['from'], full_name, rcptto, stations)))
+
+  # Split the messages between the smtp sessions, each in its own thread
+  sessions = min(sessions, len(msgs))
+  if sessions == 1:
+    sent = send_msgs(smtp_conf, msgs)
+  else:
+    pool = ThreadPool(sessions)
+    sent = sum(pool.map(lambda i: send_msgs(smtp_conf, msgs[i::sessions]), range(sessions)))
+    pool.close()
+    pool.join()
 
+  logging.info("Sent %s of %s alert messages" % (sent, len(msgs)))
 
 
+# Graph title strings for each flow level, from level 0 up
+period_labels = (" No flow", " less than 2 years", " 2 to 5 years", " 5 to 10 years",
+                 " 10 to 25 years", " 25 to 50 years", " 50 to 100 years", " greater than 100 years")
+
 def probability_period(l):
   """
   Check which level a hydro station is in, and return a string 
   to put into the graph title
   """
-  prob_reply=""
-  if ((l is None) | (l == -1)):
-    prob_reply=" (No probability data)"
-  elif l==0:
-    prob_reply=" No flow"
-  elif l==1:
-    prob_reply=" less than 2 years"
-  elif l==2:
-    prob_reply=" 2 to 5 years"
-  elif l==3:
-    prob_reply=" 5 to 10 years"
-  elif l==4:
-    prob_reply=" 10 to 25 years"
-  elif l==5:
-    prob_reply=" 25 to 50 years"
-  elif l==6:
-    prob_reply=" 50 to 100 years"
-  else :
-    prob_reply=" greater than 100 years"
-
-  return prob_reply
-
-
-def get_stationid_list():
-  """
-  Make a postgresql database connection and query for a list of all station ids
-  Get both the hydro_station ids and the drain_point ids
-  return the list
-  """
-  global host
-  global dbname
-  global user
-  global password
-
-  conn_string = "host='"+host+"' dbname='"+dbname+"' user='"+user+"' password='"+password+"'"
-  try:
-    conn = psycopg2.connect(conn_string)
-    curs = conn.cursor()
-    sql = "SELECT id FROM hydrostations WHERE active='t' UNION SELECT id FROM drain_points WHERE active='t'"
-    curs.execute(sql)
-    rows = curs.fetchall()
-    return rows
-  except psycopg2.DatabaseError, e:
-    logging.error('Error %s',  e)		
-    sys.exit(1)			
-  finally:
-    if conn:
-      conn.close()
+  if ((l is None) or (l < 0)):
+    return " (No probability data)"
+
+  return period_labels[min(int(l), len(period_labels) - 1)]
 
 
-def get_station_num(id):
+# Return periods (years) of the flow thresholds, in the order of the flow levels
+return_periods = (2, 5, 10, 25, 50, 100)
+
+
+def query_station_registry(curs):
   """
-  Make a postgresql database connection and get the station_num 
-  from the hydrograph view for a given station id
-  return the number
+  Query, in one query (after a check for the return_periods table), all hydro stations and drain points
+  with their station_num, name, active flag, reshut_num and the return period thresholds
+  (the return_periods table: see hydrographs_registry.sql. Without it, no station has thresholds)
+  Return a dict keyed by station id
+  """
+  curs.execute("SELECT 1 FROM information_schema.tables WHERE table_name='return_periods' "
+               " AND table_schema = ANY (current_schemas(false));")
+  has_thresholds = curs.fetchone() is not None
+  if has_thresholds:
+    rp_cols = ", ".join(["r.rp_%s" % rp for rp in return_periods])
+  else:
+    logging.warning("No return_periods table, stations loaded without thresholds")
+    rp_cols = ", ".join(["NULL"] * len(return_periods))
+  sql =   "SELECT s.id, l.station_num, h.station_name, s.active, h.reshut_num, %s " % rp_cols
+  sql +=  " FROM (SELECT id, COALESCE(active='t', false) AS active FROM hydrostations "
+  sql +=  "   UNION SELECT id, COALESCE(active='t', false) FROM drain_points) AS s "
+  sql +=  " LEFT JOIN hg_locations AS l ON l.id=s.id "
+  sql +=  " LEFT JOIN hydrostations AS h ON h.id=s.id "
+  if has_thresholds:
+    sql +=  " LEFT JOIN return_periods AS r ON r.station_num=l.station_num "
+  sql +=  " ORDER BY s.id;"
+  curs.execute(sql)
+  registry = {}
+  for r in curs.fetchall():
+    thresholds = r[5:]
+    if all(t is None for t in thresholds):
+      thresholds = None
+    registry[r[0]] = {'id': r[0], 'station_num': r[1], 'name': r[2], 'active': r[3],
+                      'reshut_num': r[4], 'thresholds': thresholds}
+  return registry
+
+
+def query_registry_version(curs):
   """
-  # First get configurations
-  global host
-  global dbname
-  global user
-  global password
+  Get the version of the tables behind the station registry, from the registry_version table:
+  a trigger bumps it on any change to the tables (see hydrographs_registry.sql)
+  Returns None if there is no registry_version table (the registry is then not cached)
+  """
+  import psycopg2
+  try:
+    curs.execute("SELECT version FROM registry_version;")
+  except psycopg2.ProgrammingError as e:
+    logging.warning("No registry version, station cache not used: %s", str(e).strip())
+    curs.connection.rollback()
+    return None
+  row = curs.fetchone()
+  return row[0] if row else None
 
-  conn_string = "host='"+host+"' dbname='"+dbname+"' user='"+user+"' password='"+password+"'"
+
+def get_station_registry(db, station_cache=None):
+  """
+  Load the station registry once per cycle.
+  If station_cache ("station_cache" in the Db section of the conf file) is set, the registry is
+  kept in that (pickle) file and reused as long as the table version has not changed
+  Return the registry: a dict keyed by station id
+  """
+  import psycopg2
+  conn = None
   try:
-    conn = psycopg2.connect(conn_string)
+    conn = db_connect(db)
     curs = conn.cursor()
-    sql = "SELECT station_num FROM hg_locations WHERE id= %s;" % id
-    curs.execute(sql)
-    row = curs.fetchone()
-    if (curs.rowcount <1):
-      return None
-    else:
-      return row[0]
+    version = query_registry_version(curs)
+    if station_cache and version is not None:
+      try:
+        f = open(station_cache, 'rb')
+        cached = cPickle.load(f)
+        f.close()
+        if cached['version'] == version:
+          logging.info("Station registry read from cache: %s", station_cache)
+          return cached['stations']
+      except (IOError, EOFError, KeyError, cPickle.UnpicklingError) as e:
+        logging.warning("Station cache %s not usable: %s", station_cache, str(e))
 
+    registry = query_station_registry(curs)
   except psycopg2.DatabaseError, e:
-    logging.error('Error %s', e)		
-    sys.exit(1)			
+    logging.error('Error %s', e)
+    raise
   finally:
     if conn:
       conn.close()
 
+  logging.info("Station registry loaded with %s stations", len(registry))
+  if station_cache and version is not None:
+    # Write to a temp file and rename, so concurrent runs never read a partial cache
+    try:
+      tmp = station_cache + ".tmp"
+      f = open(tmp, 'wb')
+      cPickle.dump({'version': version, 'stations': registry}, f, 2)
+      f.close()
+      os.rename(tmp, station_cache)
+    except (IOError, OSError) as e:
+      logging.warning("Could not write station cache %s: %s", station_cache, str(e))
+
+  return registry
+
 
+# Flows at or below min_flow (m3/sec) are level 0: "No flow"
+min_flow = 1.0
 
-def update_maxflow(num, mf, mt):
+def classify_flows(thresholds, flows):
+  """
+  Compute the flow level of all stations at once
+  thresholds is a list (one per station) of return period thresholds or None,
+  flows is the list of max flows
+  Level 0 is no flow, level 1 is below the 2 year threshold,
+  then one level up for each threshold reached, -1 if the station has no thresholds (and some flow)
+  Returns an array of levels
+  """
+  import numpy as np
+  nrp = len(return_periods)
+  t = np.array([th if th is not None else (None,) * nrp for th in thresholds], dtype=float).reshape(-1, nrp)
+  f = np.asarray(flows, dtype=float)
+  # NULL thresholds are NaN, and never reached
+  with np.errstate(invalid='ignore'):
+    reached = (f[:, np.newaxis] >= t).sum(axis=1)
+  levels = np.where(f <= min_flow, 0, 1 + reached)
+  levels[np.isnan(t).all(axis=1) & (f > min_flow)] = -1
+  return levels
+
+
+def update_maxflows(db, maxflows):
   """
   Update the database table "max_flows" with the maximum flow
-  for a station_num (passed as parameters)
-  Requery to get the flow level value (set by a trigger)
-  Return the flow level value
+  of all stations in one transaction.
+  maxflows is a dict keyed by station id (from station_levels)
+  The flow_level set by the trigger is read back: stations without thresholds (level -1)
+  take the trigger's level, for the others it is a consistency check against the level
+  computed here (differences are logged)
   """
-  # First get configurations
-  global host
-  global dbname
-  global user
-  global password
+  if len(maxflows) == 0:
+    return
 
-  conn_string = "host='"+host+"' dbname='"+dbname+"' user='"+user+"' password='"+password+"'"
+  import psycopg2
+  conn = None
   try:
-    conn = psycopg2.connect(conn_string)
+    conn = db_connect(db)
     curs = conn.cursor()
     sql = "UPDATE max_flows SET max_flow=%s, max_flow_ts=%s WHERE station_num=%s;"
-    data = (mf, mt, num)
-    #logging.debug("Executing: "+sql+data)
-    curs.execute(sql, data)
+    data = [(m['max_flow'], m['max_flow_ts'], m['station_num']) for m in maxflows.itervalues()]
+    curs.executemany(sql, data)
     conn.commit()
+
+    # After update the flow level has been set in the db table (by a trigger)
+    sql = "SELECT station_num, flow_level FROM max_flows WHERE station_num IN %s"
+    curs.execute(sql, (tuple(m['station_num'] for m in maxflows.itervalues()),))
+    db_levels = dict(curs.fetchall())
   except psycopg2.DatabaseError, e:
     logging.error('Error %s',e)
-    sys.exit(1)
-
-  # After update the flow level has been set in the db table (by a trigger)
-  # Query for and return the flow level value
-  try:
-    sql = "SELECT flow_level FROM max_flows WHERE station_num = %s"
-    data = (num,)
-    curs.execute(sql, data)
-    row = curs.fetchone()
-    cnt = curs.rowcount
-    if (cnt == 1):
-      l = row[0]
-    else:
-      l = None
-  
-  except psycopg2.DatabaseError,e:
-    logging.error('Error %s', e)
+    raise
   finally:
     if conn:
       conn.close()
-	
-  return l
 
+  for m in maxflows.itervalues():
+    db_level = db_levels.get(m['station_num'])
+    if db_level is None:
+      continue
+    if m['level'] == -1:
+      m['level'] = int(db_level)
+    elif db_level != m['level']:
+      logging.warning("Station num: %s flow level %s differs from database trigger level %s",
+                      str(m['station_num']), str(m['level']), str(db_level))
 
 
-def create_graph(prob, num, disch, hrs, dt):
+def create_graph(prob, num, disch, hrs, dt, out_data_path, out_pref):
     """ 
     Creates a hydrograph (png image file) using the array of discharges from the input parameter
+    in out_data_path/<date>/<out_pref><num>.png
      """
-    global out_data_path
-    global out_pref
+    plt = pyplot()
+    import matplotlib.dates as md
     # Make a name for the date-specific target directory
 
     out_dir = os.path.join(out_data_path, dt[:10])
@@ -305,316 +495,273 @@ def create_graph(prob, num, disch, hrs, dt):
     plt.setp(ax.get_xticklabels(), rotation=30, fontsize=7)
     outpng=os.path.join(out_dir,out_pref + stnum + ".png")
     plt.savefig(outpng)
+    plt.close(fig)
+
+
+def create_envelope_graph(num, times, lo, med, hi, members, dt, out_data_path, out_pref):
+    """
+    Creates the ensemble hydrograph of one station (png image file):
+    the median discharge of the members, and the band between their min and max
+    in out_data_path/<date>/<out_pref><num>.png
+    """
+    plt = pyplot()
+    import matplotlib.dates as md
+    out_dir = os.path.join(out_data_path, dt[:10])
+    try:
+        os.makedirs(out_dir)
+    except OSError:
+        if not os.path.exists(out_dir):
+            raise
+
+    logging.info("Creating ensemble graph for station num: %s", str(num))
+    fig = plt.figure()
+    plt.xlabel('Hours')
+    plt.ylabel('Discharge (m3/sec)')
+    stnum = str(num)
+    plt.suptitle('Station Number: '+ stnum, fontsize=18)
+    plt.title("Ensemble of %s members: median, min - max" % members, size=14)
+    plt.figtext(0.13, 0.87, "Initialized: "+dt, size="medium", weight="bold", backgroundcolor="#EDEA95")
+    plt.fill_between(times, lo, hi, color='#9EC9E8', linewidth=0)
+    ln = plt.plot(times, med)
+    dis_max = max(hi) if len(hi) > 0 else 0
+    plt.ylim(ymin=0, ymax=10 if dis_max <= 10 else 1.05*dis_max)
+    plt.setp(ln, linewidth=3, color='b')
+    plt.gca().xaxis.set_major_formatter(md.DateFormatter('%d-%m-%Y %H:%M'))
+    ax = fig.add_subplot(111)
+    ax.xaxis_date()
+    plt.setp(ax.get_xticklabels(), rotation=30, fontsize=7)
+    plt.savefig(os.path.join(out_dir, out_pref + stnum + ".png"))
+    plt.close(fig)
 
 
 
-def do_loop(data_rows):
+def station_series(data_rows, registry, conf):
   """
-  Loops thru the list of station ids, 
-  For each id, search for those lines in data that match that id
+  Loops thru the list of active station ids from the station registry,
+  For each id, get those lines in data that match that id
   Obtains the discharge and hour values, and accumulates them into lists
-  Send those lists to the create graph function
+  conf is the dict from load_config (columns of the data rows)
+  Return a list of (id, station_num, max_disch, max_disch_time, disch, dis_times, date_str)
   """
-  # Get the list of station ids
-  ids = get_stationid_list()
-			
-  for i in range(0,len(ids)):
-    id = ids[i][0]
+  import matplotlib.dates as md
+  hr_col, dt_str_col, disch_col = conf['hr_col'], conf['dt_str_col'], conf['disch_col']
+  ids = sorted([s['id'] for s in registry.itervalues() if s['active']])
+
+  # Collect all data for each station in one pass over the rows
+  # THe third column (numbered from 0) has the station id
+  rows_by_id = {}
+  for row in data_rows:
+    rows_by_id.setdefault(int(row[3]), []).append(row)
+
+  series = []
+  for id in ids:
     logging.info("Working on station id: %s",str(id))
-    datai = []
-    for row in data_rows:
-    # THe third column (numbered from 0) has the station id
-    # Collect all data for one station into a data array
-      if (int(row[3]) == id):
-        datai.append(row)
-        
+    datai = rows_by_id.get(id, [])
+    station_num = registry[id]['station_num']
+    if (len(datai) == 0):
+      logging.warning("No data for id: %s", str(id))
+      continue
+    if station_num is None:
+      logging.warning( "No station with id: %s",str(id))
+      continue
+
     # Initialize the two arrays for hours and discharge
     hrs=[]
     disch=[]
     dis_times=[]
     max_disch=0
-    if (len(datai) == 0):
-      logging.warning("No data for id: %s", str(id))
-      exit
-    else:
-      # Grab the date for use later in the graph (needed only once)
-      date_str = datai[1][5]
-      #logging.debug("Data for date: ",date_str)
-      max_disch_time = datai[1][dt_str_col]
-
-      for j in range(len(datai)):
-      # Collect the date strings and discharge from this subset of data
-      # Get hour and discharge column from config
-        hr = (int(datai[j][hr_col]))/3600
-        dis_time = matplotlib.dates.datestr2num(datai[j][dt_str_col])
-      # Limit graph from minimum hour (from config) to max hour 
-      # Never mind this 48 hour check, depend only on the length of the run
-      #if (hr>min_hr and hr<=max_hr):
-        hrs.append(hr)
-        dis_times.append(dis_time)
-        # Get "disch_col" column: has the discharge in cubic meters
-        dis = float(datai[j][disch_col])
-        disch.append(dis)
-        # Keep track of the maximum discharge and time for this hydro station
-        if dis>max_disch:
-          max_disch = dis
-          max_disch_time = datai[j][dt_str_col]
-
-
-      logging.debug( "Using: %s data points.", str(len(hrs)))
-      # Now use the max_disch to update the maxflows database table
-      # and get back the flow_level for this station
-      station_num = get_station_num(int(id))
-      # Continue ONLY if level actually has value
+    # Grab the date for use later in the graph (needed only once)
+    date_str = datai[1][5]
+    max_disch_time = datai[1][dt_str_col]
+
+    for j in range(len(datai)):
+    # Collect the date strings and discharge from this subset of data
+    # Get hour and discharge column from config
+      hr = (int(datai[j][hr_col]))/3600
+      dis_time = md.datestr2num(datai[j][dt_str_col])
+      hrs.append(hr)
+      dis_times.append(dis_time)
+      # Get "disch_col" column: has the discharge in cubic meters
+      dis = float(datai[j][disch_col])
+      disch.append(dis)
+      # Keep track of the maximum discharge and time for this hydro station
+      if dis>max_disch:
+        max_disch = dis
+        max_disch_time = datai[j][dt_str_col]
+
+    logging.debug( "Using: %s data points.", str(len(hrs)))
+    series.append((id, station_num, max_disch, max_disch_time, disch, dis_times, date_str))
+
+  return series
+
+
+def station_levels(series, registry):
+  """
+  The flow levels of all stations are computed together (classify_flows)
+  from the series of each station (from station_series)
+  Return a dict keyed by station id of station_num, max_flow, max_flow_ts and level
+  """
+  # Find which return period the max flow of each station is in
+  levels = classify_flows([registry[s[0]]['thresholds'] for s in series], [s[2] for s in series])
+
+  maxflows = {}
+  for s, level in zip(series, levels):
+    id, station_num, max_disch, max_disch_time, disch, dis_times, date_str = s
+    logging.debug( "Station num: %s has max discharge: %s", str(station_num), str(max_disch))
+    maxflows[id] = {'station_num': station_num, 'max_flow': max_disch,
+                    'max_flow_ts': max_disch_time, 'level': int(level)}
+  return maxflows
+
+
+def graph_series(series, registry, out_data_path, out_pref, maxflows=None):
+  """
+  Send the series of each station (from station_series) to the create graph function,
+  with the flow levels of maxflows (computed by station_levels if not given)
+  Return the maxflows dict
+  """
+  if maxflows is None:
+    maxflows = station_levels(series, registry)
+  for s in series:
+    id, station_num, max_disch, max_disch_time, disch, dis_times, date_str = s
+    # Create the graph
+    create_graph(probability_period(maxflows[id]['level']), station_num, disch, dis_times, date_str,
+                 out_data_path, out_pref)
+
+  return maxflows
+
+
+def do_loop(data_rows, registry, conf):
+  """
+  Collect the series of each station (station_series), compute the flow levels (station_levels),
+  update the max flows of all stations in the database (which gives the level of the stations
+  without thresholds), then create the graphs (graph_series)
+  Return a dict keyed by station id of station_num, max_flow, max_flow_ts and level
+  conf is the dict from load_config (columns of the data rows, graph paths, database)
+  """
+  series = station_series(data_rows, registry, conf)
+  maxflows = station_levels(series, registry)
+  update_maxflows(conf['db'], maxflows)
+  graph_series(series, registry, conf['out_data_path'], conf['out_pref'], maxflows)
+  return maxflows
+
+
+def find_new(base_path, file_name, last_ts, label):
+  """
+  Scans the subdirectories of base_path for file_name
+  Returns a list of (subdirectory, timestamp) of the files newer than last_ts, oldest first
+  """
+  found = []
+  for d in os.listdir(base_path):
+    if os.path.isdir(os.path.join(base_path,d)):
       try:
-          level = update_maxflow(int(station_num), max_disch, max_disch_time)
-          logging.debug( "Station num: %s has max discharge: %s", str(station_num), str(max_disch))
-        # Find which return period this max flow is in
-          prob_str = probability_period(level) 
-        # Create the graph
-          create_graph(prob_str, station_num, disch, dis_times, date_str)
-      except:
-          logging.warning( "No station with id: %s",str(id))
+        # Convert timestamp to int. We don't care about fractions of seconds
+        ts = int(os.path.getmtime(os.path.join(base_path,d,file_name)))
+        # Compare timestamp of the file in each subdir with the last processed timestamp
+        if ts > last_ts:
+          found.append((d, ts))
+
+      except OSError as e:
+        logging.warning("%s file in subdir: %s not yet available. %s", label, d, e.strerror)
+
+  return sorted(found, key=lambda f: (f[1], f[0]))
 
 
-def get_latest_precipdir():
+def find_newest(base_path, file_name, last_ts, label):
+  """
+  Returns the subdirectory of base_path whose file_name is the newest, if it is newer than last_ts,
+  and the file's timestamp (None, None if there is no newer file)
+  """
+  found = find_new(base_path, file_name, last_ts, label)
+  if len(found) == 0:
+    return None, None
+  return found[-1]
+
+
+def get_latest_precipdir(img_path, precip_file, last_ts):
     """
     Scans the precip directory to get timestamp
-    finds the newest (if it is newer than the timestamp file)
-    returns the newest precip directory
+    finds the newest (if it is newer than last_ts, from the "precip" state)
+    returns the newest precip directory and its timestamp
     """
-    global img_path
-    global ts_file
-    global precip_file
+    new_csv_dir, new_ts = find_newest(img_path, precip_file, last_ts, "Precipitation")
+    if new_csv_dir is None:
+        logging.info("No new precipitation file")
+    else:
+        logging.info("Using precipitation directory: %s", new_csv_dir)
+    return new_csv_dir, new_ts
 
-  # First read existing timestamp from last timestamp file
+
+def parse_precip_data(new_csv_dir, out_precip_path):
+    """
+    Create a target directory for the new precip maps in website dir structure
+    (it may be left from an earlier attempt that failed, and is then reused)
+    The precip csv files are not extracted: they are streamed from the tar.gz
+    by create_precip_images
+    """
+
+    precip_target = os.path.join(out_precip_path, new_csv_dir)
     try:
-        f = open(ts_file,"r+")
-    # Convert timestamp to int. We don't care about fractions of seconds
-        last_ts = int(float(f.readline()))
-
-    except IOError as e:
-    # Can't get a value from the last timesatmp file. Assume 0
-        logging.warning( "Can't access timestamp file: %s", e.strerror)
-        last_ts = 0
-        f = open(ts_file, "w")
+        os.mkdir(precip_target)
+        logging.info("Created directory: %s for precipitation maps" % (precip_target,))
+        return precip_target
+    except OSError as e:
+        if e.errno == errno.EEXIST and os.path.isdir(precip_target):
+            logging.info("Using existing directory: %s for precipitation maps" % (precip_target,))
+            return precip_target
+        logging.error("Creating target directory %s for precipitation maps FAILED. %s" % (precip_target, e.strerror))
         return None
 
-    new_csv_dir = None
-    for d in os.listdir(img_path):
-	try_dir = os.path.join(img_path, d)
-        if os.path.isdir(try_dir)):
-            logging.debug("Trying path: %s", os.path.join(try_dir, precip_file))
-            try:
-                ts = int(os.path.getmtime(os.path.join(try_dir,precip_file)))
-            # Compare timestamp for each frxst file in each subdir 
-            # with the value from the last timestamp file
-                if ts > last_ts:
-                    new_csv_dir = d
-    
-            except OSError as e:
-                logging.warning("Precipitation file in subdir: %s not yet available. %s", d, e.strerror)
 
-  # If there is no newer frxst file, return None
-  # otherwise return the subdir of the new data
-  # and write out the new timestamp to the last timestamp file (for next time)
-    if new_csv_dir is None:
-        logging.info("No new precipitation file")
-        f.close()
-        return None
+def create_precip_images(precip_tar, precip_target, precip_opts):
+    """
+    Render a png map from each precipitation text file in the precip tar.gz (precip_maps.py)
+    streaming the files from the archive, with the static vector overlays and legend
+    prepared once for all maps.
+    The maps are rendered across a pool of processes,
+    then the animated gif is assembled from the maps in memory
+    precip_opts are the options of the Precip section of the conf file (see load_config)
+    width, height and res left as None take the precip_maps defaults
+    Returns True if the maps were created (or the archive has no precipitation files)
+    """
+    import tarfile, zlib, precip_maps
+    frame = dict((k, precip_opts[k]) for k in ('width', 'height', 'res') if precip_opts[k] is not None)
 
+    try:
+        pngs = precip_maps.render_tar(precip_tar, precip_target, precip_opts['color_rules'],
+                    precip_opts['parallel_gzip'], overlay_dir=precip_opts['overlay_dir'],
+                    anim_file="precip_animation.gif", processes=precip_opts['processes'],
+                    cache_dir=precip_opts['overlay_cache'], **frame)
+    except (IOError, EOFError, ValueError, tarfile.TarError, zlib.error) as e:
+        logging.error("Creating precipitation maps FAILED, %s", str(e))
+        return False
+
+    if len(pngs) == 0:
+        logging.warning("No precipitation files in: %s", precip_tar)
     else:
-        f.close()
-        logging.info("Using precipitation directory: %s", new_csv_dir)
-    
-    return new_csv_dir
+        logging.info("Completed %s png maps and gif animation in %s" % (len(pngs), precip_target))
+    return True
 
 
-def parse_precip_data(new_csv_dir):
-    """
-    Extract the set of precip csv files from tar.gz 
-    into the same directory
-		Create a target directory for the new precip maps in website dir structure
-    """
-	global img_path
-	global out_precip_path
-
-	img_target = os.path.join(img_path, new_csv_dir)
-	p = tarfile.open(os.path.join(img_target,precip_file))
-	p.extractall(path=img_target)
-	p.close()
-	cnt = len([f for f in os.listdir(img_target) 
-             if f.endswith('.txt') and os.path.isfile(os.path.join(img_target, f))])
-
-	logging.info("Unzipped %s csv files into directory: %s", (cnt,img_target))
-
-	try:
-		precip_target = os.path.join(out_precip_path, new_csv_dir)
-		os.mkdir(precip_target)
-		logging.info("Created directory: %s for precipitation maps" % (precip_target,))
-		return precip_target
-	except OSError as e:
-		logging.error("Creating target directory %s for precipitation maps FAILED. %s" % (precip_target, e.strerror))
-		return None
-
-
-def create_precip_images(img_target, precip_target):
-	"""
-	Run a GRASS session to read all precipitation text files, create rasters
-	overlay with certain vectors and export to png files. 
-	Then call imagemagick to make an animated gif
-	"""
-
-	# Import required GRASS modules
-	import grass.script as grass
-	import grass.script.setup as gsetup
-	# define GRASS DATABASE
-	gisdb = os.path.join(os.path.expanduser("~"), "grass")
-	os.environ['GISDBASE'] = gisdb
-	# specify (existing) location and mapset
-	location = "WGS84"
-	mapset   = "precip"
-	# Set GISBASE environment variable
-	os.environ['GISBASE'] = "/usr/lib64/grass-6.4.2"
-	os.environ['PATH'] += os.pathsep + os.path.join(gisbase, 'extrabin')
-	gpydir = os.path.join(gisbase, "etc", "python")
-	sys.path.append(gpydir)
- 
-	# launch session
-	gsetup.init(gisbase, gisdb, location, mapset)
-
-	# Run GRASS commands as 'ihs' user
-	from pwd import getpwnam
-	try:
-		u = getpwnam('ihs')[2]
-		os.setuid(u)
-		first = True
-		cnt = 0
-		for c in glob.glob(img_target+"/*.txt"):
-		# get basename of each csv file
-			precip_rast = os.path.splitext(os.path.basename(c))[0]
-		# Use the first file to set GRASS region
-			if first:
-				first = False
-				reg_args="input=%s, output=%s, fs=%s" % (c,precip_rast,",")
-				region = grass.read_command('r.in.xyz',flags="sg", quiet=True, kwargs=reg_args)
-				grass.run_command("g.region", quiet=True, kwargs=region)
-
-		# Continue with the rest of the process
-			xyz_args = 'input=%s, output=%s, fs=%s, method="mean"' % (c, precip_rast, ",")
-			grass.run_command('r.in.xyz', quiet=True, kwargs=xyz_args)
-			grass.run_command('r.null', quiet=True, map=precip_rast, setnull=0)
-			precip_rule_file = os.path.join(os.path.expanduser('~'), "precip_colors")
-			grass.run_command('r.colors', quiet=True,  map=precip_rast, rules=precip_rule_file)
-			png_file = precip_rast+".png"
-			os.environ['GRASS_PNGFILE'] = os.path.join(precip_target,png_file)
-			grass.run_command('d.mon', quiet=True start="PNG")
-			water_args = "map=%s, type=%s, color=$s" % ("water_bodies@precip", "boundary", "160:200:225")
-			grass.run_command('d.vect', quiet=True, kwargs=water_args)
-        		grass.run_command('d.vect', quiet=True, map="border_il_wbank@precip", _type="boundary")
-			grass.run_command('d.vect', quiet=True, map="basins@precip", _type="boundary" color="brown"
-			city_args="map=%s, type=%s, display=%s, icon=%s, size=%s, color=%s, attrcol=%s, lcolor=%s, lsize=%s" % ("mideast_cities@precip", "point", "shape,attr", "basic/point", 8, "orange", "name", "orange", =6)
-			grass.run_command('d.vect', quiet=True, kwargs=city_args)
-			title=precip_rast[11:]
-			title_args="at=%s, text=%s, size=%s, color=%s, bgcolor=%s" % ("4,96", title, 3, "black", "white")
-			grass.run_command('d.text.freetype' quiet=True, flags="b", kwargs=title_args)
-			legend_args="map=%s, at=%s, range=%s" % (precip_rast,"2,25,88,95","1,100")
-			grass.run_command('d.legend', flags="s", quiet=True, kwargs=legend_args)
-			return_val = grass.run_command('d.mon' quiet=True, stop="PNG")
-			if (return_val == 0):
-				logging.info("Created map: %s", png_file)
-				cnt = cnt+1
-			else:
-				logging.error("Create map %s FAILED,", png_file)
-
-			grass.run_command('g.remove', flags="f", quiet=True, rast=precip_rast)
-			
-		logging.info("Completed %s png maps" % cnt)
-		# After finishing all pngs, make the gif animation
-		in_pngs = os.path.join(precip_target, "*.png")
-		out_gif = os.path.join(precip_target, "precip_animation.gif")
-		convert_args = " -delay 50 -loop 0 %s %s" % (in_pngs, out_gif) 
-		return_val = subprocess.call("convert", convert_args)
-		if (return_val == 0):
-			logging.info("Created gif animation as %s" % out_gif)
-		else:
-			logging.error("Creating gif %s FAILED" % out_gif)
-
-	except:
-		logging.error("Could not switch uid: %s: ", u)
-
-
-
-def get_latest_datadir():
+def get_latest_datadir(data_path, data_file, last_ts):
   """
   Scans the output directory to get timestamps of each
-  Finds the directory with a timestamp newer than the timestamp
-  stored in the "last_timestamp" file
-  Returns the newer data directory
+  Finds the directory with a timestamp newer than last_ts (from the "flows" state)
+  Returns the newer data directory and its timestamp
   """
-  global data_path
-  global ts_file
-  global data_file
-
-  # First read existing timestamp from last timestamp file
-  try:
-    f = open(ts_file,"r+")
-    # Convert timestamp to int. We don't care about fractions of seconds
-    last_ts = int(float(f.readline()))
-
-  except IOError as e:
-  # Can't get a value from the last timesatmp file. Assume 0
-    logging.warning( "Can't access timestamp file: %s", e.strerror)
-    last_ts = 0
-    f = open(ts_file, "w")
-
-  new_ts = None
-  new_data_dir = None
-  for d in os.listdir(data_path):
-    if os.path.isdir(os.path.join(data_path,d)):
-      #logging.debug("Trying path: %s", os.path.join(data_path,d))
-      try:
-        ts = int(os.path.getmtime(os.path.join(data_path,d,data_file)))
-        # Compare timestamp for each frxst file in each subdir 
-        # with the value from the last timestamp file
-        if ts > last_ts:
-          new_ts = ts
-          # Reset last_ts so that if the directories are not checked in order
-          # The most recent timestamp will always be used
-          last_ts = ts
-          new_data_dir = d
-    
-      except OSError as e:
-        logging.warning("Data file in subdir: %s not yet available. %s", d, e.strerror)
-
-  # If there is no newer frxst file, return None
-  # otherwise return the subdir of the new data
-  # and write out the new timestamp to the last timestamp file (for next time)
-  if new_ts is None:
+  new_data_dir, new_ts = find_newest(data_path, data_file, last_ts, "Data")
+  if new_data_dir is None:
     logging.info("No new data file")
-    f.close()
-    return None
-
   else:
-    f.seek(0)
-    logging.debug("Updating last_timestamp to: "+str(new_ts))
-    f.write(str(new_ts))
-    f.truncate()
-    f.close()
     logging.info("Using data directory: %s", new_data_dir)
-    
-  return new_data_dir
+  return new_data_dir, new_ts
 
 
-
-def parse_frxst(dirname):
+def parse_frxst(dirname, data_path, data_file):
   """
-  Scan the input data file, and get all rows into a list of lists
+  Scan the input data file (data_path/dirname/data_file), and get all rows into a list of lists
   Add a column "datestr" wihich concatenates the date and hour
   Return the list
   """
-  global data_path
-  global data_file
 
   input_file = os.path.join(data_path, dirname, data_file)
   data_rows=[]
@@ -645,21 +792,16 @@ def parse_frxst(dirname):
   return data_rows
 
 
-def upload_flow_data(data_rows):
+def upload_flow_data(db, data_rows):
   """
   Creates a database connection,
   inserts all rows from the data_rows array
   into the db table predicted_flow_data
   """
-  # First get configurations
-  global host
-  global dbname
-  global user
-  global password
-
-  conn_string = "host='"+host+"' dbname='"+dbname+"' user='"+user+"' password='"+password+"'"
+  import psycopg2
+  conn = None
   try:
-    conn = psycopg2.connect(conn_string)
+    conn = db_connect(db)
     curs = conn.cursor()
     for row in data_rows:
       dt = row[1]+" "+row[2]
@@ -674,46 +816,30 @@ def upload_flow_data(data_rows):
 
   except psycopg2.DatabaseError, e:
     logging.error('Error %s', e)
-    sys.exit(1)
+    raise
   finally:
     if conn:
       conn.close()
 
 
-def upload_model_timing(data_rows):
+def upload_model_timing(db, model_ts, data_rows):
   """
   Grab the init date-time of the gfs data (from the first row of data_rows)
-  and the time the model completed (from the last_timestamp file)
+  and the time the model completed (model_ts, the timestamp of the data file)
   INSERT a row into the model_timing database table with three timestamps:
   gfs init, wrf completed, and graphs available
   """
-  global ts_file
-  global host
-  global dbname
-  global user
-  global password
+  import psycopg2
 
   # Get init hour from the data
   gfs_init = data_rows[1][5]
-  # Read existing timestamp from last timestamp file
-  try:
-    f = open(ts_file,"r+")
-    last_ts = float(f.readline())
-
-  except IOError as e:
-  # Can't get a value from the last timesatmp file. Assume 0
-    logging.warning( "Can't access timestamp file: %s", e.strerror)
-    last_ts = 0
-  
-  f.close()
-
-  model_complete = datetime.datetime.fromtimestamp(last_ts).strftime('%Y-%m-%d %H:%M')
+  model_complete = datetime.datetime.fromtimestamp(model_ts).strftime('%Y-%m-%d %H:%M')
   graphs_complete = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
   #print "GFS: "+str(gfs_init)+", MODEL: "+str(model_complete)+", GRAPHS: "+str(graphs_complete) 
 
-  conn_string = "host='"+host+"' dbname='"+dbname+"' user='"+user+"' password='"+password+"'"
+  conn = None
   try:
-    conn = psycopg2.connect(conn_string)
+    conn = db_connect(db)
     curs = conn.cursor()
     
     data = (str(gfs_init), str(model_complete), str(graphs_complete))
@@ -724,91 +850,395 @@ def upload_model_timing(data_rows):
 
   except psycopg2.DatabaseError, e:
     logging.error('Error %s', e)
-    sys.exit(1)
+    raise
   finally:
     if conn:
       conn.close()
 
-def copy_to_archive(datadir):
-  """ 
-  Copies the latest directory to the website archive directory
-  Also move the latest rainfall data files to the web archive
+def copy_data_dir(datadir, web_archive, data_path):
   """
-  global web_archive
-  global data_path
-  global rain_path
-  global img_path
-
+  Copies a data directory to the website archive directory
+  Only new or changed files are transferred (see archive_copy.sync_tree)
+  """
+  import archive_copy
   destdatadir   = os.path.join(web_archive,'forecast',datadir)
   srcdatadir    = os.path.join(data_path, datadir)  
-  destraindir   = os.path.join(web_archive,'rainfall')
-  srcraindir    = rain_path
-  srcimgdir     = img_path
 
   try:
-    shutil.copytree(srcdatadir, destdatadir)
-    logging.info("Data files copied to: "+destdatadir)
+    st = archive_copy.sync_tree(srcdatadir, destdatadir)
+    logging.info("Data files copied to: %s %s", destdatadir, str(st))
   except (IOError, os.error) as e:
     logging.error("Error %s", str(e)+" from: "+datadir+" to: "+web_archive)
-  
-  try:
-    for root, dirs, fnames in os.walk(srcraindir):
-        for f in fnames:
-            shutil.copy(os.path.join(srcraindir,f), destraindir)
-            logging.info("Rain file %s copied to: %s" % (f,destraindir))
-            os.unlink(os.path.join(srcraindir,f))
 
+
+def move_rain_files(web_archive, rain_path, img_path):
+  """
+  Move the latest rainfall data files and images to the web archive
+  Rain files and images are taken from the top of rain_path and img_path only
+  """
+  import archive_copy
+  destraindir   = os.path.join(web_archive,'rainfall')
+  srcraindir    = rain_path
+  srcimgdir     = img_path
+
+  try:
+    st = archive_copy.sync_tree(srcraindir, destraindir, flat=True, move=True)
+    logging.info("Rain files moved to: %s %s", destraindir, str(st))
   except (IOError, os.error) as e:
     logging.error("Error %s", str(e)+" from: "+srcraindir+" to: "+destraindir)
 
   try:
-    for root, dirs, fnames in os.walk(srcimgdir):
-        for f in fnames:
-            shutil.copy(os.path.join(srcimgdir,f), destraindir)
-            logging.info("Rain image %s copied to: %s" % (f,destraindir))
-            os.unlink(os.path.join(srcimgdir,f))
-
+    st = archive_copy.sync_tree(srcimgdir, destraindir, flat=True, move=True)
+    logging.info("Rain images moved to: %s %s", destraindir, str(st))
   except (IOError, os.error) as e:
     logging.error("Error %s", str(e)+" from: "+srcimgdir+" to: "+destraindir)
 
 
-def main():
+def copy_to_archive(datadir, web_archive, data_path, rain_path, img_path):
+  """ 
+  Copies the latest directory to the website archive directory
+  Also move the latest rainfall data files to the web archive
+  """
+  copy_data_dir(datadir, web_archive, data_path)
+  move_rain_files(web_archive, rain_path, img_path)
+
+
+def load_config(conf_file):
+  """
+  Read the conf file (hydrographs.conf)
+  Return a dict of all the options used by the functions above, with:
+  'db': the Db section (host, dbname, user, password),
+  'precip_opts': the options of the (optional) Precip section,
+  'smtp': the options of the SMTP section (None if there is no SMTP section)
   """
+  config = ConfigParser.ConfigParser()
+  config.read(conf_file)
+  conf = {
+    'min_hr': config.getint("General", "min_hr"),
+    'max_hr': config.getint("General","max_hr"),
+    'hr_col': config.getint("General", "hr_col"),
+    'data_path': config.get("General", "data_path"),
+    'rain_path': config.get("General", "rain_path"),
+    'img_path': config.get("General", "img_path"),
+    'disch_col': config.getint("General", "disch_col"),
+    'dt_str_col': config.getint("General", "dt_str_col"),
+    'ts_file': config.get("General", "timestamp_file"),
+    # State of the runs (see run_state.py), by default next to the old timestamp file
+    'state_file': config.get("General", "timestamp_file") + ".json",
+    'data_file': config.get("General", "disch_data_file"),
+    'precip_file': config.get("General", "precip_data_file"),
+    'log_file': config.get("General", "logfile"),
+    'out_data_path': config.get("Graphs","out_data_path"),
+    'out_pref': config.get("Graphs", "out_pref"),
+    'out_precip_path': config.get("Graphs", "out_precip_path"),
+    'web_archive': config.get("Web","web_archive"),
+    # Optional columnar archive of the predicted flows
+    'flow_archive_dir': None,
+  }
+  if config.has_option("Web", "flow_archive"):
+    conf['flow_archive_dir'] = config.get("Web", "flow_archive")
+  if config.has_option("General", "state_file"):
+    conf['state_file'] = config.get("General", "state_file")
+
+  # Ensemble mode (see process_ensemble) when there is an Ensemble section
+  # processes (default one per cpu), member_sep, out_path and min_members are optional
+  conf['ensemble'] = None
+  if config.has_section("Ensemble"):
+    ens = {'processes': None, 'member_sep': '_', 'min_members': 2,
+           'out_path': os.path.join(conf['out_data_path'], 'ensemble')}
+    for opt in config.options("Ensemble"):
+      if opt in ('processes', 'min_members'):
+        ens[opt] = config.getint("Ensemble", opt)
+      else:
+        ens[opt] = config.get("Ensemble", opt)
+    conf['ensemble'] = ens
+
+  # Precipitation map options, all optional (width, height and res default to those of precip_maps)
+  precip_opts = {'color_rules': 'precip_color_rules', 'overlay_dir': None,
+                 'width': None, 'height': None, 'res': None,
+                 'processes': None, 'overlay_cache': None, 'parallel_gzip': False}
+  if config.has_section("Precip"):
+    for opt in config.options("Precip"):
+      if opt in ('width', 'height', 'processes'):
+        precip_opts[opt] = config.getint("Precip", opt)
+      elif opt == 'parallel_gzip':
+        precip_opts[opt] = config.getboolean("Precip", opt)
+      elif opt == 'res':
+        precip_opts[opt] = config.getfloat("Precip", opt)
+      else:
+        precip_opts[opt] = config.get("Precip", opt)
+  conf['precip_opts'] = precip_opts
+
+  conf['db'] = {'host': config.get("Db","host"), 'dbname': config.get("Db","dbname"),
+                'user': config.get("Db","user"), 'password': config.get("Db","password")}
+  conf['station_cache'] = None
+  if config.has_option("Db", "station_cache"):
+    conf['station_cache'] = config.get("Db", "station_cache")
+
+  # smtp connection details
+  # smtp_from, smtp_starttls and smtp_sessions are optional
+  conf['smtp'] = None
+  if config.has_section("SMTP"):
+    smtp_conf = {
+      'server': config.get("SMTP", "smtp_server"),
+      'port': config.getint("SMTP", "smtp_port"),
+      'user': config.get("SMTP","smtp_user"),
+      'pass': config.get("SMTP", "smtp_pass"),
+      'from': 'micha@arava.co.il',
+      'starttls': True,
+      'sessions': 1,
+    }
+    if config.has_option("SMTP", "smtp_from"):
+      smtp_conf['from'] = config.get("SMTP", "smtp_from")
+    if config.has_option("SMTP", "smtp_starttls"):
+      smtp_conf['starttls'] = config.getboolean("SMTP", "smtp_starttls")
+    if config.has_option("SMTP", "smtp_sessions"):
+      smtp_conf['sessions'] = max(1, config.getint("SMTP", "smtp_sessions"))
+    conf['smtp'] = smtp_conf
+
+  return conf
+
+
+def process_datadir(conf, datadir, data_ts, registry=None):
+  """
+  Create the hydrographs and upload the flows of one data directory,
+  copy it to the web archive and append it to the flow archive
+  registry is the station registry (loaded here if not given)
+  """
+  data_rows = parse_frxst(datadir, conf['data_path'], conf['data_file'])
+  if (data_rows is None):
+    # Nothing to do with this directory
+    return
+
+  # we have data, go ahead
+  if registry is None:
+    registry = get_station_registry(conf['db'], conf['station_cache'])
+  maxflows = do_loop(data_rows, registry, conf)
+  # INSERT to the database
+  upload_flow_data(conf['db'], data_rows)
+  upload_model_timing(conf['db'], data_ts, data_rows)
+  copy_to_archive(datadir, conf['web_archive'], conf['data_path'], conf['rain_path'], conf['img_path'])
+  if conf['flow_archive_dir']:
+    import flow_archive
+    flow_archive.write_cycle(conf['flow_archive_dir'], data_rows)
+#  send_alerts(conf['db'], conf['smtp'], registry, maxflows)
+
+
+def process_flows(conf, last_ts):
+  """
+  Process the newest data directory (newer than last_ts): see process_datadir
+  Returns the data directory and its timestamp, to be recorded in the state (None, None if there is no new data)
+  A directory without data is also recorded, so it is not read again
+  """
+  datadir, data_ts = get_latest_datadir(conf['data_path'], conf['data_file'], last_ts)
+  if datadir is None:
+    return None, None
+
+  preload_modules(flow_modules)
+  process_datadir(conf, datadir, data_ts)
+  return datadir, data_ts
+
+
+def process_precip(conf, last_ts):
+  """
+  Render the precipitation maps of the newest precip directory (newer than last_ts)
+  Returns the directory and its timestamp, to be recorded in the state
+  (None, None if there is no new data, or if the maps failed: they are tried again by the next run)
+  """
+  csvdir, precip_ts = get_latest_precipdir(conf['img_path'], conf['precip_file'], last_ts)
+  if csvdir is None:
+    return None, None
+
+  precip_target = parse_precip_data(csvdir, conf['out_precip_path'])
+  if precip_target is None:
+    return None, None
+  preload_modules(precip_modules)
+  if not create_precip_images(os.path.join(conf['img_path'], csvdir, conf['precip_file']), precip_target,
+                              conf['precip_opts']):
+    return None, None
+  return csvdir, precip_ts
+
+
+# Configuration and station registry of the ensemble worker processes, set once per worker by the pool initializer
+worker_conf = None
+worker_registry = None
+
+def init_worker(conf, registry):
+  global worker_conf
+  global worker_registry
+  worker_conf = conf
+  worker_registry = registry
+
+
+def member_task(task):
+  """
+  Process one ensemble member in a worker process
+  task is (member directory, outputs). The outputs of a member are its hydrographs
+  (in out_data_path/<member>/) and the copy of its data directory in the web archive.
+  With outputs False the member is only read, for the envelope
+  Returns the member directory and a dict of station id -> (station_num, times, discharges, date_str)
+  """
+  member, outputs = task
+  conf = worker_conf
+  data_rows = parse_frxst(member, conf['data_path'], conf['data_file'])
+  if data_rows is None:
+    return member, {}
+  series = station_series(data_rows, worker_registry, conf)
+  if outputs:
+    graph_series(series, worker_registry, os.path.join(conf['out_data_path'], member), conf['out_pref'])
+    copy_data_dir(member, conf['web_archive'], conf['data_path'])
+  return member, dict((s[0], (s[1], s[5], s[4], s[6])) for s in series)
+
+
+def map_members(conf, registry, tasks, processes=None):
+  """
+  Run member_task for each task across a pool of processes (in this process if processes is 1)
+  The configuration and station registry are sent once to each worker
+  Returns a dict of member directory -> station series
+  """
+  if processes == 1:
+    init_worker(conf, registry)
+    return dict(member_task(t) for t in tasks)
+
+  import multiprocessing
+  pool = multiprocessing.Pool(processes, init_worker, (conf, registry))
+  try:
+    results = dict(pool.imap_unordered(member_task, tasks))
+  finally:
+    pool.close()
+    pool.join()
+  return results
+
+
+def ensemble_envelope(member_series):
+  """
+  Min, median and max discharge of each station across the members, at each time
+  member_series is a list (one per member) of dicts station id -> (station_num, times, discharges, date_str)
+  All the series are placed in one array of members x stations x times (NaN where a member has no value)
+  and reduced along the members axis
+  Returns a dict station id -> (station_num, times, min, median, max, number of members, date_str)
+  """
+  import numpy as np
+  import warnings
+  ids = sorted(set(i for m in member_series for i in m))
+  if len(ids) == 0:
+    return {}
+  times = np.unique(np.concatenate([np.asarray(m[i][1], dtype=float) for m in member_series for i in m]))
+  flows = np.empty((len(member_series), len(ids), len(times)))
+  flows.fill(np.nan)
+  for k, m in enumerate(member_series):
+    for j, i in enumerate(ids):
+      if i in m:
+        flows[k, j, np.searchsorted(times, m[i][1])] = m[i][2]
+
+  # Times no member has a value for give all-NaN slices: dropped below
+  with warnings.catch_warnings():
+    warnings.simplefilter('ignore', RuntimeWarning)
+    lo = np.nanmin(flows, axis=0)
+    med = np.nanmedian(flows, axis=0)
+    hi = np.nanmax(flows, axis=0)
+  counts = (~np.isnan(flows)).any(axis=2).sum(axis=0)
+
+  envelope = {}
+  for j, i in enumerate(ids):
+    has = ~np.isnan(med[j])
+    station_num, date_str = [(m[i][0], m[i][3]) for m in member_series if i in m][0]
+    envelope[i] = (station_num, times[has], lo[j, has], med[j, has], hi[j, has], int(counts[j]), date_str)
+  return envelope
+
+
+def process_ensemble(conf, last_ts):
+  """
+  Ensemble mode: process every data directory newer than last_ts: the members of new ensembles
+  across a pool of processes, then graph the envelope (min, median, max)
+  of each station for each ensemble with new members, in <out_path>/<ensemble>/
+  The members of an ensemble are the directories with the same name up to member_sep
+  (i.e. 2014110100_01, 2014110100_02). Its envelope uses all of its members, also those processed before
+  New directories without member_sep in their name are deterministic runs: they are processed
+  one by one as in the deterministic mode (process_datadir: database upload and flow archive)
+  Returns the newest directory and its timestamp, to be recorded in the state (None, None if there is no new data)
+  """
+  ens = conf['ensemble']
+  new = find_new(conf['data_path'], conf['data_file'], last_ts, "Data")
+  if len(new) == 0:
+    logging.info("No new data file")
+    return None, None
+
+  preload_modules(flow_modules)
+  def ensemble_name(d):
+    return d.split(ens['member_sep'], 1)[0]
+
+  registry = get_station_registry(conf['db'], conf['station_cache'])
+  runs = [(d, ts) for d, ts in new if ens['member_sep'] not in d]
+  if runs:
+    logging.info("Processing %s new deterministic data directories", len(runs))
+  for d, ts in runs:
+    process_datadir(conf, d, ts, registry)
+
+  new_dirs = [d for d, ts in new if ens['member_sep'] in d]
+  if len(new_dirs) == 0:
+    return new[-1]
+  names = sorted(set(ensemble_name(d) for d in new_dirs))
+  # Members processed before are read again for the envelopes
+  old_dirs = [d for d in sorted(os.listdir(conf['data_path'])) if d not in new_dirs and ens['member_sep'] in d
+              and ensemble_name(d) in names and os.path.isfile(os.path.join(conf['data_path'], d, conf['data_file']))]
+  logging.info("Processing %s new data directories of %s ensembles", len(new_dirs), len(names))
+
+  tasks = [(d, True) for d in new_dirs] + [(d, False) for d in old_dirs]
+  results = map_members(conf, registry, tasks, ens['processes'])
+
+  for name in names:
+    members = [results[d] for d in sorted(results) if ensemble_name(d) == name and results[d]]
+    if len(members) < ens['min_members']:
+      logging.info("Ensemble %s has %s members, no envelope", name, len(members))
+      continue
+    envelope = ensemble_envelope(members)
+    out_dir = os.path.join(ens['out_path'], name)
+    for id in sorted(envelope):
+      station_num, times, lo, med, hi, count, date_str = envelope[id]
+      create_envelope_graph(station_num, times, lo, med, hi, count, date_str, out_dir, conf['out_pref'])
+    logging.info("Ensemble %s: envelope of %s stations from %s members", name, len(envelope), len(members))
+
+  move_rain_files(conf['web_archive'], conf['rain_path'], conf['img_path'])
+  return new[-1]
+
+
+def main(conf):
+  """
+  For each product (flows, then precip) check for new data, and process it
+  (with an Ensemble section in the conf file, all new flow directories: see process_ensemble):
   Loops thru a number of index values,retrieved from a db query, reads rows 
   from the csv file passed on the command line
   Each row contains data for a certain station at a certain time
   The loop aggregates the data, and creates a discharge array for each station
   This array is fed to a function to create a hydrograph for each station
+  conf is the dict from load_config
+  The checks for new data come first: the other modules are loaded only when there is work to do
+  A product is processed under its lock (run_state.py), so a run that overlaps the previous one
+  skips what that run is still processing. The state of a product is updated when its processing completes
+  (a run that fails is repeated by the next run)
   """
 
-  logging.info("*** Hydrograph process started ***")
-  datadir = get_latest_datadir()
-  if datadir is None:
-    exit
-  else:	
-    data_rows = parse_frxst(datadir)
-    if (data_rows is None):
-      sys.exit()
-    else:
-    # we have data, go ahead
-      do_loop(data_rows)
-    # INSERT to the database
-      upload_flow_data(data_rows)
-      upload_model_timing(data_rows)
-      copy_to_archive(datadir)
-#      send_alerts()
-
-  csvdir = get_latest_precipdir()
-  if csvdir is None:
-      exit
-  else:
-    precip_target = parse_precip_data(csvdir)
-		if precip_target is None:
-			exit
-		else:
-			create_precip_images(csvdir, precip_target)	
+  logging.info("*** Hydrograph process started (imports and configuration: %.0f ms) ***",
+               (time.time() - start_time) * 1000)
+  run_state.load_state(conf['state_file'], conf['ts_file'])
+  # Work done for each product of the state file
+  flows_step = process_ensemble if conf['ensemble'] else process_flows
+  for product, step in (('flows', flows_step), ('precip', process_precip)):
+    lock = run_state.lock_product(conf['state_file'], product)
+    if lock is None:
+      logging.info("Another run is processing %s, skipped", product)
+      continue
+    try:
+      # Read the state again under the lock: the previous run may have just completed
+      last_ts = run_state.load_state(conf['state_file'])[product]['last_ts']
+      new_dir, new_ts = step(conf, last_ts)
+      if new_dir is not None:
+        run_state.update_product(conf['state_file'], product, new_ts, new_dir)
+    finally:
+      run_state.unlock_file(lock)
 
-  logging.info("*** Hydrograph Process completed ***")
+  logging.info("*** Hydrograph Process completed in %.0f ms ***", (time.time() - start_time) * 1000)
   # end of main()
 
 
@@ -823,33 +1253,19 @@ if __name__ == "__main__":
   os.chdir(script_path)
 
 # Get configurations
-  config = ConfigParser.ConfigParser()
-  config.read("hydrographs.conf")
-  min_hr = config.getint("General", "min_hr")
-  max_hr = config.getint("General","max_hr")
-  hr_col = config.getint("General", "hr_col")
-  data_path = config.get("General", "data_path")
-  rain_path = config.get("General", "rain_path")
-  img_path = config.get("General", "img_path")
-  disch_col = config.getint("General", "disch_col")
-  dt_str_col = config.getint("General", "dt_str_col")
-  ts_file = config.get("General", "timestamp_file")
-  data_file = config.get("General", "disch_data_file")
-  precip_file = config.get("General", "precip_data_file")
-  log_file = config.get("General", "logfile")
-  out_data_path = config.get("Graphs","out_data_path")
-  out_pref = config.get("Graphs", "out_pref")
-	out_precip_path = config.get("Graphs", "out_precip_path")	
-  host = config.get("Db","host")
-  dbname = config.get("Db","dbname")
-  user = config.get("Db","user")
-  password = config.get("Db","password")
-  web_archive = config.get("Web","web_archive")
+  conf = load_config("hydrographs.conf")
 
   # Set up logging
   frmt='%(asctime)s %(levelname)-8s %(message)s'
-  logging.basicConfig(level=logging.DEBUG, format=frmt, filename=log_file, filemode='a')
+  logging.basicConfig(level=logging.DEBUG, format=frmt, filename=conf['log_file'], filemode='a')
  
   # Now begin work
-  main()
-
+  # Database errors are logged where they occur
+  # (psycopg2 is imported only if there was new data)
+  try:
+    main(conf)
+  except Exception as e:
+    psycopg2 = sys.modules.get('psycopg2')
+    if psycopg2 is not None and isinstance(e, psycopg2.DatabaseError):
+      sys.exit(1)
+    raise
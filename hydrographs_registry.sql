@@ -0,0 +1,75 @@
+-- Author:   Micha Silver
+-- Description:
+--   Tables used by the station registry of hydrographs.py (see get_station_registry)
+--   Run once on the hydrographs database:
+--     psql -d <dbname> -f hydrographs_registry.sql
+--
+--   return_periods: the flow thresholds (m3/sec) of each station for the 2 to 100 year return periods.
+--     Fill it with the same thresholds the flow_level trigger of max_flows uses:
+--     a station with no row (or NULL thresholds) gets no flow level.
+--   registry_version: one row, with a version number bumped by triggers on any change
+--     to the registry tables (and to the tables behind the hg_locations view).
+--     The cached registry (station_cache in the conf file) is reused only while the version is unchanged.
+
+CREATE TABLE return_periods (
+  station_num integer PRIMARY KEY,
+  rp_2 real,
+  rp_5 real,
+  rp_10 real,
+  rp_25 real,
+  rp_50 real,
+  rp_100 real
+);
+
+CREATE TABLE registry_version (
+  version integer NOT NULL,
+  updated_at timestamp with time zone NOT NULL DEFAULT now()
+);
+INSERT INTO registry_version (version) VALUES (1);
+
+CREATE OR REPLACE FUNCTION bump_registry_version() RETURNS trigger AS $$
+BEGIN
+  UPDATE registry_version SET version = version + 1, updated_at = now();
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Statement level: one bump per insert, update or delete statement, whatever the number of rows
+CREATE TRIGGER hydrostations_registry_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON hydrostations
+  FOR EACH STATEMENT EXECUTE PROCEDURE bump_registry_version();
+CREATE TRIGGER drain_points_registry_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON drain_points
+  FOR EACH STATEMENT EXECUTE PROCEDURE bump_registry_version();
+CREATE TRIGGER return_periods_registry_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON return_periods
+  FOR EACH STATEMENT EXECUTE PROCEDURE bump_registry_version();
+
+-- hg_locations is a view: triggers on a view do not fire when its tables change,
+-- so the triggers go on the tables it reads from (through any nested views)
+-- that are not covered above. If hg_locations is a table, the trigger goes on it.
+-- Run this block again if the view is changed to read other tables.
+DO $$
+DECLARE
+  t record;
+BEGIN
+  FOR t IN
+    WITH RECURSIVE used(table_schema, table_name) AS (
+      SELECT table_schema, table_name FROM information_schema.tables
+        WHERE table_name = 'hg_locations' AND table_schema = ANY (current_schemas(false))
+      UNION
+      SELECT v.table_schema, v.table_name FROM information_schema.view_table_usage AS v
+        JOIN used AS u ON v.view_schema = u.table_schema AND v.view_name = u.table_name
+    )
+    SELECT u.table_schema, u.table_name FROM used AS u
+      JOIN information_schema.tables AS b ON b.table_schema = u.table_schema AND b.table_name = u.table_name
+      WHERE b.table_type = 'BASE TABLE'
+        AND u.table_name NOT IN ('hydrostations', 'drain_points', 'return_periods')
+  LOOP
+    EXECUTE 'DROP TRIGGER IF EXISTS ' || quote_ident(t.table_name || '_registry_version')
+      || ' ON ' || quote_ident(t.table_schema) || '.' || quote_ident(t.table_name);
+    EXECUTE 'CREATE TRIGGER ' || quote_ident(t.table_name || '_registry_version')
+      || ' AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON '
+      || quote_ident(t.table_schema) || '.' || quote_ident(t.table_name)
+      || ' FOR EACH STATEMENT EXECUTE PROCEDURE bump_registry_version()';
+    RAISE NOTICE 'Registry version trigger on %.%', t.table_schema, t.table_name;
+  END LOOP;
+END
+$$;
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""
+Author:   Micha Silver
+Version:  0.1
+Description:
+  Memory mapped access to the variables of classic format NetCDF files
+  (NETCDF3_CLASSIC, NETCDF3_64BIT as written by create_netcdf.py, and CDF-5).
+  In these files every fixed size variable is one contiguous block at an offset
+  given in the header, stored big endian. read_header() parses the header,
+  and variable() returns a numpy array of a variable backed by np.memmap:
+  nothing is read until it is indexed, only the pages touched are read,
+  and repeated runs are served from the page cache.
+  Record variables are returned as strided views over the records.
+
+  NETCDF4 (HDF5) files are not classic: use is_classic() and fall back to netCDF4.
+
+  From the command line, list the variables of a file:
+    nc3mmap.py <netcdf file>
+"""
+
+import struct, argparse
+import numpy as np
+
+# Header tags
+NC_DIMENSION = 10
+NC_VARIABLE = 11
+NC_ATTRIBUTE = 12
+# Type codes: numpy type (big endian) and default fill value
+nc_types = {1: ('>i1', -127), 2: ('S1', '\x00'), 3: ('>i2', -32767), 4: ('>i4', -2147483647),
+            5: ('>f4', 9.9692099683868690e+36), 6: ('>f8', 9.9692099683868690e+36),
+            7: ('>u1', 255), 8: ('>u2', 65535), 9: ('>u4', 4294967295),
+            10: ('>i8', -9223372036854775806), 11: ('>u8', 18446744073709551614)}
+
+
+def read_fmt(f, fmt):
+    """
+    Read one big endian value with struct format fmt
+    """
+    size = struct.calcsize(fmt)
+    buf = f.read(size)
+    if len(buf) < size:
+        raise ValueError("Unexpected end of NetCDF header")
+    return struct.unpack(fmt, buf)[0]
+
+
+def read_name(f, count_fmt):
+    """
+    Read a name: its length, and the characters padded to 4 bytes
+    """
+    n = read_fmt(f, count_fmt)
+    s = f.read(n)
+    f.read((4 - n % 4) % 4)
+    return s
+
+
+def read_values(f, nc_type, n):
+    """
+    Read n attribute values of nc_type, padded to 4 bytes
+    Returns a string for char attributes, a scalar for one value, otherwise an array
+    """
+    dtype = np.dtype(nc_types[nc_type][0])
+    nbytes = dtype.itemsize * n
+    buf = f.read(nbytes)
+    f.read((4 - nbytes % 4) % 4)
+    if nc_type == 2:
+        return buf.rstrip('\x00')
+    vals = np.frombuffer(buf, dtype=dtype).astype(dtype.newbyteorder('='))
+    return vals[0] if n == 1 else vals
+
+
+def read_list_tag(f, count_fmt):
+    """
+    Read the tag and number of elements of a dimension, attribute or variable list
+    (tag 0 for an absent list)
+    """
+    tag = read_fmt(f, '>I')
+    return tag, read_fmt(f, count_fmt)
+
+
+def read_attrs(f, count_fmt):
+    """
+    Read an attribute list into a dict
+    """
+    tag, n = read_list_tag(f, count_fmt)
+    attrs = {}
+    if tag == 0:
+        return attrs
+    if tag != NC_ATTRIBUTE:
+        raise ValueError("Bad attribute list in NetCDF header")
+    for i in range(n):
+        name = read_name(f, count_fmt)
+        nc_type = read_fmt(f, '>I')
+        attrs[name] = read_values(f, nc_type, read_fmt(f, count_fmt))
+    return attrs
+
+
+def is_classic(filename):
+    """
+    True if filename is a classic format NetCDF file (CDF-1, CDF-2 or CDF-5)
+    """
+    f = open(filename, 'rb')
+    try:
+        magic = f.read(4)
+    finally:
+        f.close()
+    return len(magic) == 4 and magic[:3] == 'CDF' and ord(magic[3]) in (1, 2, 5)
+
+
+def read_header(filename):
+    """
+    Parse the header of a classic NetCDF file
+    Returns a dict with: version, numrecs, dims (list of (name, length), 0 for the record dim),
+    attrs (global attributes), variables (dict of name: dims, shape, dtype, begin, vsize, attrs, record),
+    and recsize (bytes per record, over all record variables)
+    """
+    f = open(filename, 'rb')
+    try:
+        magic = f.read(4)
+        if len(magic) < 4 or magic[:3] != 'CDF' or ord(magic[3]) not in (1, 2, 5):
+            raise ValueError("%s is not a classic format NetCDF file" % filename)
+        version = ord(magic[3])
+        # CDF-5 uses 64 bit counts, CDF-1 and CDF-2 32 bit. Only CDF-1 has 32 bit offsets
+        count_fmt = '>Q' if version == 5 else '>I'
+        offset_fmt = '>I' if version == 1 else '>Q'
+        numrecs = read_fmt(f, count_fmt)
+
+        dims = []
+        tag, n = read_list_tag(f, count_fmt)
+        if tag not in (0, NC_DIMENSION):
+            raise ValueError("Bad dimension list in NetCDF header")
+        for i in range(n if tag else 0):
+            name = read_name(f, count_fmt)
+            dims.append((name, read_fmt(f, count_fmt)))
+
+        gattrs = read_attrs(f, count_fmt)
+
+        variables = {}
+        tag, n = read_list_tag(f, count_fmt)
+        if tag not in (0, NC_VARIABLE):
+            raise ValueError("Bad variable list in NetCDF header")
+        for i in range(n if tag else 0):
+            name = read_name(f, count_fmt)
+            ndims = read_fmt(f, count_fmt)
+            dimids = [read_fmt(f, count_fmt) for d in range(ndims)]
+            vattrs = read_attrs(f, count_fmt)
+            nc_type = read_fmt(f, '>I')
+            vsize = read_fmt(f, count_fmt)
+            begin = read_fmt(f, offset_fmt)
+            record = ndims > 0 and dims[dimids[0]][1] == 0
+            variables[name] = {'dims': [dims[d][0] for d in dimids],
+                               'shape': [numrecs if (record and k == 0) else dims[d][1] for k, d in enumerate(dimids)],
+                               'dtype': nc_types[nc_type][0], 'nc_type': nc_type,
+                               'begin': begin, 'vsize': vsize, 'attrs': vattrs, 'record': record}
+    finally:
+        f.close()
+
+    rec_vars = [v for v in variables.itervalues() if v['record']]
+    # A single record variable is not padded to 4 bytes
+    if len(rec_vars) == 1:
+        v = rec_vars[0]
+        recsize = np.dtype(v['dtype']).itemsize * int(np.prod(v['shape'][1:]))
+    else:
+        recsize = sum(v['vsize'] for v in rec_vars)
+    return {'version': version, 'numrecs': numrecs, 'dims': dims, 'attrs': gattrs,
+            'variables': variables, 'recsize': recsize}
+
+
+def variable(filename, name, mode='r', header=None):
+    """
+    Return variable name of a classic NetCDF file as a numpy array over np.memmap
+    mode: 'r' read only, 'r+' write through to the file, 'c' copy on write (changes in memory only)
+    The values are raw: fill values are not masked (see fill_value)
+    """
+    if header is None:
+        header = read_header(filename)
+    v = header['variables'][name]
+    mm = np.memmap(filename, dtype='u1', mode=mode)
+    dtype = np.dtype(v['dtype'])
+    shape = tuple(v['shape'])
+    if not v['record']:
+        return np.ndarray(shape, dtype=dtype, buffer=mm, offset=v['begin'])
+
+    # Record variable: one slab per record, records are recsize bytes apart
+    inner = shape[1:]
+    inner_strides = tuple(int(np.prod(inner[k+1:])) * dtype.itemsize for k in range(len(inner)))
+    return np.ndarray(shape, dtype=dtype, buffer=mm, offset=v['begin'],
+                      strides=(header['recsize'],) + inner_strides)
+
+
+def fill_value(header, name):
+    """
+    The fill value of a variable: its _FillValue attribute or the NetCDF default for its type
+    """
+    v = header['variables'][name]
+    if '_FillValue' in v['attrs']:
+        return v['attrs']['_FillValue']
+    return nc_types[v['nc_type']][1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List the variables of a classic NetCDF file")
+    parser.add_argument("nc_file", help="NetCDF file")
+    args = parser.parse_args()
+    header = read_header(args.nc_file)
+    print "Format: CDF-%s, records: %s" % (header['version'], header['numrecs'])
+    print "Dimensions: %s" % ", ".join("%s=%s" % d for d in header['dims'])
+    print "Variable\tType\tShape\tOffset"
+    for name, v in sorted(header['variables'].items(), key=lambda t: t[1]['begin']):
+        print "%s\t%s\t%s\t%s" % (name, v['dtype'], "x".join(str(s) for s in v['shape']), v['begin'])
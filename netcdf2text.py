@@ -52,12 +52,11 @@ def netcdf_to_text(ncdir,outdir):
 		csvfile.close()
 
 
-# Main work starts here
-parser = argparse.ArgumentParser("Get command line arguments")
-parser.add_argument("-i", "--wrfdir", default=".", required=True, help="Directory of wrfout netCDF files") 
-parser.add_argument("-o", "--outdir", default=".", help="Directory to store output csv")
-# Get arguments
-args = parser.parse_args()
-# Run the function
-netcdf_to_text(args.wrfdir, args.outdir)
-
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser("Get command line arguments")
+	parser.add_argument("-i", "--wrfdir", default=".", required=True, help="Directory of wrfout netCDF files") 
+	parser.add_argument("-o", "--outdir", default=".", help="Directory to store output csv")
+	# Get arguments
+	args = parser.parse_args()
+	# Run the function
+	netcdf_to_text(args.wrfdir, args.outdir)
@@ -0,0 +1,562 @@
+#!/usr/bin/env python
+"""
+Author:   Micha Silver
+Version:  0.1
+Description:
+  Render the precipitation maps (png) from the precipitation text files
+  (lon,lat,precip per line, as written by netcdf2text.py) without GRASS.
+  This replaces the r.in.xyz / r.colors / d.mon / d.vect / d.legend session
+  that create_precip_map.sh (and hydrographs.py) ran for every file.
+
+  The map "domain" is set up once from the first file, like the GRASS region:
+    the grid extent and resolution, the placement of the map in the png frame,
+    one 8 bit palette with the colors of precip_color_rules, and the static
+    vector overlays (water bodies, borders, basins, cities) and legend,
+    rasterised once into the frame. The rasterised overlays can be cached on disk,
+    keyed by map extent, frame size, styles and the source layer files.
+  Each frame is then: bin the points into the grid (one np.bincount),
+  color the grid through a lookup into the palette, paste the overlays and draw the title.
+  Frames are rendered across a pool of processes, and the animated gif is assembled
+  from the frames in memory, all sharing the one palette.
+  The text files can be streamed straight from the tar.gz archive (optionally
+  decompressed by pigz) without extracting them to disk.
+
+  Command line:
+    precip_maps.py -i <directory of precip text files, or tar.gz> -o <directory for png output>
+                   [-c <color rules file>] [-v <directory of overlay shapefiles>]
+                   [-k <overlay cache directory>] [-a <animation file name>] [-p <number of processes>] [-z]
+"""
+
+import os, glob, logging, argparse, multiprocessing, hashlib, itertools, tarfile, subprocess
+from distutils.spawn import find_executable
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+# Frame size and grid resolution (about 3 km) as in create_precip_map.sh
+frame_width = 400
+frame_height = 600
+grid_res = 0.033
+
+# Palette entries per interval between two color rules
+steps_per_rule = 24
+
+# Named colors as defined by GRASS
+grass_colors = {
+    'white': (255, 255, 255), 'black': (0, 0, 0), 'red': (255, 0, 0),
+    'green': (0, 255, 0), 'blue': (0, 0, 255), 'yellow': (255, 255, 0),
+    'magenta': (255, 0, 255), 'cyan': (0, 255, 255), 'aqua': (100, 128, 255),
+    'grey': (128, 128, 128), 'gray': (128, 128, 128), 'orange': (255, 128, 0),
+    'brown': (180, 77, 25), 'purple': (128, 0, 255), 'violet': (128, 0, 255),
+    'indigo': (0, 128, 255)
+}
+
+# Static vector overlays, in drawing order: (layer name, type, color)
+# as drawn by d.vect in create_precip_map.sh
+overlay_styles = [
+    ('water_bodies', 'boundary', '160:200:225'),
+    ('border_il_wbank', 'boundary', 'black'),
+    ('basins', 'boundary', 'brown'),
+    ('mideast_cities', 'point', 'orange'),
+]
+
+# Legend placement (bottom, top, left, right in percent of the frame) and value range
+legend_at = (2, 25, 88, 95)
+legend_range = (1, 100)
+# Title placement (percent from left, percent from bottom) and size (percent of frame height)
+title_at = (4, 96)
+title_size = 3
+
+
+def parse_color(c):
+    """
+    Convert a GRASS color, either a name or "r:g:b", to an (r, g, b) tuple
+    """
+    if ':' in c:
+        return tuple(int(v) for v in c.split(':'))
+    return grass_colors[c.lower()]
+
+
+def read_color_rules(rules_file):
+    """
+    Read an r.colors rules file: lines of "value color"
+    Return a sorted list of (value, (r, g, b))
+    """
+    rules = []
+    f = open(rules_file, 'r')
+    for line in f:
+        parts = line.split()
+        if len(parts) < 2 or line.lstrip().startswith('#'):
+            continue
+        rules.append((float(parts[0]), parse_color(parts[1])))
+    f.close()
+    rules.sort()
+    return rules
+
+
+def build_palette(rules):
+    """
+    Build the 8 bit palette shared by all frames:
+      index 0 is the background (and null cells): white
+      then the precipitation colors, interpolated between the rules
+      then the fixed colors used for overlays and text
+    Returns the palette (list of 768 ints), the index of the first precip color,
+    and a dict of the indexes of the fixed colors
+    """
+    rule_rgb = np.array([c for v, c in rules], dtype=float)
+    nsteps = (len(rules) - 1) * steps_per_rule + 1
+    pos = np.linspace(0, len(rules) - 1, nsteps)
+    lut_rgb = np.column_stack([np.interp(pos, np.arange(len(rules)), rule_rgb[:, i]) for i in range(3)])
+
+    colors = [grass_colors['white']] + [tuple(int(round(v)) for v in c) for c in lut_rgb]
+    fixed = {}
+    for name in ['black', 'white'] + [s[2] for s in overlay_styles]:
+        if name not in fixed:
+            fixed[name] = len(colors)
+            colors.append(parse_color(name))
+    if len(colors) > 256:
+        raise ValueError("Too many colors for an 8 bit palette: %s" % len(colors))
+
+    palette = [v for c in colors for v in c]
+    palette += [0] * (768 - len(palette))
+    return palette, 1, fixed
+
+
+def value_to_index(domain, values):
+    """
+    Map precipitation values to palette indexes (vectorized)
+    Zero and null (NaN) values get index 0 (as r.null setnull=0)
+    """
+    v = np.nan_to_num(values)
+    pos = np.interp(v, domain['rule_values'], np.arange(len(domain['rule_values'])))
+    idx = domain['lut_start'] + np.rint(pos * steps_per_rule).astype(np.uint8)
+    idx[v <= 0] = 0
+    return idx
+
+
+def parse_xyz(text):
+    """
+    Parse lon,lat,precip lines of text
+    Returns an (n, 3) array
+    """
+    return np.fromstring(text.replace(',', ' '), sep=' ').reshape(-1, 3)
+
+
+def read_xyz(txt_file):
+    """
+    Read the lon,lat,precip points from a text file
+    Returns an (n, 3) array
+    """
+    f = open(txt_file, 'r')
+    text = f.read()
+    f.close()
+    return parse_xyz(text)
+
+
+def iter_tar_members(tar_path, suffix=".txt", parallel_gzip=False):
+    """
+    Stream the members of a (gzipped) tar archive, without extracting to disk
+    Yields (member name, member text) for each file whose name ends with suffix
+    With parallel_gzip=True, and pigz installed, decompression is done by pigz
+    A corrupt archive raises IOError (or tarfile.TarError, EOFError, zlib.error)
+    """
+    proc = None
+    pigz = find_executable("pigz") if parallel_gzip else None
+    if pigz:
+        proc = subprocess.Popen([pigz, "-dc", tar_path], stdout=subprocess.PIPE)
+        tar = tarfile.open(fileobj=proc.stdout, mode="r|")
+    else:
+        tar = tarfile.open(tar_path, mode="r|*")
+    try:
+        for m in tar:
+            if m.isfile() and m.name.endswith(suffix):
+                yield m.name, tar.extractfile(m).read()
+    finally:
+        tar.close()
+        if proc:
+            proc.stdout.close()
+            proc.wait()
+    if proc and proc.returncode != 0:
+        raise IOError("pigz failed (exit code %s) on: %s" % (proc.returncode, tar_path))
+
+
+def make_domain(xyz, color_rules, overlay_dir=None, width=frame_width, height=frame_height, res=grid_res,
+                cache_dir=None):
+    """
+    Set up the map domain from the points of one file (the equivalent of r.in.xyz -s -g and g.region):
+    the grid extent, the placement of the grid in the frame,
+    the palette, and the static layer: overlays and legend
+    The rasterised overlays are kept in cache_dir, if set, and reused while the map extent,
+    frame size, styles and source layers stay the same
+    Returns a dict used by all later frames
+    """
+    west, east = xyz[:, 0].min(), xyz[:, 0].max()
+    south, north = xyz[:, 1].min(), xyz[:, 1].max()
+    cols = max(1, int(round((east - west) / res)))
+    rows = max(1, int(round((north - south) / res)))
+    rules = read_color_rules(color_rules)
+    palette, lut_start, fixed = build_palette(rules)
+
+    # Fit the grid into the frame keeping the aspect ratio, centered (as d.rast)
+    scale = min(float(width) / cols, float(height) / rows)
+    map_w, map_h = int(cols * scale), int(rows * scale)
+    x0, y0 = (width - map_w) // 2, (height - map_h) // 2
+
+    domain = {
+        'west': west, 'east': east, 'south': south, 'north': north,
+        'rows': rows, 'cols': cols, 'ewres': (east - west) / cols, 'nsres': (north - south) / rows,
+        'width': width, 'height': height,
+        'map_box': (y0, y0 + map_h, x0, x0 + map_w),
+        # Grid cell for each pixel of the map area (nearest neighbour)
+        'row_map': np.minimum((np.arange(map_h) / scale).astype(int), rows - 1),
+        'col_map': np.minimum((np.arange(map_w) / scale).astype(int), cols - 1),
+        'palette': palette, 'lut_start': lut_start, 'fixed': fixed,
+        'rule_values': np.array([v for v, c in rules]),
+    }
+    # Frame geotransform, used to rasterise the overlays
+    domain['geotransform'] = (west - x0 * domain['ewres'] / scale, domain['ewres'] / scale, 0,
+                              north + y0 * domain['nsres'] / scale, 0, -domain['nsres'] / scale)
+    domain['static'] = static_layer(domain, overlay_dir, cache_dir)
+    return domain
+
+
+def rasterize_overlays(domain, overlay_dir):
+    """
+    Rasterise the static vector layers (<overlay_dir>/<layer>.shp) into a frame sized
+    array of palette indexes, 0 where nothing is drawn
+    Polygons are drawn as boundaries, points as a marker with the "name" label
+    """
+    from osgeo import gdal, ogr
+
+    overlay = np.zeros((domain['height'], domain['width']), dtype=np.uint8)
+    labels = []
+    for name, geom_type, color in overlay_styles:
+        shp = os.path.join(overlay_dir, name + ".shp")
+        ds = ogr.Open(shp)
+        if ds is None:
+            logging.warning("Overlay layer not found: %s", shp)
+            continue
+        src_lyr = ds.GetLayer(0)
+        src_lyr.SetSpatialFilterRect(domain['west'], domain['south'], domain['east'], domain['north'])
+        color_idx = domain['fixed'][color]
+        if geom_type == 'point':
+            gt = domain['geotransform']
+            for feat in src_lyr:
+                g = feat.GetGeometryRef()
+                px = int((g.GetX() - gt[0]) / gt[1])
+                py = int((g.GetY() - gt[3]) / gt[5])
+                labels.append((px, py, color_idx, feat.GetField('name')))
+            continue
+
+        # Boundaries of polygons, into a memory layer
+        mem = ogr.GetDriverByName('Memory').CreateDataSource('overlay')
+        lyr = mem.CreateLayer(name, src_lyr.GetSpatialRef(), ogr.wkbMultiLineString)
+        for feat in src_lyr:
+            g = feat.GetGeometryRef()
+            if g is None:
+                continue
+            out = ogr.Feature(lyr.GetLayerDefn())
+            out.SetGeometry(g.Boundary() if g.GetDimension() == 2 else g)
+            lyr.CreateFeature(out)
+        rast = gdal.GetDriverByName('MEM').Create('', domain['width'], domain['height'], 1, gdal.GDT_Byte)
+        rast.SetGeoTransform(domain['geotransform'])
+        gdal.RasterizeLayer(rast, [1], lyr, burn_values=[color_idx])
+        drawn = rast.GetRasterBand(1).ReadAsArray()
+        overlay = np.where(drawn > 0, drawn, overlay).astype(np.uint8)
+
+    # Point markers and labels
+    if labels:
+        img = Image.fromarray(overlay, 'L')
+        draw = ImageDraw.Draw(img)
+        font = load_font(int(domain['height'] * 0.012) + 6)
+        for px, py, color_idx, label in labels:
+            draw.rectangle([px - 2, py - 2, px + 2, py + 2], fill=color_idx)
+            if label:
+                draw.text((px + 4, py - 4), label, fill=color_idx, font=font)
+        overlay = np.asarray(img, dtype=np.uint8)
+
+    return overlay
+
+
+def overlay_cache_key(domain, overlay_dir):
+    """
+    Key of the rasterised overlays: the map extent, frame size and geotransform,
+    the overlay styles and palette indexes, and the size and mtime of every file
+    of each source layer (so any change to a layer gives a new key)
+    """
+    sources = []
+    for name, geom_type, color in overlay_styles:
+        for f in sorted(glob.glob(os.path.join(overlay_dir, name + ".*"))):
+            st = os.stat(f)
+            sources.append((os.path.basename(f), st.st_size, int(st.st_mtime)))
+    key = repr((os.path.abspath(overlay_dir),
+                [round(v, 6) for v in domain['geotransform']], domain['width'], domain['height'],
+                overlay_styles, sorted(domain['fixed'].items()), sources))
+    return hashlib.md5(key).hexdigest()
+
+
+def cached_overlays(domain, overlay_dir, cache_dir):
+    """
+    Get the rasterised overlays from the cache directory, or rasterise them
+    and store them there, as a compressed array of palette indexes (1 byte per pixel)
+    """
+    cache_file = os.path.join(cache_dir, "overlay_%s.npz" % overlay_cache_key(domain, overlay_dir))
+    if os.path.isfile(cache_file):
+        try:
+            return np.load(cache_file)['overlay']
+        except (IOError, KeyError, ValueError) as e:
+            logging.warning("Overlay cache %s not usable: %s", cache_file, str(e))
+
+    overlay = rasterize_overlays(domain, overlay_dir)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Write to a temp file and rename, so a concurrent run never reads a partial file
+        tmp = "%s.%s.tmp" % (cache_file, os.getpid())
+        f = open(tmp, 'wb')
+        np.savez_compressed(f, overlay=overlay)
+        f.close()
+        os.rename(tmp, cache_file)
+        logging.info("Overlays cached in: %s", cache_file)
+    except (IOError, OSError) as e:
+        logging.warning("Could not write overlay cache %s: %s", cache_file, str(e))
+    return overlay
+
+
+def load_font(size, bold=False):
+    """
+    A TrueType font of the given pixel size if one is available, else the PIL default font
+    """
+    for name in (['DejaVuSans-Bold.ttf'] if bold else []) + ['DejaVuSans.ttf']:
+        try:
+            return ImageFont.truetype(name, size)
+        except IOError:
+            pass
+    return ImageFont.load_default()
+
+
+def static_layer(domain, overlay_dir, cache_dir=None):
+    """
+    Build the frame sized layer of everything that is the same in every frame:
+    the vector overlays (from the cache, if cache_dir is set)
+    and the legend (a smooth color bar as d.legend -s)
+    Returns an array of palette indexes, 0 where the precip map shows through
+    """
+    w, h = domain['width'], domain['height']
+    if overlay_dir and cache_dir:
+        layer = cached_overlays(domain, overlay_dir, cache_dir).copy()
+    elif overlay_dir:
+        layer = rasterize_overlays(domain, overlay_dir)
+    else:
+        layer = np.zeros((h, w), dtype=np.uint8)
+
+    bottom, top, left, right = legend_at
+    y_top, y_bot = int(h * (1 - top / 100.0)), int(h * (1 - bottom / 100.0))
+    x_left, x_right = int(w * left / 100.0), int(w * right / 100.0)
+    bar_w = max(1, (x_right - x_left) // 2)
+    values = np.linspace(legend_range[1], legend_range[0], y_bot - y_top)
+    layer[y_top:y_bot, x_left:x_left + bar_w] = value_to_index(domain, values)[:, np.newaxis]
+
+    img = Image.fromarray(layer, 'L')
+    draw = ImageDraw.Draw(img)
+    black = domain['fixed']['black']
+    draw.rectangle([x_left, y_top, x_left + bar_w - 1, y_bot - 1], outline=black)
+    font = load_font(int(h * 0.015) + 4)
+    for v in (legend_range[1], (legend_range[0] + legend_range[1]) // 2, legend_range[0]):
+        y = y_top + (y_bot - y_top - 1) * (legend_range[1] - v) / float(legend_range[1] - legend_range[0])
+        draw.text((x_left + bar_w + 2, int(y) - 5), str(v), fill=black, font=font)
+
+    return np.asarray(img, dtype=np.uint8)
+
+
+def grid_xyz(domain, xyz):
+    """
+    Bin the points into the grid and take the mean of each cell (r.in.xyz method=mean)
+    Returns a (rows, cols) float array, NaN where a cell has no points
+    """
+    col = np.clip(((xyz[:, 0] - domain['west']) / domain['ewres']).astype(int), 0, domain['cols'] - 1)
+    row = np.clip(((domain['north'] - xyz[:, 1]) / domain['nsres']).astype(int), 0, domain['rows'] - 1)
+    cell = row * domain['cols'] + col
+    size = domain['rows'] * domain['cols']
+    total = np.bincount(cell, weights=xyz[:, 2], minlength=size)
+    count = np.bincount(cell, minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+    return mean.reshape(domain['rows'], domain['cols'])
+
+
+def render_frame(domain, xyz, title):
+    """
+    Render one precipitation map as a frame sized array of palette indexes
+    """
+    grid_idx = value_to_index(domain, grid_xyz(domain, xyz))
+    frame = np.zeros((domain['height'], domain['width']), dtype=np.uint8)
+    r0, r1, c0, c1 = domain['map_box']
+    frame[r0:r1, c0:c1] = grid_idx[domain['row_map'][:, np.newaxis], domain['col_map'][np.newaxis, :]]
+    static = domain['static']
+    frame = np.where(static > 0, static, frame).astype(np.uint8)
+
+    # Title, black on white (d.text -b)
+    img = Image.fromarray(frame, 'L')
+    draw = ImageDraw.Draw(img)
+    font = load_font(int(domain['height'] * title_size / 100.0), bold=True)
+    x = int(domain['width'] * title_at[0] / 100.0)
+    y = int(domain['height'] * (1 - title_at[1] / 100.0))
+    tw, th = draw.textsize(title, font=font)
+    draw.rectangle([x - 2, y - 2, x + tw + 2, y + th + 2], fill=domain['fixed']['white'])
+    draw.text((x, y), title, fill=domain['fixed']['black'], font=font)
+    return np.asarray(img, dtype=np.uint8)
+
+
+def frame_image(domain, frame):
+    """
+    A PIL palette image of a rendered frame
+    """
+    img = Image.fromarray(frame, 'P')
+    img.putpalette(domain['palette'])
+    return img
+
+
+def save_png(domain, frame, png_file):
+    """
+    Write one rendered frame as a palette png
+    """
+    frame_image(domain, frame).save(png_file, optimize=False)
+
+
+def save_animation(domain, frames, out_file, delay=500):
+    """
+    Assemble the animated gif from the rendered frames (in memory)
+    All frames share the domain palette, so there is no per frame color quantization
+    delay is the time per frame in milliseconds
+    """
+    images = [frame_image(domain, f) for f in frames]
+    images[0].save(out_file, save_all=True, append_images=images[1:],
+                   duration=delay, loop=0, optimize=False)
+
+
+# Domain of the worker processes, set once per worker by the pool initializer
+worker_domain = None
+
+def init_worker(domain):
+    global worker_domain
+    worker_domain = domain
+
+
+def render_task(task):
+    """
+    Render (and save) one frame in a worker process
+    task is (points text, title, png file name)
+    Returns the frame, for the animation
+    """
+    text, title, png_file = task
+    frame = render_frame(worker_domain, parse_xyz(text), title)
+    save_png(worker_domain, frame, png_file)
+    return frame
+
+
+def render_frames(domain, tasks, processes=None):
+    """
+    Render the frames of a list (or iterator) of tasks (see render_task) across a pool of processes
+    The domain is sent once to each worker
+    The tasks are read in this process, and submitted one by one: an error reading them
+    (i.e. a corrupt tar) is raised here (in Pool.imap it would leave the pool waiting)
+    Returns the frames in the order of the tasks
+    """
+    if processes == 1:
+        init_worker(domain)
+        return [render_task(t) for t in tasks]
+
+    pool = multiprocessing.Pool(processes, init_worker, (domain,))
+    try:
+        results = [pool.apply_async(render_task, (t,)) for t in tasks]
+        frames = [r.get() for r in results]
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return frames
+
+
+def frame_title(txt_name):
+    """
+    Title of a map from the text file name: precip_csv_<date> -> <date>
+    """
+    return os.path.splitext(os.path.basename(txt_name))[0].replace("precip_csv_", "")
+
+
+def render_sources(sources, output_dir, color_rules, overlay_dir=None, anim_file="precip_animation.gif",
+                   processes=None, cache_dir=None, width=frame_width, height=frame_height, res=grid_res):
+    """
+    Render a png map into output_dir for each (name, text) of precipitation points from sources,
+    in parallel, and the animation of all maps, in name order (if anim_file is set)
+    The first source sets the map region
+    Returns the list of png files created
+    """
+    sources = iter(sources)
+    try:
+        first = next(sources)
+    except StopIteration:
+        return []
+    domain = make_domain(parse_xyz(first[1]), color_rules, overlay_dir, width, height, res, cache_dir)
+
+    pngs = []
+    def tasks():
+        for name, text in itertools.chain([first], sources):
+            png_file = os.path.join(output_dir, os.path.splitext(os.path.basename(name))[0] + ".png")
+            pngs.append(png_file)
+            yield text, frame_title(name), png_file
+
+    frames = render_frames(domain, tasks(), processes)
+    logging.info("Created %s maps in %s", len(pngs), output_dir)
+    if anim_file:
+        order = sorted(range(len(pngs)), key=lambda i: pngs[i])
+        save_animation(domain, [frames[i] for i in order], os.path.join(output_dir, anim_file))
+    return pngs
+
+
+def render_dir(input_dir, output_dir, color_rules, **kwargs):
+    """
+    Render the maps (see render_sources) of each precip*.txt file in input_dir
+    """
+    def sources():
+        for c in sorted(glob.glob(os.path.join(input_dir, "precip*.txt"))):
+            f = open(c, 'r')
+            text = f.read()
+            f.close()
+            yield c, text
+
+    return render_sources(sources(), output_dir, color_rules, **kwargs)
+
+
+def render_tar(tar_path, output_dir, color_rules, parallel_gzip=False, **kwargs):
+    """
+    Render the maps (see render_sources) of each .txt member of a tar.gz archive,
+    streamed from the archive without extracting it
+    """
+    sources = iter_tar_members(tar_path, ".txt", parallel_gzip)
+    return render_sources(sources, output_dir, color_rules, **kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create precipitation maps from precip text files")
+    parser.add_argument("-i", "--inputdir", required=True, help="Directory of precip text files, or a tar.gz of them")
+    parser.add_argument("-o", "--outputdir", default=".", help="Directory for png output")
+    parser.add_argument("-c", "--color-rules", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "precip_color_rules"),
+                        help="Color rules file (r.colors format)")
+    parser.add_argument("-v", "--overlay-dir", help="Directory of overlay shapefiles")
+    parser.add_argument("-k", "--cache-dir", help="Directory to cache the rasterised overlays")
+    parser.add_argument("-a", "--animation", default="precip_animation.gif", help="Animation file name (gif)")
+    parser.add_argument("-z", "--parallel-gzip", action="store_true", help="Decompress a tar.gz input with pigz")
+    parser.add_argument("-p", "--processes", type=int, help="Number of rendering processes (default: number of cpus)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
+    opts = {'overlay_dir': args.overlay_dir, 'anim_file': args.animation,
+            'processes': args.processes, 'cache_dir': args.cache_dir}
+    if os.path.isfile(args.inputdir):
+        pngs = render_tar(args.inputdir, args.outputdir, args.color_rules, args.parallel_gzip, **opts)
+    else:
+        pngs = render_dir(args.inputdir, args.outputdir, args.color_rules, **opts)
+    print "Completed %s png maps" % len(pngs)
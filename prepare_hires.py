@@ -37,14 +37,31 @@ Revisions:
 '''
 
 import os, sys, ConfigParser, argparse, math
-from grass.script import grass
 import netCDF4, numpy as np
-from osgeo import gdal
-import urllib2, zipfile
+from osgeo import gdal, ogr
+import tile_download, tile_store
 
-if "GISBASE" not in os.environ:
-    print "You must be in GRASS GIS to run this program."
-    sys.exit(1)
+# Download locations of the HydroSHEDS tiles and GSHHG shorelines
+HS_baseURL = "http://earlywarning.usgs.gov/hydrodata/sa_con_3s_grid/"
+GSHHG_URL = "http://www.soest.hawaii.edu/pwessel/gshhg/gshhg-shp-2.2.4.zip"
+# Members of the archives actually used by load_data (see tile_store.match_members):
+# the ArcInfo grid files of each HydroSHEDS tile, and the hi-res shorelines (L1) and lakes (L2)
+HS_members = ("w001001.adf", "w001001x.adf", "hdr.adf", "dblbnd.adf", "sta.adf", "prj.adf")
+GSHHG_members = ("GSHHS_shp/h/GSHHS_h_L1.*", "GSHHS_shp/h/GSHHS_h_L2.*")
+
+# grass.script, imported by init_grass (it is only available in a GRASS session)
+grass = None
+
+
+def init_grass():
+    '''
+    Check that we are in a GRASS session, and import the GRASS python scripting library
+    '''
+    global grass
+    if "GISBASE" not in os.environ:
+        print "You must be in GRASS GIS to run this program."
+        sys.exit(1)
+    from grass.script import grass
 
 def parse_command_line():
     '''
@@ -75,10 +92,13 @@ def load_configs(conf_file):
         dir_dict[opt] = v
 
     for opt in config.options('Default'):
-        if (opt == 'agg_factor' or opt == 'basin_threshold'):
+        if (opt == 'agg_factor' or opt == 'basin_threshold' or opt == 'download_threads'):
             v = config.getint('Default', opt)
-        else
-            v = config.get('default', opt)
+        elif opt == 'tile_store_size':
+            # In MB in the conf file, bytes for tile_store.evict
+            v = config.getint('Default', opt) * 1024 * 1024
+        else:
+            v = config.get('Default', opt)
 
         default_dict[opt] = v
 
@@ -92,22 +112,20 @@ def make_directories(dir_dict):
     Create the output directories under the work directory
     If work_dir contains a full path, leave it 
     otherwise append the work_dir to user's home directory
-    Returns true unless any make dir fails
+    Returns a dict of the full paths of the directories (raises OSError if any make dir fails)
     '''
     pth = os.path.dirname(dir_dict['work_dir'])
     if not pth:
         pth = os.path.expanduser('~')
 
+    full_paths = {}
     for k,d in dir_dict.iteritems(): 
         new_path = os.path.join(pth,d)
         if not os.path.exists(new_path):
-            try:
-                os.mkdirs(new_path)
-            except OSError, e:
-                raise e
-                return false
+            os.makedirs(new_path)
+        full_paths[k] = new_path
 
-    return True
+    return full_paths
 
 
 def get_geo_corners(geo_em):
@@ -117,7 +135,8 @@ def get_geo_corners(geo_em):
     to cover the whole geo_em.d03.nc region.  
     Use all outer corners to find region, and expand to nearest 5 degress
     Return the lower left corner, the cellsize,
-    and list of pairs of long/lat 5 degree tiles that covers region
+    list of pairs of long/lat 5 degree tiles that covers region,
+    and the bounds of the region: [west, south, east, north]
     '''
     nc = netCDF4.Dataset(geo_em, 'r')
     corner_lats = getattr(nc,'corner_lats')
@@ -143,7 +162,8 @@ def get_geo_corners(geo_em):
         for tile_lat in range(tile_min_lt, tile_max_lt, 5):
             tile_list.append([tile_lon, tile_lat])
 
-    return ll_corner, tile_list, cellsize
+    bounds = [min_ln, min_lt, max_ln, max_lt]
+    return ll_corner, tile_list, cellsize, bounds
 
 
 def get_hydrosheds_tilename(t):
@@ -163,22 +183,24 @@ def get_hydrosheds_tilename(t):
     else:
         lon_prefix="e"
         
-    # Longitude values must be formatted with 3 places
+    # Latitude values are formatted with 2 places, longitude values with 3 places (i.e. n05e030)
     # Use abs() to return absolute values for neg coordinates
-    req_tile = ("%s%s%%s" % (lat_prefix, abs(t[1]), lon_prefix, "{0:0>3}".format(abs(t[0))))
+    req_tile = "%s%s%s%s" % (lat_prefix, "{0:0>2}".format(abs(t[1])), lon_prefix, "{0:0>3}".format(abs(t[0])))
     tile_name = req_tile + file_ext
 
-    # Now Find the continent:
-    if t[0]>=55:                                # Asia
-        continent_subdir = "AS/"
-    if (t[0]<=55 and t[0]>-10 and t[1]>=10):    # Europe
-        continent_subdir = "EU/"
-    if (t[0]<=35 and t[1]<=50 and t[0]>=-10):   # Africa
-        continent_subdir = "AF/"
-    if (t[0]<-50 and t[1]>=20):                 # North America
-        continent_subdir = "NA/"
+    # Now Find the continent (where the regions overlap, the later test in this order wins:
+    # Africa over Europe, Europe over Asia)
+    continent_subdir = None
     if (t[0]<-50 and t[1]<=10):                 # South America
         continent_subdir = "SA/"
+    elif (t[0]<-50 and t[1]>=20):               # North America
+        continent_subdir = "NA/"
+    elif (t[0]<=35 and t[1]<=50 and t[0]>=-10): # Africa
+        continent_subdir = "AF/"
+    elif (t[0]<=55 and t[0]>-10 and t[1]>=10):  # Europe
+        continent_subdir = "EU/"
+    elif t[0]>=55:                              # Asia
+        continent_subdir = "AS/"
     else:
         grass.message("Tiles not found, please download maually")
 
@@ -186,101 +208,265 @@ def get_hydrosheds_tilename(t):
 
 
 
-def get_hydrosheds(tile_list,hydrosheds_dir):
+def fetch_into_store(urls, store_dir, members=None, threads=tile_download.DOWNLOAD_THREADS, checksums=None):
+    '''
+    Resolve a list of archive urls against the shared tile store (tile_store.py)
+    Download and add to the store only the archives it does not have yet,
+    then extract the members in the manifest (in parallel) where not done before
+    Returns the list of urls that failed
+    '''
+    names = [os.path.basename(u) for u in urls]
+    found, missing = tile_store.resolve(store_dir, names, members)
+    incoming = os.path.join(store_dir, "incoming")
+    if not os.path.isdir(incoming):
+        os.makedirs(incoming)
+    jobs = [(u, os.path.join(incoming, os.path.basename(u))) for u in urls if os.path.basename(u) in missing]
+    if not jobs:
+        return []
+
+    done, failed = tile_download.download_all(jobs, threads, checksums)
+    for d in done:
+        tile_store.add(store_dir, d, extract=False)
+    tile_store.resolve(store_dir, names, members, threads)
+    return [f[0] for f in failed]
+
+
+def get_hydrosheds(tile_list,hydrosheds_dir,base_url=HS_baseURL,threads=tile_download.DOWNLOAD_THREADS,checksums=None,
+                   store_dir=None,store_limit=None):
     '''
     Use the tile_list to download dem tiles from Hydrosheds website:
     http://earlywarning.usgs.gov/hydrosheds/dataavail.php
     The tile_list variable contains a list of pairs of long/lat
+    Tiles are downloaded in parallel (tile_download.py), tiles already downloaded
+    and valid are skipped, and partial downloads are resumed
+    base_url can point to a mirror (or a local test server)
+    checksums is an optional dict of tile file name: md5
+    If store_dir is set, the tiles are taken from that shared tile store (tile_store.py), 
+    only missing tiles are downloaded and extracted, and hydrosheds_dir gets links to the tiles.
+    The store is then trimmed to store_limit bytes (least recently used tiles first)
     '''
-    HS_baseURL = "http://earlywarning.usgs.gov/hydrodata/sa_con_3s_grid/"
+    urls = []
     for t in tile_list:
         continent_subdir, tile_name = get_hydrosheds_tilename(t)
-        requrl = HS_baseURL + continent_subdir + tile_name
-        try: 
-            f = urllib2.urlopen(req_url)
-            f_out = open(os.path.join(hydrosheds_dir,tile_name), 'wb')
-            msg = "Downloading: %s" % tile_name
-            grass.message(msg)
-            f_out.write(f.read())
-            f_out.close()
-        except HTTPError, e:
-            print "HTTP Error:", e.code, req_url
-            return False
-        except URLError, e:
-            print "URL error:", e.reason, req_url
+        if continent_subdir is None:
+            grass.message("Tile %s is outside the HydroSHEDS continents, skipped" % tile_name)
+            continue
+        urls.append(base_url + continent_subdir + tile_name)
+
+    if store_dir:
+        failed = fetch_into_store(urls, store_dir, HS_members, threads, checksums)
+        for req_url in failed:
+            grass.message("Download failed: %s" % req_url)
+        if failed:
             return False
+        names = [os.path.basename(u) for u in urls]
+        tile_store.link_into(store_dir, names, hydrosheds_dir, HS_members)
+        if store_limit:
+            tile_store.evict(store_dir, store_limit, keep=names)
+        return True
+
+    jobs = [(u, os.path.join(hydrosheds_dir, os.path.basename(u))) for u in urls]
+    done, failed = tile_download.download_all(jobs, threads, checksums)
+    for req_url, err in failed:
+        grass.message("Download failed: %s %s" % (req_url, err))
+    if failed:
+        return False
 
-    for z in os.listdir(hydrosheds_dir):
-        zf = zipfile.ZipFile(os.path.join(hydrosheds_dir, z), 'r')
-        for zi in zf.infolist():
-            msg = "Unzipping: %s. Uncompressed size: %s" % (zi.filename, zi.file_size)
-            grass.message(msg)
-            zf.extract(zi, hydrosheds_dir)
+    # Extract, in parallel, only the grid files of the tiles of this tile list
+    # and only those not extracted before
+    n = tile_store.extract_many([(z, hydrosheds_dir, HS_members) for z in done], threads, skip_existing=True)
+    grass.message("Extracted %s files from %s tiles" % (n, len(done)))
         
     return True
 
 
 
-def get_land_lakes(hydrosheds_dir):
+def get_land_lakes(hydrosheds_dir, gshhg_URL=GSHHG_URL, store_dir=None):
     '''
     Download land and lakes shapefiles from GHSSG website:
     http://www.soest.hawaii.edu/pwessel/gshhg/gshhg-shp-2.2.4.zip
     Use to mask out ocean and lakes from the hydrosheds DEM
+    If store_dir is set, the archive is taken from the shared tile store (see get_hydrosheds)
     '''
 
-    gshhg_URL   = 'http://www.soest.hawaii.edu/pwessel/gshhg/gshhg-shp-2.2.4.zip'
-    gshhg_zip       = 'gshhg-shp-2.2.4.zip'  
-    gshhg_path   = os.path.join(hydrosheds_dir, gshhg_zip)
+    gshhg_zip   = os.path.basename(gshhg_URL)
+    gshhg_path  = os.path.join(hydrosheds_dir, gshhg_zip)
+    msg = "Downloading: %s" % gshhg_zip
+    grass.message(msg)
+    if store_dir:
+        if fetch_into_store([gshhg_URL], store_dir, GSHHG_members):
+            print "Download failed:", gshhg_URL
+            return False
+        tile_store.link_into(store_dir, [gshhg_zip], hydrosheds_dir, GSHHG_members)
+        return True
+
     try:
-        f = urllib2.urlopen(gshhg_URL)
-        f_out = open(gsshg_path, 'wb')
-        msg = "Downloading: %s" % gsshg_zip
-        grass.message(msg)
-        f_out.write(f.read())
-        f_out.close()
-    except HTTPError, e:
-        print "HTTP Error:", e.code, gshhg_URL
-        return False
-    except URLError, e:
-        print "URL error:", e.reason, gshhg_URL
+        tile_download.download_file(gshhg_URL, gshhg_path)
+    except IOError, e:
+        print "Download failed:", str(e)
         return False
 
-    zf = zipfile.ZipFile(gsshg_path, 'r')
-    for zi in zf.infolist():
-        msg = "Unzipping: %s Uncompressed size: %s" % (zi.filename, zi.file_size)
-        grass.message(msg)
-        zf.extract(zi, hydrosheds_dir)
-
+    # Only the hi-res L1 and L2 shapefiles, not all resolutions and formats
+    n = tile_store.extract_members(gshhg_path, hydrosheds_dir, GSHHG_members, skip_existing=True)
+    grass.message("Extracted %s files from %s" % (n, gshhg_zip))
     return True
 
 
-def load_data(ll_corner):
+def list_dem_tiles(hs_dir):
+    """
+    Find the DEM grid (w001001.adf) of each extracted HydroSHEDS tile in hs_dir
+    Tiles are extracted as <tile>/<tile>/w001001.adf
+    """
+    adf = "w001001.adf"
+    tiles = []
+    for d in sorted(os.listdir(hs_dir)):
+        in_adf = os.path.join(hs_dir, d, d, adf)
+        if os.path.isfile(in_adf):
+            tiles.append(in_adf)
+    return tiles
+
+
+def clip_dem_vrt(hs_dir, bounds, margin=0.1):
+    """
+    Build a GDAL virtual mosaic (VRT) over all the HydroSHEDS tiles,
+    and a second VRT with only the window covering bounds [west, south, east, north] plus a margin (degrees)
+    The window is snapped to whole pixels of the mosaic, so no resampling is done
+    Nothing is copied: r.in.gdal on the clipped VRT reads only the tile blocks inside the window
+    Requires GDAL >= 2.1 (gdal.BuildVRT and gdal.Translate)
+    Returns the path of the clipped VRT
+    """
+    tiles = list_dem_tiles(hs_dir)
+    if not tiles:
+        grass.message("No DEM tiles found in %s" % hs_dir)
+        return None
+    mosaic_vrt = os.path.join(hs_dir, "hydrosheds_mosaic.vrt")
+    clip_vrt = os.path.join(hs_dir, "hydrosheds_clip.vrt")
+    ds = gdal.BuildVRT(mosaic_vrt, tiles)
+    gt = ds.GetGeoTransform()
+    # Pixel window of the region (gt[5] is negative: rows count down from the north)
+    x_off = max(0, int(math.floor((bounds[0] - margin - gt[0]) / gt[1])))
+    y_off = max(0, int(math.floor((bounds[3] + margin - gt[3]) / gt[5])))
+    x_end = min(ds.RasterXSize, int(math.ceil((bounds[2] + margin - gt[0]) / gt[1])))
+    y_end = min(ds.RasterYSize, int(math.ceil((bounds[1] - margin - gt[3]) / gt[5])))
+    msg = "Clipping DEM mosaic (%s x %s) to window of %s x %s cells" % (ds.RasterXSize, ds.RasterYSize, x_end - x_off, y_end - y_off)
+    grass.message(msg)
+    clip_ds = gdal.Translate(clip_vrt, ds, format='VRT', srcWin=[x_off, y_off, x_end - x_off, y_end - y_off])
+    # Close (and flush) the VRT files
+    clip_ds = None
+    ds = None
+    return clip_vrt
+
+
+def gshhs_layer(shp_path, bounds):
+    """
+    Open a GSHHS shapefile, and filter its polygons to the bounds [west, south, east, north]
+    A spatial index (.qix) is created the first time, so the filter does not scan the global dataset
+    Returns the datasource (keep a reference while using the layer) and the layer
+    """
+    if not os.path.isfile(os.path.splitext(shp_path)[0] + ".qix"):
+        try:
+            ds = ogr.Open(shp_path, 1)
+            lyr_name = ds.GetLayer(0).GetName()
+            ds.ExecuteSQL("CREATE SPATIAL INDEX ON %s" % lyr_name)
+            ds = None
+        except (AttributeError, RuntimeError):
+            # Read only directory: filter without the index
+            pass
+    ds = ogr.Open(shp_path)
+    lyr = ds.GetLayer(0)
+    lyr.SetSpatialFilterRect(bounds[0], bounds[1], bounds[2], bounds[3])
+    return ds, lyr
+
+
+def mask_dem(dem_path, gshhs_path, out_tif):
+    """
+    Mask out the oceans and lakes from the DEM, without GRASS vector processing:
+    the GSHHS land (L1) polygons are rasterized with value 1, then the lake (L2) polygons with 0,
+    directly onto the DEM grid, using only the polygons inside the DEM extent.
+    The DEM cells outside the land mask are set to NoData with numpy, and written to out_tif
+    Returns the number of land cells
+    """
+    dem_ds = gdal.Open(dem_path)
+    gt = dem_ds.GetGeoTransform()
+    ncols, nrows = dem_ds.RasterXSize, dem_ds.RasterYSize
+    bounds = [gt[0], gt[3] + nrows*gt[5], gt[0] + ncols*gt[1], gt[3]]
+    mask_ds = gdal.GetDriverByName('MEM').Create('', ncols, nrows, 1, gdal.GDT_Byte)
+    mask_ds.SetGeoTransform(gt)
+    mask_ds.SetProjection(dem_ds.GetProjection())
+    for shp, burn in (('GSHHS_h_L1.shp', 1), ('GSHHS_h_L2.shp', 0)):
+        shp_ds, lyr = gshhs_layer(os.path.join(gshhs_path, shp), bounds)
+        gdal.RasterizeLayer(mask_ds, [1], lyr, burn_values=[burn])
+        shp_ds = None
+    land = mask_ds.GetRasterBand(1).ReadAsArray() == 1
+
+    band = dem_ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    if nodata is None:
+        nodata = -32768
+    dem = band.ReadAsArray()
+    dem[~land] = nodata
+    out_ds = gdal.GetDriverByName('GTiff').Create(out_tif, ncols, nrows, 1, band.DataType, ['TILED=YES'])
+    out_ds.SetGeoTransform(gt)
+    out_ds.SetProjection(dem_ds.GetProjection())
+    out_band = out_ds.GetRasterBand(1)
+    out_band.SetNoDataValue(nodata)
+    out_band.WriteArray(dem)
+    out_ds = None
+    dem_ds = None
+    return int(land.sum())
+
+
+def load_data(configs, ll_corner, bounds=None):
     """
     Load into GRASS hydrosheds tiles, lakes and land shapefiles,
     the stations (from csv), the llcorner point ,
     Change header in geo_em_hgt.asc AAIGrid file, and import
+    With configs['dem_mosaic'] == 'vrt' (and the region bounds from get_geo_corners)
+    the tiles are mosaicked and clipped by GDAL, and imported to GRASS in one step.
+    Otherwise each tile is imported, and then patched in GRASS
+    On the vrt path, oceans and lakes are also masked out with GDAL/numpy (mask_dem)
+    if configs['dem_mask'] == 'native'
+    configs is the dict of directories and options from load_configs
+    Returns False if there is no DEM to import
     """
-    global configs
-    ll_coords = "%s|%s" % (llcorner[0], llcorner[1])
+    ll_coords = "%s|%s" % (ll_corner[0], ll_corner[1])
     grass.write_command('v.in.ascii', overwrite=True, output=configs['llcorner_vect'], stdin=ll_coords)
     cols="stat_num integer, stat_name text, longitude double precision, latitude double precision"
     grass.run_command('v.in.ascii', overwrite=True, output=configs['ppoints_vect'], input=configs['stations_csv'], separator=",", columns=cols, x=3, y=4 )
     
     # Import Hydrosheds dems
-    adf = "w001001.adf"
     hs_dir = configs['hydrosheds_dir']
-    for d in os.listdirs(hs_dir):
-        if os.path.isfile(os.path.join(hs_dir,d,d,adf):
-            in_adf = os.path.join(hs_dir, d, d, adf)
+    if configs.get('dem_mosaic', 'grass') == 'vrt' and bounds is not None:
+        clip_vrt = clip_dem_vrt(hs_dir, bounds, float(configs.get('dem_margin', 0.1)))
+        if clip_vrt is None:
+            grass.message("No DEM to import: no HydroSHEDS tiles in %s" % hs_dir)
+            return False
+        if configs.get('dem_mask', 'grass') == 'native':
+            masked_tif = os.path.join(hs_dir, "hydrosheds_dem.tif")
+            gshhs_path = os.path.join(hs_dir, "GSHHS_shp", "h")
+            grass.message("Creating masked DEM")
+            land_cells = mask_dem(clip_vrt, gshhs_path, masked_tif)
+            grass.message("Land cells in DEM: %s" % land_cells)
+            if land_cells == 0:
+                grass.message("No land cells in the DEM of the region: check the GSHHS shapefiles in %s" % gshhs_path)
+                return False
+            grass.run_command('r.in.gdal', input=masked_tif, output='hydrosheds_dem', overwrite=True)
+            grass.run_command('g.region',flags='p', rast='hydrosheds_dem')
+            return True
+        grass.run_command('r.in.gdal', input=clip_vrt, output='hydrosheds_raw', overwrite=True)
+        grass.run_command('g.region',flags='p', rast='hydrosheds_raw')
+    else:
+        for in_adf in list_dem_tiles(hs_dir):
+            d = os.path.basename(os.path.dirname(in_adf))
             grass.run_command('r.in.gdal', input=in_adf, output=d, overwrite=True)
 
-    # patch tiles together (first set current region to all tiles
-    hs_tiles = grass.mlist_grouped('rast', pattern="*_con")[configs['mapset']]
-    grass.run_command('g.region',flags='p', rast=hs_tiles )
-    msg = "Patching tiles"
-    grass.message(msg)
-    grass.run_command('r.patch', input=hs_tiles, output='hydrosheds_raw', overwrite=True)
-    grass.run_command('g.mremove', flags='f', rast=hs_tiles)
+        # patch tiles together (first set current region to all tiles
+        hs_tiles = grass.mlist_grouped('rast', pattern="*_con")[configs['mapset']]
+        grass.run_command('g.region',flags='p', rast=hs_tiles )
+        msg = "Patching tiles"
+        grass.message(msg)
+        grass.run_command('r.patch', input=hs_tiles, output='hydrosheds_raw', overwrite=True)
+        grass.run_command('g.mremove', flags='f', rast=hs_tiles)
 
     # Import GSHHG vectors
     gshhs_dir = "GSHHS_shp"
@@ -289,13 +475,13 @@ def load_data(ll_corner):
     # Get two layers: L1 are the shorelines, and L2 the lakes
     shps = ['GSHHS_h_L1.shp','GSHHS_h_L2.shp']
     land_path = os.path.join(gshhs_path, shps[0])
-    lakes_path = os.pathjoin(gshhs_path, shps[1])
+    lakes_path = os.path.join(gshhs_path, shps[1])
     grass.run_command('v.in.ogr', dsn=land_path, output='continents', snap=0.001, min_area=10, overwrite=True )
     grass.run_command('v.in.ogr', dsn=lakes_path, output='lakes', snap=0.01, overwrite=True )
     # Use overlay to cut lakes from land areas, then convert to raster
     # Use the raster as a mask to cut out oceans and lakes from the dem
-    grass.run_command('v.overlay', flags='t', overwrite=True, ainput='continents', binput='lakes', out='land', operator=not)
-    grass.run_command('v.to.rast', input='land', output='land_mask', use=val, val=1)
+    grass.run_command('v.overlay', flags='t', overwrite=True, ainput='continents', binput='lakes', out='land', operator='not')
+    grass.run_command('v.to.rast', input='land', output='land_mask', use='val', val=1)
     grass.run_command('r.mask', raster='land_mask')
     expr = "hydrosheds_dem = hydrosheds_raw" 
     grass.message("Creating masked DEM")
@@ -306,20 +492,19 @@ def load_data(ll_corner):
     return True
 
 
-def convert_to_lcc():
+def convert_to_lcc(configs):
     '''
     Switch GRASS to LCC Location, and project layers point to this CRS:
     llcorner, stations
     Set region to dem (from WGS84 Locations) and then project dem into LCC Location.
     '''
-    global configs
     map = configs['mapset']
-    lccloc = config['lcc_location']
-    wgsloc = config['wgs_location']
+    lccloc = configs['lcc_location']
+    wgsloc = configs['wgs_location']
     llcorner = configs['llcorner_vect']
     stations = configs['ppoints_vect']
     ascii_dir = configs['ascii_dir']
-    grass.run_command('g.mapset', mapset=map, location=loc)
+    grass.run_command('g.mapset', mapset=map, location=lccloc)
     # ReProject llcorner vector point, and station locations to this LOCATION
     grass.run_command('v.proj', input=llcorner, location=wgsloc, mapset=map)
     grass.run_command('v.proj', input=stations, location=wgsloc, mapset=map)
@@ -333,14 +518,14 @@ def convert_to_lcc():
     # Convert geo_em.d03.nc to AAIGrid,
     # Replace values in header of the file, and import 
     geo_em = configs['geo_em']
-    geo_netcdf = "NETCDF:%s:HGT_M" %s geo_em
-    geo_em_base = os.path.splitext(os.path.basename(geo_em)[0]
+    geo_netcdf = "NETCDF:%s:HGT_M" % geo_em
+    geo_em_base = os.path.splitext(os.path.basename(geo_em))[0]
     geo_em_asc = os.path.join(ascii_dir, geo_em_base+'.asc')
-    os.system("gdal_translate -of AAIGrid -a_nodata -9999 %s %s" % (geo_netcdf, geo_em_asc) 
+    os.system("gdal_translate -of AAIGrid -a_nodata -9999 %s %s" % (geo_netcdf, geo_em_asc))
     
     return True
 
-def convert_geo_aaigrid(geo_em, asc_dir, llcorner, cellsize, agg_factor)
+def convert_geo_aaigrid(geo_em, asc_dir, llcorner, cellsize, agg_factor):
     """
     Use GDAL to convert geo_em.d03.nc HGT variable to AAIGrid format
     Replace the xllcorner and yllcorner values, as well as the cellsize in the AAIGrid header
@@ -377,4 +562,38 @@ def convert_to_wgs84():
     return True
 
 
-
+def main(args):
+    '''
+    Run all the steps, args is the dict from parse_command_line
+    The options of both sections of the conf file, with the full paths of the directories,
+    are passed to the steps as one configs dict
+    '''
+    init_grass()
+    conf_file = args['config_file'] or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prepare_hires.conf')
+    dir_dict, configs = load_configs(conf_file)
+    configs.update(make_directories(dir_dict))
+
+    ll_corner, tile_list, cellsize, bounds = get_geo_corners(configs['geo_em'])
+    if args['download_dem']:
+        checksums = None
+        if configs.get('tile_checksums'):
+            checksums = tile_download.read_manifest(configs['tile_checksums'])
+        store_dir = configs.get('tile_store')
+        if not get_hydrosheds(tile_list, configs['hydrosheds_dir'], configs.get('hydrosheds_url', HS_baseURL),
+                              configs.get('download_threads', tile_download.DOWNLOAD_THREADS), checksums,
+                              store_dir, configs.get('tile_store_size')):
+            return 1
+        if not get_land_lakes(configs['hydrosheds_dir'], GSHHG_URL, store_dir):
+            return 1
+
+    if not load_data(configs, ll_corner, bounds):
+        return 1
+    convert_to_lcc(configs)
+    run_watershed()
+    convert_to_gtiff()
+    convert_to_wgs84()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_command_line()))
@@ -316,7 +316,7 @@ mkdir -p "$WORKDIR"/gtiff
 r.out.gdal -c --o -f in=dem_fill out="$WORKDIR"/gtiff/TOPOGRAPHY.tif format=GTiff type=Int16 createopt="COMPRESS=LZW" nodata=-9999
 r.out.gdal -c --o in=f_dir_arc out="$WORKDIR"/gtiff/FLOWDIRECTION.tif format=GTiff type=Int16 createopt="COMPRESS=LZW" nodata=-9999 
 # Use Int32 datatype for streams, there may be more than 32767 stream reaches!
-r.out.gdal -c --o in=str out="$WORKDIR"/gtiff/CHANNELGRID.tif format=GTiff type=Int32 createopt="COMPRESS=LZW" 
+r.out.gdal -c --o in=str out="$WORKDIR"/gtiff/CHANNELGRID.tif format=GTiff type=Int32 createopt="COMPRESS=LZW" nodata=-9999
 r.out.gdal -c --o in=str_order out="$WORKDIR"/gtiff/STREAMORDER.tif format=GTiff type=Int16 createopt="COMPRESS=LZW" nodata=-9999
 r.out.gdal -c --o in=station_catchments out="$WORKDIR"/gtiff/basn_mask.tif format=GTiff type=Int16 createopt="COMPRESS=LZW" nodata=-9999
 r.out.gdal -c --o in=frxst_pts out="$WORKDIR"/gtiff/frxst_pts.tif format=GTiff type=Int16 createopt="COMPRESS=LZW" nodata=-9999
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+Author:   Micha Silver
+Version:  0.1
+Description:
+  State of the hydrographs.py runs, kept separately for each product ("flows", "precip"):
+  the timestamp of the last data file processed, its directory, and when it was processed.
+  The state is a JSON file, written to a temp file and renamed into place,
+  so a run never reads a partial file.
+  Each product also has an advisory lock (<state file>.<product>.lock), held by the run
+  processing it: an overlapping run skips that product instead of processing the same data again.
+  The kernel releases the locks of a run that dies.
+  A state file that does not exist yet is initialised from the old timestamp file
+  (one timestamp, used by both products).
+
+  Command line:
+    run_state.py <state file>                              print the state
+    run_state.py <state file> -p flows -t <timestamp>      set the last timestamp of a product (i.e. to process again)
+"""
+
+import os, json, time, errno, fcntl, logging, argparse
+
+products = ('flows', 'precip')
+
+
+def lock_file(path, wait=True):
+    """
+    Take an exclusive lock on path; returns the open lock file (pass to unlock_file),
+    or None if the lock is held by another process and wait is False
+    """
+    f = open(path, 'a')
+    flags = fcntl.LOCK_EX
+    if not wait:
+        flags |= fcntl.LOCK_NB
+    try:
+        fcntl.flock(f.fileno(), flags)
+    except IOError as e:
+        f.close()
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return f
+
+
+def unlock_file(f):
+    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    f.close()
+
+
+def lock_product(state_file, product):
+    """
+    Take the lock of a product without waiting
+    Returns the open lock file, or None if another run is processing the product
+    """
+    return lock_file("%s.%s.lock" % (state_file, product), wait=False)
+
+
+def read_legacy_ts(ts_file):
+    """
+    The timestamp in the old timestamp file, 0 if there is none
+    """
+    try:
+        f = open(ts_file, 'r')
+        try:
+            return int(float(f.readline()))
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return 0
+
+
+def empty_state(ts=0):
+    return dict((p, {'last_ts': ts, 'last_dir': None, 'updated': None}) for p in products)
+
+
+def read_state(state_file):
+    f = open(state_file, 'r')
+    try:
+        state = json.load(f)
+    finally:
+        f.close()
+    for p in products:
+        state.setdefault(p, empty_state()[p])
+    return state
+
+
+def save_state(state_file, state):
+    """
+    Write the state to a temp file and rename it into place
+    """
+    tmp = "%s.%s.tmp" % (state_file, os.getpid())
+    f = open(tmp, 'w')
+    try:
+        json.dump(state, f, indent=1, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(tmp, state_file)
+
+
+def load_state(state_file, legacy_ts_file=None):
+    """
+    Read the state: a dict of product -> last_ts, last_dir, updated
+    If there is no state file yet, it is created, with the timestamp of legacy_ts_file for all products
+    A state file that cannot be parsed raises ValueError (rather than processing all the data again)
+    """
+    try:
+        return read_state(state_file)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    lock = lock_file(state_file + ".lock")
+    try:
+        # Another run may have created it meanwhile
+        if os.path.exists(state_file):
+            return read_state(state_file)
+        ts = read_legacy_ts(legacy_ts_file) if legacy_ts_file else 0
+        state = empty_state(ts)
+        save_state(state_file, state)
+        logging.info("Created state file %s (last timestamp %s)", state_file, ts)
+    finally:
+        unlock_file(lock)
+    return state
+
+
+def update_product(state_file, product, last_ts, last_dir):
+    """
+    Record the data processed for one product
+    The state is read again and saved under the lock of the state file,
+    so updates of the other product by a concurrent run are kept
+    """
+    lock = lock_file(state_file + ".lock")
+    try:
+        try:
+            state = read_state(state_file)
+        except IOError:
+            state = empty_state()
+        state[product] = {'last_ts': last_ts, 'last_dir': last_dir, 'updated': time.time()}
+        save_state(state_file, state)
+    finally:
+        unlock_file(lock)
+    logging.debug("State of %s updated to: %s %s", product, last_ts, last_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print or set the state of the hydrographs runs")
+    parser.add_argument("state_file", help="JSON state file")
+    parser.add_argument("-p", "--product", choices=products, help="Product to set")
+    parser.add_argument("-t", "--timestamp", type=int, help="Last timestamp of the product")
+    args = parser.parse_args()
+
+    if args.product and args.timestamp is not None:
+        update_product(args.state_file, args.product, args.timestamp, None)
+    state = read_state(args.state_file)
+    for p in products:
+        s = state[p]
+        updated = time.strftime("%Y-%m-%d %H:%M", time.localtime(s['updated'])) if s['updated'] else "-"
+        print "%s\t%s\t%s\t%s" % (p, s['last_ts'], s['last_dir'], updated)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+Author:   Micha Silver
+Description:
+  Tests of create_netcdf.py: the GeoTIFF input (NoData cells and values out of the
+  range of the NetCDF variables), and the check of the ncdump -hs header. Run with:
+    python -m unittest test_create_netcdf
+  The GeoTIFF build is compared to the AAIGrid build of the same layers,
+  it is skipped if GDAL (osgeo) is not installed
+"""
+
+import os, shutil, tempfile, unittest
+import numpy as np
+from netCDF4 import Dataset
+import create_netcdf
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+nrows, ncols = 20, 30
+xll, yll, cellsize = 1000.0, 2000.0, 100.0
+# NoData of an Int32 GeoTIFF exported by GRASS without nodata=
+int32_nodata = -2147483648
+
+
+def make_layers():
+    """
+    Layer values of a small test domain: dict of variable name: array
+    About a third of the cells are NoData (-9999)
+    """
+    rs = np.random.RandomState(1)
+    nodata = rs.rand(nrows, ncols) < 0.3
+    layers = {}
+    for varname, asc_name, tif_name in create_netcdf.hires_layers:
+        if varname == 'LAKEGRID':
+            continue
+        kk = rs.randint(1, 500, (nrows, ncols)).astype(np.int32)
+        kk[nodata] = -9999
+        layers[varname] = kk
+    # Stream reach ids up to near the top of the Int16 range (an Int32 GeoTIFF)
+    layers['CHANNELGRID'] = np.where(nodata, -9999, rs.randint(1, 30000, (nrows, ncols))).astype(np.int32)
+    return layers
+
+
+# ncdump -hs header of a NETCDF4 hires file
+nc4_header = """netcdf b {
+dimensions:
+	y = 60 ;
+	x = 90 ;
+variables:
+	float TOPOGRAPHY(y, x) ;
+		TOPOGRAPHY:_FillValue = -9999.f ;
+		TOPOGRAPHY:coordinates = "x y" ;
+		TOPOGRAPHY:_Storage = "chunked" ;
+		TOPOGRAPHY:_ChunkSizes = 60, 90 ;
+		TOPOGRAPHY:_DeflateLevel = 4 ;
+		TOPOGRAPHY:_Shuffle = "true" ;
+
+// global attributes:
+		:grid_key = "a:_b" ;
+		:_Format = "netCDF-4" ;
+}
+"""
+
+
+def write_asc(filename, kk):
+    f = open(filename, 'w')
+    f.write("ncols %s\nnrows %s\nxllcorner %s\nyllcorner %s\ncellsize %s\nNODATA_value -9999\n"
+            % (ncols, nrows, int(xll), int(yll), int(cellsize)))
+    for row in kk:
+        f.write(" ".join(str(v) for v in row) + "\n")
+    f.close()
+
+
+def write_tif(filename, kk, gdal_type, nodata):
+    drv = gdal.GetDriverByName('GTiff')
+    ds = drv.Create(filename, ncols, nrows, 1, gdal_type)
+    ds.SetGeoTransform((xll, cellsize, 0, yll + cellsize * nrows, 0, -cellsize))
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(nodata)
+    band.WriteArray(np.where(kk == -9999, nodata, kk))
+    ds = None
+
+
+def write_geofile(filename):
+    geo = Dataset(filename, 'w')
+    geo.setncattr('STAND_LON', 35.0)
+    geo.setncattr('TRUELAT1', 30.0)
+    geo.setncattr('TRUELAT2', 60.0)
+    geo.setncattr('CEN_LAT', 31.5)
+    geo.close()
+
+
+def make_domain(work_dir, name, **opts):
+    dom = dict(create_netcdf.domain_defaults)
+    for opt in create_netcdf.int_options:
+        dom[opt] = int(dom[opt])
+    dom.update({'name': name, 'geofile': os.path.join(work_dir, 'geo.nc'), 'agg_factor': 10,
+                'hires_filename': os.path.join(work_dir, name + '.nc'),
+                'basins_txt': os.path.join(work_dir, name + '_basins.txt')})
+    dom.update(opts)
+    return dom
+
+
+class VarValuesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.nc = Dataset(os.path.join(self.work_dir, 'v.nc'), 'w')
+        self.nc.createDimension('x', 4)
+        self.var = self.nc.createVariable('CHANNELGRID', 'i2', ('x',), fill_value=-9999)
+
+    def tearDown(self):
+        self.nc.close()
+        shutil.rmtree(self.work_dir)
+
+    def test_nodata_is_fill_value(self):
+        kk = np.array([int32_nodata, 3, int32_nodata, 7], dtype=np.int32)
+        self.assertEqual(list(create_netcdf.var_values(self.var, kk, float(int32_nodata))), [-9999, 3, -9999, 7])
+
+    def test_out_of_range(self):
+        kk = np.array([1, 2, 40000, 7], dtype=np.int32)
+        self.assertRaises(ValueError, create_netcdf.var_values, self.var, kk)
+
+    def test_min_value(self):
+        kk = np.array([-32768, 0, 5, -9999], dtype=np.int32)
+        self.assertEqual(list(create_netcdf.var_values(self.var, kk, min_value=-9999)), [-9999, 0, 5, -9999])
+
+
+class NcdumpHeaderTest(unittest.TestCase):
+
+    formats = ['classic', '64-bit offset', 'netCDF-4']
+
+    def test_netcdf4(self):
+        self.assertEqual(create_netcdf.check_ncdump_header(nc4_header, self.formats), [])
+
+    def test_format_not_read(self):
+        problems = create_netcdf.check_ncdump_header(nc4_header, ['classic', '64-bit offset'])
+        self.assertEqual(len(problems), 1)
+
+    def test_plugin_filter(self):
+        header = nc4_header.replace('TOPOGRAPHY:_Shuffle = "true" ;', 'TOPOGRAPHY:_Filter = "32015,3" ;')
+        problems = create_netcdf.check_ncdump_header(header, self.formats)
+        self.assertEqual(len(problems), 1)
+        self.assertTrue(problems[0].startswith("TOPOGRAPHY: filter 32015,3"))
+
+    def test_no_format(self):
+        header = nc4_header.replace(':_Format = "netCDF-4" ;', '')
+        self.assertEqual(len(create_netcdf.check_ncdump_header(header, self.formats)), 1)
+
+
+@unittest.skipIf(gdal is None, "GDAL (osgeo) not installed")
+class GeoTiffBuildTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.asc_dir = os.path.join(self.work_dir, 'ascii')
+        self.gtiff_dir = os.path.join(self.work_dir, 'gtiff')
+        os.mkdir(self.asc_dir)
+        os.mkdir(self.gtiff_dir)
+        write_geofile(os.path.join(self.work_dir, 'geo.nc'))
+        self.layers = make_layers()
+        for varname, asc_name, tif_name in create_netcdf.hires_layers:
+            if varname not in self.layers:
+                continue
+            kk = self.layers[varname]
+            write_asc(os.path.join(self.asc_dir, asc_name), kk)
+            if varname == 'CHANNELGRID':
+                write_tif(os.path.join(self.gtiff_dir, tif_name), kk, gdal.GDT_Int32, int32_nodata)
+            else:
+                write_tif(os.path.join(self.gtiff_dir, tif_name), kk, gdal.GDT_Int16, -9999)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_same_as_aaigrid(self):
+        create_netcdf.build_hires(make_domain(self.work_dir, 'asc', asc_dir=self.asc_dir))
+        create_netcdf.build_hires(make_domain(self.work_dir, 'tif', gtiff_dir=self.gtiff_dir))
+        asc = Dataset(os.path.join(self.work_dir, 'asc.nc'))
+        tif = Dataset(os.path.join(self.work_dir, 'tif.nc'))
+        try:
+            for varname in self.layers:
+                a = np.ma.filled(asc.variables[varname][:], -9999)
+                t = np.ma.filled(tif.variables[varname][:], -9999)
+                self.assertTrue(np.array_equal(a, t), varname)
+            # NoData is not a channel (0)
+            channels = np.ma.filled(tif.variables['CHANNELGRID'][:], -9999)
+            self.assertEqual((channels == -9999).sum(), (self.layers['CHANNELGRID'] == -9999).sum())
+        finally:
+            asc.close()
+            tif.close()
+
+    def test_reach_ids_out_of_range(self):
+        kk = self.layers['CHANNELGRID'].copy()
+        kk[0, 0] = 40000
+        write_tif(os.path.join(self.gtiff_dir, 'CHANNELGRID.tif'), kk, gdal.GDT_Int32, int32_nodata)
+        self.assertRaises(ValueError, create_netcdf.build_hires, make_domain(self.work_dir, 'tif', gtiff_dir=self.gtiff_dir))
+
+
+if __name__ == "__main__":
+    unittest.main()
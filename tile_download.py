@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""
+Author:   Micha Silver
+Version:  0.1
+Description:
+  Download manager for the HydroSHEDS tiles (and the GSHHG shorelines) used by prepare_hires.py
+  Files are downloaded by a bounded pool of threads, streamed to disk in chunks
+  as <name>.part, and renamed only when complete and verified.
+  An interrupted download is resumed with an HTTP Range request.
+  Files already present and valid are skipped, and one failed file does not stop the others.
+
+  Validation: the size (from the server, or a checksum manifest) and, when known,
+  the md5 checksum. Zip files without a known checksum are checked with zipfile.
+
+  Command line:
+    tile_download.py -u <base url> -d <target dir> [-m <md5 manifest>] [-t <threads>] file1 file2 ...
+  The manifest, if given, is in md5sum format: "<md5>  <file name>" per line
+"""
+
+import os, sys, time, socket, hashlib, zipfile, logging, argparse
+import urllib2
+from multiprocessing.pool import ThreadPool
+
+# Download chunk size, number of parallel downloads, and retries per file
+CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_THREADS = 4
+RETRIES = 3
+
+
+def read_manifest(manifest_file):
+    """
+    Read an md5sum style manifest: "<md5>  <file name>" on each line
+    Returns a dict of file name: md5
+    """
+    checksums = {}
+    f = open(manifest_file, 'r')
+    for line in f:
+        parts = line.split()
+        if len(parts) == 2:
+            checksums[os.path.basename(parts[1].lstrip('*'))] = parts[0].lower()
+    f.close()
+    return checksums
+
+
+def file_md5(path):
+    h = hashlib.md5()
+    f = open(path, 'rb')
+    try:
+        while True:
+            buf = f.read(CHUNK_SIZE)
+            if not buf:
+                break
+            h.update(buf)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
+def is_valid(path, size=None, md5=None, name=None):
+    """
+    Check a downloaded file against the expected size and md5 (either may be None)
+    Without an md5, zip files are checked for a readable directory and member CRCs
+    name is the file name that sets the type, if path is not the final name (i.e. a .part file)
+    """
+    if not os.path.isfile(path):
+        return False
+    if size is not None and os.path.getsize(path) != size:
+        return False
+    if md5 is not None:
+        return file_md5(path) == md5
+    if (name or path).lower().endswith(".zip"):
+        try:
+            zf = zipfile.ZipFile(path, 'r')
+            try:
+                return zf.testzip() is None
+            finally:
+                zf.close()
+        except (zipfile.BadZipfile, IOError):
+            return False
+    return True
+
+
+def remote_size(url, timeout=60):
+    """
+    Get the size of a remote file with a HEAD request, None if unknown
+    """
+    req = urllib2.Request(url)
+    req.get_method = lambda: 'HEAD'
+    try:
+        resp = urllib2.urlopen(req, timeout=timeout)
+        length = resp.info().getheader('Content-Length')
+        resp.close()
+        return int(length) if length else None
+    except (urllib2.URLError, socket.error, ValueError):
+        return None
+
+
+def fetch(url, part_file, timeout=60):
+    """
+    Stream url into part_file, resuming after the bytes already in part_file
+    if the server honours the Range request (otherwise start again)
+    Returns the total size of the file (None if the server did not say)
+    """
+    offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+    req = urllib2.Request(url)
+    if offset > 0:
+        req.add_header('Range', 'bytes=%d-' % offset)
+    try:
+        resp = urllib2.urlopen(req, timeout=timeout)
+    except urllib2.HTTPError as e:
+        # 416: the part file already holds the whole file
+        if e.code == 416 and offset > 0:
+            return offset
+        raise
+
+    total = None
+    if resp.getcode() == 206:
+        mode = 'ab'
+        content_range = resp.info().getheader('Content-Range')
+        if content_range and '/' in content_range and not content_range.endswith('*'):
+            total = int(content_range.split('/')[-1])
+    else:
+        # Full content: (re)start from the beginning
+        mode = 'wb'
+        offset = 0
+        length = resp.info().getheader('Content-Length')
+        total = int(length) if length else None
+
+    f_out = open(part_file, mode)
+    try:
+        while True:
+            buf = resp.read(CHUNK_SIZE)
+            if not buf:
+                break
+            f_out.write(buf)
+    finally:
+        f_out.close()
+        resp.close()
+    return total
+
+
+def download_file(url, dest, size=None, md5=None, retries=RETRIES, timeout=60):
+    """
+    Download one file to dest, unless dest is already there and valid
+    Interrupted transfers are retried, resuming from the partial file
+    Returns 'skipped' or 'downloaded'. Raises IOError on failure
+    """
+    if os.path.exists(dest):
+        if size is None and md5 is None:
+            size = remote_size(url, timeout)
+        if is_valid(dest, size, md5):
+            logging.info("Already downloaded: %s", dest)
+            return 'skipped'
+        logging.warning("Existing file %s is not valid, downloading again", dest)
+        os.unlink(dest)
+
+    part_file = dest + ".part"
+    last_error = None
+    for attempt in range(retries + 1):
+        try:
+            logging.info("Downloading: %s", url)
+            total = fetch(url, part_file, timeout)
+            if size is None:
+                size = total
+            if is_valid(part_file, size, md5, name=dest):
+                os.rename(part_file, dest)
+                return 'downloaded'
+            # Corrupt: discard and start over
+            last_error = "verification failed"
+            os.unlink(part_file)
+        except urllib2.HTTPError as e:
+            # The file is not on the server: no point retrying
+            if e.code in (403, 404):
+                raise IOError("HTTP Error %s: %s" % (e.code, url))
+            last_error = "HTTP Error %s" % e.code
+        except (urllib2.URLError, socket.error, IOError) as e:
+            last_error = str(e)
+        logging.warning("Download of %s failed (%s), attempt %s of %s", url, last_error, attempt + 1, retries + 1)
+        time.sleep(min(2 ** attempt, 30))
+
+    raise IOError("Download of %s failed: %s" % (url, last_error))
+
+
+def download_all(jobs, threads=DOWNLOAD_THREADS, checksums=None):
+    """
+    Download a list of (url, dest) jobs in a pool of threads
+    checksums is an optional dict of file name: md5 (see read_manifest)
+    Returns two lists: the destination files that are in place, and the (url, error) of failures
+    """
+    checksums = checksums or {}
+
+    def job(j):
+        url, dest = j
+        try:
+            download_file(url, dest, md5=checksums.get(os.path.basename(dest)))
+            return dest, None
+        except (IOError, OSError) as e:
+            logging.error("%s", str(e))
+            return None, (url, str(e))
+
+    pool = ThreadPool(max(1, min(threads, len(jobs))))
+    try:
+        results = pool.map(job, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    done = [r[0] for r in results if r[0] is not None]
+    failed = [r[1] for r in results if r[1] is not None]
+    return done, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download files in parallel, with resume")
+    parser.add_argument("-u", "--base-url", required=True, help="Base url of the files")
+    parser.add_argument("-d", "--target-dir", default=".", help="Directory for the downloaded files")
+    parser.add_argument("-m", "--manifest", help="md5sum style checksum manifest")
+    parser.add_argument("-t", "--threads", type=int, default=DOWNLOAD_THREADS, help="Number of parallel downloads")
+    parser.add_argument("files", nargs='+', help="File names (relative to the base url)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
+    checksums = read_manifest(args.manifest) if args.manifest else None
+    jobs = [(args.base_url.rstrip('/') + '/' + f, os.path.join(args.target_dir, os.path.basename(f))) for f in args.files]
+    done, failed = download_all(jobs, args.threads, checksums)
+    print "Downloaded: %s, failed: %s" % (len(done), len(failed))
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+"""
+Author:   Micha Silver
+Version:  0.1
+Description:
+  Shared store of the downloaded DEM tiles (and GSHHG shoreline archive),
+  used by prepare_hires.py for all the domains built over the same region.
+
+  Layout of the store directory:
+    objects/<md5>.zip       each archive, stored once by its content (md5)
+    extracted/<md5>/...     the extracted rasters of the archive
+    extracted/<md5>.<key>/  the same, when only the members of a manifest are extracted
+    index.json              file name (i.e. n30e035_con_grid.zip) -> md5, sizes, last use
+  A domain's hydrosheds_dir gets symbolic links to the extracted tiles,
+  so only tiles missing from the store are downloaded and extracted.
+  Extraction can be limited to a manifest of the needed members (i.e. w001001.adf and its
+  sidecar files) and runs in parallel across archives.
+  When the store grows beyond its size limit, the least recently used tiles are evicted.
+  The index is updated under an advisory lock, so builds can share the store concurrently.
+
+  Command line:
+    tile_store.py -s <store dir> [-l <size limit MB>]     list the store (and evict down to the limit)
+"""
+
+import os, time, json, glob, shutil, hashlib, fcntl, fnmatch, zipfile, logging, argparse
+from multiprocessing.pool import ThreadPool
+
+index_name = "index.json"
+lock_name = ".lock"
+# Number of archives extracted in parallel
+EXTRACT_THREADS = 4
+
+
+def lock_store(store_dir):
+    """
+    Take the exclusive lock of the store; returns the open lock file (pass to unlock_store)
+    """
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    f = open(os.path.join(store_dir, lock_name), 'a')
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    return f
+
+
+def unlock_store(lock_file):
+    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    lock_file.close()
+
+
+def load_index(store_dir):
+    """
+    Read the index of the store, an empty index if there is none yet
+    """
+    try:
+        f = open(os.path.join(store_dir, index_name), 'r')
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return {'tiles': {}}
+
+
+def save_index(store_dir, index):
+    """
+    Write the index to a temp file and rename it into place
+    """
+    path = os.path.join(store_dir, index_name)
+    tmp = "%s.%s.tmp" % (path, os.getpid())
+    f = open(tmp, 'w')
+    json.dump(index, f, indent=1, sort_keys=True)
+    f.close()
+    os.rename(tmp, path)
+
+
+def file_md5(path):
+    h = hashlib.md5()
+    f = open(path, 'rb')
+    try:
+        while True:
+            buf = f.read(1024 * 1024)
+            if not buf:
+                break
+            h.update(buf)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
+def dir_size(path):
+    total = 0
+    for root, dirs, fnames in os.walk(path):
+        for f in fnames:
+            total += os.path.getsize(os.path.join(root, f))
+    return total
+
+
+def members_key(members):
+    """
+    Short key of a members manifest (None for the whole archive)
+    """
+    if not members:
+        return None
+    return hashlib.md5("\n".join(sorted(members))).hexdigest()[:8]
+
+
+def extracted_dir(store_dir, md5, members=None):
+    key = members_key(members)
+    if key is None:
+        return os.path.join(store_dir, "extracted", md5)
+    return os.path.join(store_dir, "extracted", md5 + "." + key)
+
+
+def match_members(names, members=None):
+    """
+    Select the member names of an archive that match a manifest:
+    a list of fnmatch patterns, matched against the full member path if the pattern
+    has a "/", otherwise against the base name (i.e. "w001001.adf" or "GSHHS_shp/h/GSHHS_h_L1.*")
+    With no manifest, all members are selected
+    """
+    if not members:
+        return [n for n in names if not n.endswith('/')]
+    selected = []
+    for n in names:
+        if n.endswith('/'):
+            continue
+        base = n.rsplit('/', 1)[-1]
+        for m in members:
+            if fnmatch.fnmatch(n if '/' in m else base, m):
+                selected.append(n)
+                break
+    return selected
+
+
+def extract_members(zip_path, dest_dir, members=None, skip_existing=False):
+    """
+    Extract the members of a zip archive that match the manifest (see match_members) into dest_dir
+    With skip_existing=True members already in dest_dir with the same size are not extracted again
+    Returns the number of members extracted
+    """
+    zf = zipfile.ZipFile(zip_path, 'r')
+    count = 0
+    try:
+        infos = dict((zi.filename, zi) for zi in zf.infolist())
+        for n in match_members(sorted(infos), members):
+            zi = infos[n]
+            if skip_existing:
+                path = os.path.join(dest_dir, n)
+                if os.path.isfile(path) and os.path.getsize(path) == zi.file_size:
+                    continue
+            logging.debug("Unzipping: %s. Uncompressed size: %s", n, zi.file_size)
+            zf.extract(zi, dest_dir)
+            count += 1
+    finally:
+        zf.close()
+    return count
+
+
+def extract_many(jobs, threads=EXTRACT_THREADS, skip_existing=False):
+    """
+    Run extract_members for a list of (zip_path, dest_dir, members) jobs in a pool of threads
+    (zlib and file I/O release the GIL, so archives are extracted in parallel)
+    Returns the total number of members extracted
+    """
+    if not jobs:
+        return 0
+    pool = ThreadPool(max(1, min(threads, len(jobs))))
+    try:
+        counts = pool.map(lambda j: extract_members(j[0], j[1], j[2], skip_existing), jobs)
+    finally:
+        pool.close()
+        pool.join()
+    return sum(counts)
+
+
+def extract_archive(zip_path, dest_dir, members=None):
+    """
+    Extract the members of a zip archive matching the manifest (all members if None)
+    into dest_dir, via a temp directory renamed when complete
+    """
+    tmp_dir = "%s.%s.tmp" % (dest_dir, os.getpid())
+    extract_members(zip_path, tmp_dir, members)
+    if not os.path.isdir(tmp_dir):
+        # Nothing matched the manifest
+        os.makedirs(tmp_dir)
+    os.rename(tmp_dir, dest_dir)
+
+
+def extracted_size(store_dir, md5):
+    """
+    Size of all extracted copies (whole archive or manifests) of one archive
+    """
+    return sum(dir_size(d) for d in glob.glob(os.path.join(store_dir, "extracted", md5 + "*")))
+
+
+def resolve(store_dir, names, members=None, threads=EXTRACT_THREADS):
+    """
+    Look up a list of archive names (i.e. tile zip file names) in the store index
+    Archives in the store that were not yet extracted for this manifest of members
+    are extracted now (in parallel), without downloading them again
+    Returns a dict of the names in the store: name -> directory of the extracted files,
+    and the list of names missing from the store
+    """
+    index = load_index(store_dir)
+    found = {}
+    missing = []
+    jobs = []
+    for name in names:
+        entry = index['tiles'].get(name)
+        if entry is None:
+            missing.append(name)
+            continue
+        out_dir = extracted_dir(store_dir, entry['md5'], members)
+        obj_path = os.path.join(store_dir, "objects", entry['md5'] + ".zip")
+        if os.path.isdir(out_dir):
+            found[name] = out_dir
+        elif os.path.isfile(obj_path):
+            jobs.append((name, obj_path, out_dir))
+        else:
+            missing.append(name)
+
+    if jobs:
+        lock = lock_store(store_dir)
+        try:
+            todo = [j for j in jobs if not os.path.isdir(j[2])]
+            pool = ThreadPool(max(1, min(threads, len(todo) or 1)))
+            try:
+                pool.map(lambda j: extract_archive(j[1], j[2], members), todo)
+            finally:
+                pool.close()
+                pool.join()
+            index = load_index(store_dir)
+            for name, obj_path, out_dir in jobs:
+                found[name] = out_dir
+                if name in index['tiles']:
+                    index['tiles'][name]['extracted_size'] = extracted_size(store_dir, index['tiles'][name]['md5'])
+            save_index(store_dir, index)
+        finally:
+            unlock_store(lock)
+    return found, missing
+
+
+def add(store_dir, zip_path, name=None, members=None, extract=True):
+    """
+    Add a downloaded archive to the store under name (default the file name):
+    move it into objects/<md5>.zip, extract it (once per content and manifest) and record it in the index
+    With extract=False the extraction is left to resolve() (which extracts several archives in parallel)
+    Returns the directory of the extracted files
+    """
+    name = name or os.path.basename(zip_path)
+    md5 = file_md5(zip_path)
+    obj_dir = os.path.join(store_dir, "objects")
+    if not os.path.isdir(obj_dir):
+        os.makedirs(obj_dir)
+    obj_path = os.path.join(obj_dir, md5 + ".zip")
+
+    lock = lock_store(store_dir)
+    try:
+        if os.path.exists(obj_path):
+            os.unlink(zip_path)
+        else:
+            shutil.move(zip_path, obj_path)
+        out_dir = extracted_dir(store_dir, md5, members)
+        if extract and not os.path.isdir(out_dir):
+            logging.info("Extracting %s into the tile store", name)
+            extract_archive(obj_path, out_dir, members)
+        index = load_index(store_dir)
+        index['tiles'][name] = {'md5': md5, 'size': os.path.getsize(obj_path),
+                                'extracted_size': extracted_size(store_dir, md5), 'last_used': time.time()}
+        save_index(store_dir, index)
+    finally:
+        unlock_store(lock)
+    return out_dir
+
+
+def touch(store_dir, names):
+    """
+    Mark archives as used now (for the LRU eviction)
+    """
+    lock = lock_store(store_dir)
+    try:
+        index = load_index(store_dir)
+        now = time.time()
+        for name in names:
+            if name in index['tiles']:
+                index['tiles'][name]['last_used'] = now
+        save_index(store_dir, index)
+    finally:
+        unlock_store(lock)
+
+
+def link_into(store_dir, names, target_dir, members=None):
+    """
+    Make symbolic links in target_dir to the top level entries of the extracted archives
+    (i.e. target_dir/n30e035_con -> store/extracted/<md5>/n30e035_con)
+    Links left dangling in target_dir by tiles evicted since an earlier build are removed
+    Returns the list of links
+    """
+    found, missing = resolve(store_dir, names, members)
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+    for entry in os.listdir(target_dir):
+        link = os.path.join(target_dir, entry)
+        if os.path.islink(link) and not os.path.exists(link):
+            logging.info("Removing dangling link to an evicted tile: %s", link)
+            os.unlink(link)
+    links = []
+    for name, src_dir in found.iteritems():
+        for entry in os.listdir(src_dir):
+            link = os.path.join(target_dir, entry)
+            if os.path.islink(link):
+                os.unlink(link)
+            if not os.path.exists(link):
+                os.symlink(os.path.abspath(os.path.join(src_dir, entry)), link)
+            links.append(link)
+    touch(store_dir, found.keys())
+    return links
+
+
+def store_size(index):
+    """
+    Size of the store: each content (md5) is counted once, whatever the number of names it is recorded under
+    """
+    sizes = dict((e['md5'], e['size'] + e.get('extracted_size', 0)) for e in index['tiles'].itervalues())
+    return sum(sizes.itervalues())
+
+
+def evict(store_dir, max_bytes, keep=()):
+    """
+    Remove the least recently used archives (and their extracted files)
+    until the store is no larger than max_bytes. Archives named in keep are never removed
+    Links to the evicted tiles in the domains' directories are left dangling: link_into removes them
+    Returns the list of evicted names
+    """
+    lock = lock_store(store_dir)
+    evicted = []
+    try:
+        index = load_index(store_dir)
+        total = store_size(index)
+        for name, entry in sorted(index['tiles'].items(), key=lambda t: t[1]['last_used']):
+            if total <= max_bytes:
+                break
+            if name in keep:
+                continue
+            del index['tiles'][name]
+            # The same content may be recorded under another name: it is kept, and still counts
+            if not any(e['md5'] == entry['md5'] for e in index['tiles'].itervalues()):
+                obj_path = os.path.join(store_dir, "objects", entry['md5'] + ".zip")
+                if os.path.exists(obj_path):
+                    os.unlink(obj_path)
+                for d in glob.glob(os.path.join(store_dir, "extracted", entry['md5'] + "*")):
+                    shutil.rmtree(d, ignore_errors=True)
+                total -= entry['size'] + entry.get('extracted_size', 0)
+            evicted.append(name)
+            logging.info("Evicted from the tile store: %s", name)
+        save_index(store_dir, index)
+    finally:
+        unlock_store(lock)
+    return evicted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List the tile store, and evict tiles down to a size limit")
+    parser.add_argument("-s", "--store-dir", required=True, help="Tile store directory")
+    parser.add_argument("-l", "--limit", type=int, help="Size limit in MB")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
+    if args.limit is not None:
+        evict(args.store_dir, args.limit * 1024 * 1024)
+    index = load_index(args.store_dir)
+    for name, e in sorted(index['tiles'].items()):
+        print "%s\t%s\t%.1f MB\t%s" % (name, e['md5'], (e['size'] + e.get('extracted_size', 0)) / 1048576.0,
+                                        time.strftime("%Y-%m-%d %H:%M", time.localtime(e['last_used'])))
+    print "Total: %.1f MB" % (store_size(index) / 1048576.0)
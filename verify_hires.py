@@ -9,62 +9,91 @@ All values are saved into an array, and finally exported to the output file
 
 import netCDF4
 import numpy as np
-import sys,math,os
+import os
 import argparse
+import nc3mmap
 
-# Command line arguments
-parser = argparse.ArgumentParser(description="Analyze gis_hires netCDF file", usage='%(prog)s [options]')
-parser.add_argument("-i","--input", dest="in_nc", help="The path/name of the netCDF input file", nargs='?', type=argparse.FileType('r'), required=True)
-parser.add_argument("-o", "--output", dest="out_txt", default="drain_pts.txt", help="The path/name for the output text file", nargs='?', type=argparse.FileType('w'))
-args = parser.parse_args()
-ncfile = args.in_nc.name
-outfile = args.out_txt.name
+def hires_reader(ncfile):
+	"""
+	Returns two functions for the gis_hires file: get_var(name), the variable flipped
+	(ordered from bottom to top) and get_fill(name), its fill value, and the open Dataset
+	"""
+	nc = netCDF4.Dataset(ncfile, 'r')
+	# Use numpy flipud function to get arrays ordered from bottom to top
+	# So that drain point id's will be the same as WRF-Hydro
+	# Classic (NETCDF3) files are memory mapped with nc3mmap: flipud is then only a view,
+	# and just the cells at the drain points are read from the other variables
+	if nc3mmap.is_classic(ncfile):
+		header = nc3mmap.read_header(ncfile)
+		def get_var(name):
+			return np.flipud(nc3mmap.variable(ncfile, name, header=header))
+		def get_fill(name):
+			return nc3mmap.fill_value(header, name)
+	else:
+		nc.set_auto_mask(False)
+		def get_var(name):
+			return np.flipud(nc.variables[name][:])
+		def get_fill(name):
+			var = nc.variables[name]
+			return getattr(var, '_FillValue', netCDF4.default_fillvals[var.dtype.str[1:]])
+	return get_var, get_fill, nc
 
-ncpath, ncfname = os.path.split(ncfile)
-print ('Using netCDF file: %s \nin directory: %s' % (ncfname, ncpath))
-outpath, outfname = os.path.split(outfile)
-print ('Writing results to: %s\n' % outfile)
 
-# Open netCDF file
-nc = netCDF4.Dataset(ncfile, 'r')
-dims = nc.dimensions
-print ("N-S dim: %s \t E-W dim: %s" % (len(dims['y']), len(dims['x'])))
-print ('---------------------------------------------------------\n')
+def drain_points(ncfile):
+	"""
+	Find the drain points in the frxst_pts variable, in row order
+	Returns a list of rows: ID, stream order, longitude, latitude, elevation, basin mask
+	(fill values masked, as netCDF4 does)
+	"""
+	get_var, get_fill, nc = hires_reader(ncfile)
+	try:
+		def point_values(name, rows, cols):
+			return np.ma.masked_equal(get_var(name)[rows, cols], get_fill(name))
 
-# Read required variables into numpy arrays
-# Use numpy flipud function to get arrays ordered from bottom to top
-# So that drain point id's will be the same as WRF-Hydro
-fr_arr 	= np.flipud(nc.variables['frxst_pts'])
-topo_arr = np.flipud(nc.variables['TOPOGRAPHY'])
-str_arr	= np.flipud(nc.variables['STREAMORDER'])
-lat_arr	= np.flipud(nc.variables['LATITUDE'])
-lon_arr	= np.flipud(nc.variables['LONGITUDE'])
-x_arr	= np.flipud(nc.variables['x'])
-y_arr	= np.flipud(nc.variables['y'])
-bm_arr	= np.flipud(nc.variables['basn_mask'])
-fr_cnt	= 0
+		fr_arr 	= get_var('frxst_pts')
+		rows, cols = np.nonzero(fr_arr >= 0)
+		str_vals	= point_values('STREAMORDER', rows, cols)
+		lon_vals	= point_values('LONGITUDE', rows, cols)
+		lat_vals	= point_values('LATITUDE', rows, cols)
+		topo_vals	= point_values('TOPOGRAPHY', rows, cols)
+		bm_vals	= point_values('basn_mask', rows, cols)
+	finally:
+		nc.close()
 
-# Loop thru the frxst_pts array
-print('ID\tStream Order\tLongitude\tLatitude\tElevation\tBasin Mask')
-details=[]
-for idx, fr_val in np.ndenumerate(fr_arr):
-	if (fr_val >= 0) :
-		fr_cnt += 1
-		str_val = str_arr[idx[0], idx[1]]
-		lon_val = lon_arr[idx[0], idx[1]]
-		lat_val = lat_arr[idx[0], idx[1]]
-		topo_val = topo_arr[idx[0], idx[1]]
-		basn_val = bm_arr[idx[0], idx[1]]
-		print ('%s\t%s\t%s\t%s\t%s\t%s' % (fr_cnt, str_val, lon_val, lat_val, topo_val, basn_val))
-		details.append([fr_cnt,str_val,lon_val,lat_val,topo_val,basn_val])
+	details=[]
+	for i in range(len(rows)):
+		details.append([i + 1, str_vals[i], lon_vals[i], lat_vals[i], topo_vals[i], bm_vals[i]])
+	return details
 
-# Now do the output
-out_f = open(outfile, 'w')
-out_f.write('ID,Stream Order,Longitude,Latitude,Elevation,Basin Mask\n')
-for i in range(len(details)):
-	out_f.write('%s,%s,%s,%s,%s,%s\n' % (details[i][0], details[i][1],details[i][2],details[i][3],details[i][4],details[i][5]))
-out_f.close()		
-#print "{0:0>3}".format(tile_max_ln), "{0:0>3}".format(tile_min_ln)
-#print "Tile Max/Min longitude, Max/Min latitude: %s, %s, %s, %s" % ("{0:0>3}".format(tile_max_ln), "{0:0>3}".format(tile_min_ln), tile_max_lt, tile_min_lt)
-       
 
+def write_drain_points(details, outfile):
+	out_f = open(outfile, 'w')
+	out_f.write('ID,Stream Order,Longitude,Latitude,Elevation,Basin Mask\n')
+	for d in details:
+		out_f.write('%s,%s,%s,%s,%s,%s\n' % tuple(d))
+	out_f.close()
+
+
+if __name__ == "__main__":
+	# Command line arguments
+	parser = argparse.ArgumentParser(description="Analyze gis_hires netCDF file", usage='%(prog)s [options]')
+	parser.add_argument("-i","--input", dest="in_nc", help="The path/name of the netCDF input file", nargs='?', type=argparse.FileType('r'), required=True)
+	parser.add_argument("-o", "--output", dest="out_txt", default="drain_pts.txt", help="The path/name for the output text file", nargs='?', type=argparse.FileType('w'))
+	args = parser.parse_args()
+	ncfile = args.in_nc.name
+	outfile = args.out_txt.name
+
+	ncpath, ncfname = os.path.split(ncfile)
+	print ('Using netCDF file: %s \nin directory: %s' % (ncfname, ncpath))
+	print ('Writing results to: %s\n' % outfile)
+	nc = netCDF4.Dataset(ncfile, 'r')
+	dims = nc.dimensions
+	print ("N-S dim: %s \t E-W dim: %s" % (len(dims['y']), len(dims['x'])))
+	nc.close()
+	print ('---------------------------------------------------------\n')
+
+	details = drain_points(ncfile)
+	print('ID\tStream Order\tLongitude\tLatitude\tElevation\tBasin Mask')
+	for d in details:
+		print ('%s\t%s\t%s\t%s\t%s\t%s' % tuple(d))
+	write_drain_points(details, outfile)